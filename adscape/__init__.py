@@ -0,0 +1,36 @@
+import importlib
+
+
+# Headless core of the apps: capture, detection, session storage and the LLM
+# client, no GUI toolkit. The main names are available from the package
+# (adscape.Monitor, adscape.SessionStore..) and their module is imported on first
+# use: importing adscape costs nothing and each entry point only pays for what it
+# uses. Import times are budgeted, see IMPORT_BUDGET in adscape.bench.
+
+_EXPORTS = {
+    'Session': 'session', 'Message': 'session', 'MessageStore': 'session',
+    'SessionStore': 'main', 'SessionJournal': 'main', 'SessionDirectory': 'main',
+    'SessionSearch': 'search',
+    'LLMClient': 'llm', 'ChatHistory': 'llm', 'PromptCache': 'llm',
+    'MultiCapture': 'capture', 'Region': 'capture', 'AdaptiveInterval': 'capture',
+    'AdDetector': 'detect', 'SignatureLibrary': 'detect',
+    'FramePipeline': 'pipeline',
+    'FrameRing': 'ring', 'EvidenceExporter': 'ring',
+    'Monitor': 'monitor', 'AlertState': 'alert',
+    'tracer': 'trace',
+}
+
+__all__ = list(_EXPORTS)
+
+
+def __getattr__(name):
+    module = _EXPORTS.get(name)
+    if module is None:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    value = getattr(importlib.import_module(f'.{module}', __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(__all__))
@@ -0,0 +1,146 @@
+import time
+import threading
+
+from .detect import AdDetector
+from .trace import tracer
+
+
+# What the window of the background monitor should show, as a state machine fed
+# by the monitor callbacks (many per second while the screen changes). The UI is
+# only called on transitions: shown when a new ad appears, hidden when the user
+# acknowledges it or once the place of the ads has stayed clear for `hide_after`
+# seconds (one timer per transition, no polling). Only the changed parts of the
+# screen are detected: an ad that stays on screen is not seen again, so a clear
+# crop only counts for the ads whose box it covers. Bursts of detections of the
+# ads already shown are absorbed, an ad raises an alert at most once per
+# `min_interval` and not at all for `cooldown` seconds after it was acknowledged.
+
+HIDDEN, ALERTING, ACKNOWLEDGED = 'hidden', 'alerting', 'acknowledged'
+
+
+def ad_keys(detections):
+    """Identity of the ads of `detections`: (kind, label) of the creatives and badges"""
+    return {(d.kind, d.label) for d in detections if AdDetector.is_ad((d,))}
+
+
+def _ad_boxes(detections, keys):
+    return {d.box for d in detections if (d.kind, d.label) in keys}
+
+
+def _covers(area, box):
+    return area[0] <= box[0] and area[1] <= box[1] \
+        and box[0] + box[2] <= area[0] + area[2] and box[1] + box[3] <= area[1] + area[3]
+
+
+def _timer(delay, callback):
+    timer = threading.Timer(delay, callback)
+    timer.daemon = True
+    timer.start()
+
+
+class AlertState():
+    """Debounced hidden/alerting/acknowledged state. `on_show(detections)` and `on_hide()`
+    are called on transitions only, from the thread of the call that caused them (or
+    of `schedule(delay, callback)`, which runs the hide timer, a daemon thread by default).
+    """
+
+    def __init__(self, on_show=None, on_hide=None, schedule=None, hide_after=2.0, min_interval=10.0,
+                 cooldown=300.0, clock=time.monotonic) -> None:
+        self.on_show = on_show
+        self.on_hide = on_hide
+        self.schedule = schedule or _timer
+        self.hide_after = hide_after
+        self.min_interval = min_interval
+        self.cooldown = cooldown
+        self.clock = clock
+        self.state = HIDDEN
+        self.active = set()             # ad keys of the current alert
+        self.boxes = set()              # their boxes on screen, not seen cleared since
+        self.transitions = 0
+        self.suppressed = 0             # detections of ads rate limited or in cooldown
+        self._alerted = {}              # ad key: clock() of its last alert
+        self._acknowledged = {}         # ad key: clock() of its acknowledgement
+        self._hide_token = None         # pending hide timer (token of the last clear)
+        self._lock = threading.Lock()
+
+    def event(self, detections):
+        """Detections of a frame with an ad, True if the alert is shown"""
+        now = self.clock()
+        with self._lock:
+            keys = ad_keys(detections)
+            if self.state != HIDDEN and keys & self.active:
+                # still on screen: keep the alert
+                self.boxes |= _ad_boxes(detections, self.active)
+                self._hide_token = None
+            new = {key for key in keys - self.active if self._allowed(key, now)}
+            if not new:
+                self.suppressed += bool(keys - self.active)
+                return False
+            for key in new:
+                self._alerted[key] = now
+            if self.state == ALERTING:
+                # burst: merged into the shown alert
+                self.active |= new
+                self.boxes |= _ad_boxes(detections, new)
+                self._hide_token = None
+                return False
+            self.active = new
+            self.boxes = _ad_boxes(detections, new)
+            self._set(ALERTING)
+        if self.on_show:
+            self.on_show(detections)
+        return True
+
+    def clear(self, box):
+        """A crop at `box` (x, y, w, h, as the detection boxes) detected without ads. Once the
+        boxes of all the alerted ads are clear, the alert is hidden `hide_after` seconds later
+        unless an ad is seen again"""
+        with self._lock:
+            if self.state == HIDDEN:
+                return
+            self.boxes = {b for b in self.boxes if not _covers(box, b)}
+            if self.boxes:
+                return
+            if self.state == ACKNOWLEDGED:
+                # the window is hidden already
+                self.active = set()
+                self._set(HIDDEN)
+                return
+            if self._hide_token is not None:
+                return
+            token = self._hide_token = object()
+        self.schedule(self.hide_after, lambda: self._expire(token))
+
+    def acknowledge(self):
+        """Closed by the user: no alert for these ads during `cooldown`"""
+        now = self.clock()
+        with self._lock:
+            if self.state != ALERTING:
+                return
+            for key in self.active:
+                self._acknowledged[key] = now
+            self._hide_token = None
+            self._set(ACKNOWLEDGED)
+        if self.on_hide:
+            self.on_hide()
+
+    def _allowed(self, key, now):
+        return now - self._alerted.get(key, -self.min_interval) >= self.min_interval \
+            and now - self._acknowledged.get(key, -self.cooldown) >= self.cooldown
+
+    def _expire(self, token):
+        with self._lock:
+            if token is not self._hide_token or self.state != ALERTING:
+                return
+            self._hide_token = None
+            self.active = set()
+            self.boxes = set()
+            self._set(HIDDEN)
+        if self.on_hide:
+            self.on_hide()
+
+    def _set(self, state):
+        # called with the lock held
+        self.state = state
+        self.transitions += 1
+        tracer.count(f'alert.{state}')
@@ -0,0 +1,71 @@
+import pytest
+from adscape.alert import *
+from adscape.detect import Detection
+
+sponsored = [Detection('badge', (10, 10, 40, 12), 0.9, 'sponsored')]
+promoted = [Detection('badge', (10, 60, 40, 12), 0.9, 'promoted')]
+layout = [Detection('layout', (0, 0, 100, 100), 0.5)]
+# crops detected without ads: over the sponsored badge, elsewhere
+ad_area, other_area = (0, 0, 64, 32), (128, 0, 128, 128)
+
+
+def test_AlertState():
+    now = [0.0]
+    shown, hidden, timers = [], [], []
+    alerts = AlertState(on_show=shown.append, on_hide=lambda: hidden.append(now[0]),
+                        schedule=lambda delay, callback: timers.append(callback),
+                        hide_after=2, min_interval=10, cooldown=60, clock=lambda: now[0])
+    assert ad_keys(sponsored + layout) == {('badge', 'sponsored')}
+
+    # a burst of detections: one show
+    assert alerts.event(sponsored)
+    assert not alerts.event(sponsored) and not alerts.event(sponsored + promoted)
+    assert alerts.state == ALERTING and len(shown) == 1 and len(alerts.active) == 2
+
+    # clear crops: one hide timer once both ads are gone, cancelled by an ad seen again
+    alerts.clear(ad_area)
+    assert alerts.state == ALERTING and not timers
+    alerts.clear((0, 50, 128, 128))
+    alerts.clear(ad_area)
+    assert len(timers) == 1
+    alerts.event(sponsored)
+    timers.pop()()
+    assert alerts.state == ALERTING and not hidden
+    alerts.clear(ad_area)
+    now[0] = 3.0
+    timers.pop()()
+    assert alerts.state == HIDDEN and hidden == [3.0]
+
+    # rate limited, then shown again
+    assert not alerts.event(sponsored) and alerts.suppressed == 1
+    now[0] = 10.0
+    assert alerts.event(sponsored) and len(shown) == 2
+
+    # acknowledged: hidden at once, no alert for that ad during the cooldown
+    alerts.acknowledge()
+    assert alerts.state == ACKNOWLEDGED and len(hidden) == 2
+    alerts.clear(ad_area)
+    assert alerts.state == HIDDEN and len(hidden) == 2 and not timers
+    now[0] = 30.0
+    assert not alerts.event(sponsored)
+    assert alerts.event(promoted) and len(shown) == 3
+    now[0] = 80.0
+    alerts.acknowledge()
+    now[0] = 100.0
+    assert alerts.event(sponsored)
+    assert alerts.transitions == 8
+
+
+def test_AlertState_unchanged_ad():
+    timers = []
+    alerts = AlertState(schedule=lambda delay, callback: timers.append(callback))
+    alerts.event(sponsored)
+    # the ad is still on screen, unchanged: only the tiles next to it are detected
+    for _ in range(3):
+        alerts.clear(other_area)
+    # partly over the ad
+    alerts.clear((20, 0, 64, 32))
+    assert alerts.state == ALERTING and not timers
+    alerts.clear(ad_area)
+    timers.pop()()
+    assert alerts.state == HIDDEN
@@ -0,0 +1,418 @@
+import os
+import sys
+import json
+import time
+import random
+import pathlib
+import platform
+import tempfile
+import subprocess
+import threading
+import itertools
+import contextlib
+from datetime import datetime, timedelta
+import numpy as np
+
+from .main import Session, SessionStore, SessionJournal, SessionDirectory
+from .llm import LLMClient, ChatHistory, PromptCache
+from .capture import DirtyTiles, dirty_boxes
+from .detect import SignatureLibrary, AdDetector, load_image
+from .pipeline import FramePipeline
+from .ollama_stub import OllamaStub
+
+
+# Benchmarks of the session store, the LLM apps' session files, the capture/detect
+# loop and the LLM client (against the local Ollama stub), on seeded synthetic data,
+# and of the startup of the entry points:
+#   python -m adscape.bench --sessions 10000 100000 --out results.json
+#   python -m adscape.bench --baseline results.json      (p50 ratios to a previous run)
+#   python -m adscape.bench --suite startup --check-budget
+# Results are JSON: per suite and case the latency stats of the runs, in seconds.
+
+REPO = pathlib.Path(__file__).parent.parent
+SCREENSHOT = REPO / 'ss' / 'Screenshot - withads(sponsored).png'
+MODELS = ('llama3', 'mistral', 'phi3')
+
+# Import-time budget (seconds, p50 of a cold import in a fresh interpreter, about
+# twice the time on a laptop) of the core modules and of the background monitor,
+# relaunched at login. `--check-budget` fails over budget or when a module imports
+# one of NOT_IMPORTED: no GUI toolkit in the core, and the monitor imports neither
+# the LLM client nor the session storage, nor the detector pool before it is used.
+IMPORT_BUDGET = {
+    'adscape': 0.005,
+    'adscape.session': 0.03,
+    'adscape.main': 0.06,
+    'adscape.llm': 0.25,
+    'adscape.monitor': 0.25,
+    'main_backgroud_event': 0.25,
+}
+NOT_IMPORTED = {
+    'adscape': ('kivy', 'numpy', 'requests', 'sqlite3'),
+    'adscape.session': ('kivy',),
+    'adscape.main': ('kivy', 'sqlite3'),
+    'adscape.llm': ('kivy',),
+    'adscape.monitor': ('kivy', 'requests', 'sqlite3', 'adscape.pipeline'),
+    'main_backgroud_event': ('kivy', 'requests', 'sqlite3', 'adscape.pipeline'),
+}
+# timed in the child, interpreter startup excluded; prints the seconds and the unexpected imports
+_IMPORT_PROBE = ('import sys, time\n'
+                 't = time.perf_counter()\n'
+                 'import {module}\n'
+                 'seconds = time.perf_counter() - t\n'
+                 'print(seconds, *[m for m in {not_imported!r} if m in sys.modules])\n')
+
+
+class Timer():
+    """Latencies of the runs of a case, timed with `with timer:`"""
+
+    def __init__(self) -> None:
+        self.samples: list[float] = []
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.samples.append(time.perf_counter() - self._start)
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+
+    def as_dict(self):
+        s = sorted(self.samples)
+        if not s:
+            return {'count': 0}
+        return {'count': len(s), 'mean': sum(s) / len(s), 'p50': s[len(s) // 2],
+                'p95': s[min(len(s) - 1, int(len(s) * 0.95))], 'min': s[0], 'max': s[-1]}
+
+
+class Vocabulary():
+    """Seeded pseudo-words with Zipf-like frequencies (a few frequent, many rare)"""
+
+    def __init__(self, rng, size=5000) -> None:
+        letters = 'abcdefghijklmnopqrstuvwxyz'
+        self.rng = rng
+        self.words = [''.join(rng.choices(letters, k=rng.randint(2, 10))) for _ in range(size)]
+        self.cum_weights = list(itertools.accumulate(1 / (r + 1) for r in range(size)))
+
+    def text(self, n_words):
+        return ' '.join(self.rng.choices(self.words, cum_weights=self.cum_weights, k=n_words))
+
+
+def synthetic_sessions(n, seed=0, turns=3, words=80, start=datetime(2025, 1, 1)):
+    """`n` archive sessions a minute apart, `turns` questions and answers each"""
+    rng = random.Random(seed)
+    vocabulary = Vocabulary(rng)
+    for i in range(n):
+        name = f"session_{(start + timedelta(minutes=i)).strftime('%Y%m%d_%H%M%S')}.json"
+        yield Session(name=name, meta={'llm': rng.choice(MODELS)},
+                      questions=[vocabulary.text(rng.randint(5, 20)) for _ in range(turns)],
+                      answers=[vocabulary.text(rng.randint(words // 2, words * 2)) for _ in range(turns)])
+
+
+def long_conversation(turns=200, seed=0, words=80):
+    """Messages of an LLM app session (user and assistant alternating)"""
+    rng = random.Random(seed)
+    vocabulary = Vocabulary(rng)
+    messages = []
+    for _ in range(turns):
+        messages.append({'role': 'user', 'content': vocabulary.text(rng.randint(5, 30))})
+        messages.append({'role': 'assistant', 'content': vocabulary.text(rng.randint(words // 2, words * 2))})
+    return messages
+
+
+def synthetic_frames(n, seed=0, base=None):
+    """`n` successive screen frames: the recorded screenshot (or `base`) with, from one
+    frame to the next, a few redrawn rectangles and now and then a scrolled band"""
+    rng = np.random.default_rng(seed)
+    frame = load_image(SCREENSHOT) if base is None else base
+    frame = np.ascontiguousarray(frame)
+    h, w = frame.shape[:2]
+    frames = [frame]
+    for _ in range(n - 1):
+        frame = frame.copy()
+        for _ in range(rng.integers(1, 4)):
+            rh, rw = rng.integers(8, h // 4), rng.integers(8, w // 4)
+            y, x = rng.integers(0, h - rh), rng.integers(0, w - rw)
+            frame[y:y + rh, x:x + rw, :3] = rng.integers(0, 256, 3, dtype=np.uint8)
+        if rng.random() < 0.3:
+            y0, y1 = sorted(rng.integers(0, h, 2))
+            frame[y0:y1] = np.roll(frame[y0:y1], -int(rng.integers(10, 60)), axis=0)
+        frames.append(frame)
+    return frames
+
+
+def recorded_frames(paths):
+    """Frames of recorded screenshots, in order"""
+    return [load_image(p) for p in sorted(paths)]
+
+
+@contextlib.contextmanager
+def workdir():
+    # the stores and the apps write their session files to the working directory
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory(prefix='adscape_bench') as tmp:
+        os.chdir(tmp)
+        try:
+            yield pathlib.Path(tmp)
+        finally:
+            os.chdir(cwd)
+
+
+def bench_store(n_sessions=10000, seed=0, fetches=200, batches=5, batch=10):
+    """SessionStore: archiving (1000 sessions per store), open, random and sequential
+    fetches, storing small batches and searching"""
+    timers = {case: Timer() for case in ('store_1000', 'open', 'fetch_random', 'fetch_sequential',
+                                         'store_batch', 'search')}
+    rng = random.Random(seed)
+    with workdir() as tmp:
+        archive = tmp / 'bench_store.zip'
+        sessions = synthetic_sessions(n_sessions + batches * batch, seed)
+        with SessionStore(archive, prefetch=0) as ss:
+            for _ in range(0, n_sessions, 1000):
+                for s in itertools.islice(sessions, 1000):
+                    pathlib.Path(s.name).write_text(s.to_json(), encoding='utf-8')
+                with timers['store_1000']:
+                    ss.store_sessions()
+        for _ in range(5):
+            with timers['open']:
+                ss = SessionStore(archive, prefetch=0)
+            ss.close()
+        with SessionStore(archive, prefetch=0, cache_entries=8) as ss:
+            for i in rng.sample(range(len(ss.index)), min(fetches, len(ss.index))):
+                with timers['fetch_random']:
+                    ss.get_session(i)
+            for i in range(len(ss.index) - 1, max(-1, len(ss.index) - 1 - fetches), -1):
+                with timers['fetch_sequential']:
+                    ss.get_session(i)
+            for _ in range(batches):
+                for s in itertools.islice(sessions, batch):
+                    ss.add_session(s)
+                with timers['store_batch']:
+                    ss.store_sessions()
+            words = ss.get_session(len(ss.index) - 1).answers[0].split()
+            for word in rng.sample(words, min(10, len(words))):
+                with timers['search']:
+                    ss.search(word)
+    return {case: timer.as_dict() for case, timer in timers.items()}
+
+
+def bench_apps(turns=200, n_files=10000, seed=0):
+    """LLM apps: journal appends while chatting, saving (journal folded into the snapshot),
+    loading a long session (its JSON file, its binary encoding), listing and paging the sessions folder"""
+    timers = {case: Timer() for case in ('journal_append', 'save', 'load', 'load_binary', 'list_scan', 'list_open',
+                                         'list_poll', 'page')}
+    messages = long_conversation(turns, seed)
+    with workdir() as tmp:
+        sessions_dir = tmp / 'sessions'
+        sessions_dir.mkdir()
+        filename = sessions_dir / 'session_1700000000.json'
+        for _ in range(3):
+            journal = SessionJournal(filename, header=Session(filename.name, {'model': MODELS[0]}, []).header())
+            for message in messages:
+                with timers['journal_append']:
+                    journal.append('messages', message)
+            with timers['save']:
+                journal.close()
+            os.remove(filename)
+        session = Session(filename.name, {'model': MODELS[0]}, messages)
+        SessionJournal(filename, header=session.to_dict()).close()
+        encoded = session.encode()
+        for _ in range(5):
+            with timers['load']:
+                ChatHistory('system', messages=Session.read(filename).messages)
+            with timers['load_binary']:
+                ChatHistory('system', messages=Session.load(encoded).messages)
+
+        for i in range(n_files):
+            (sessions_dir / f'session_{1600000000 + i}.json').write_text('{}')
+        for _ in range(5):
+            with timers['list_scan']:
+                # what each Back/Next click used to cost
+                sorted(f for f in os.listdir(sessions_dir) if f.endswith('.json'))
+            with timers['list_open']:
+                directory = SessionDirectory(sessions_dir)
+            with timers['list_poll']:
+                directory.poll()
+        rng = random.Random(seed)
+        for _ in range(1000):
+            with timers['page']:
+                directory[rng.randrange(len(directory))]
+    return {case: timer.as_dict() for case, timer in timers.items()}
+
+
+def bench_capture(n_frames=20, seed=0, frames=None, workers=2):
+    """Capture/detect loop: dirty tiles of each frame, detection of the dirty crops
+    (serial) and of whole frames, throughput of the detector process pool"""
+    timers = {case: Timer() for case in ('dirty_tiles', 'detect_dirty', 'detect_full', 'pipeline')}
+    frames = frames if frames is not None else synthetic_frames(n_frames, seed)
+    reference = load_image(SCREENSHOT)
+    library = SignatureLibrary()
+    library.add_badge(reference[231:242, 1514:1557], 'sponsored')
+    library.add_creative(reference[296:412, 1472:1588], 'cisco')
+    detector = AdDetector(library)
+    tiles = DirtyTiles()
+    for frame in frames:
+        with timers['dirty_tiles']:
+            boxes = dirty_boxes(tiles.update(frame), tiles.tile, frame.shape)
+        with timers['detect_dirty']:
+            for x, y, w, h in boxes:
+                detector.detect(frame[y:y + h, x:x + w])
+    for frame in frames[:5]:
+        with timers['detect_full']:
+            detector.detect(frame)
+
+    done = threading.Semaphore(0)
+    pipeline = FramePipeline(library, frames[0].shape, workers=workers, depth=len(frames),
+                             on_result=lambda detections, key: done.release())
+    try:
+        # warm workers up (process start, prepared shapes) before timing
+        pipeline.submit(frames[0])
+        done.acquire()
+        start = time.perf_counter()
+        for i, frame in enumerate(frames):
+            pipeline.submit(frame, key=i)
+        for _ in frames:
+            done.acquire()
+        timers['pipeline'].add((time.perf_counter() - start) / len(frames))
+    finally:
+        pipeline.close()
+    return {case: timer.as_dict() for case, timer in timers.items()}
+
+
+def bench_llm(n_requests=20, seed=0, latency=0.05, token_seconds=0.002, reply_tokens=64):
+    """LLM client against the Ollama stub: model warm-up, time to first token and
+    total time of streamed generations and chats, prompt cache hits"""
+    timers = {case: Timer() for case in ('warm_up', 'ttft', 'generate', 'chat', 'cached')}
+    vocabulary = Vocabulary(random.Random(seed))
+    with workdir() as tmp, OllamaStub(latency=latency, token_seconds=token_seconds,
+                                      reply_tokens=reply_tokens) as stub:
+        client = LLMClient(stub.url, cache=PromptCache(tmp / 'bench_cache.db'))
+        try:
+            timers['warm_up'].add(_wait(client.warm_up, MODELS[0])[1]['total'])
+            for _ in range(n_requests):
+                _, metrics = _wait(client.generate, {'model': MODELS[0], 'prompt': vocabulary.text(20)},
+                                   on_token=lambda token: None)
+                timers['ttft'].add(metrics['ttft'])
+                timers['generate'].add(metrics['total'])
+            history = ChatHistory('system')
+            for _ in range(n_requests):
+                history.append('user', vocabulary.text(20))
+                text, metrics = _wait(client.chat, history, MODELS[0])
+                history.append('assistant', text)
+                timers['chat'].add(metrics['total'])
+            payload = {'model': MODELS[0], 'prompt': vocabulary.text(20), 'options': {'seed': seed}}
+            _wait(client.generate, payload)
+            for _ in range(n_requests):
+                with timers['cached']:
+                    _wait(client.generate, payload)
+        finally:
+            client.close()
+            client.cache.close()
+    return {case: timer.as_dict() for case, timer in timers.items()}
+
+
+def bench_startup(runs=10, modules=tuple(IMPORT_BUDGET)):
+    """Cold import of the entry points, each in a fresh interpreter, and the modules
+    they should not have imported (`unexpected`), against IMPORT_BUDGET"""
+    timers = {module: Timer() for module in modules}
+    unexpected = {module: set() for module in modules}
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join(filter(None, (str(REPO), os.environ.get('PYTHONPATH')))))
+    for _ in range(runs):
+        for module in modules:
+            probe = _IMPORT_PROBE.format(module=module, not_imported=NOT_IMPORTED.get(module, ()))
+            out = subprocess.run([sys.executable, '-c', probe], capture_output=True, text=True, check=True,
+                                 cwd=REPO, env=env).stdout.split()
+            timers[module].add(float(out[0]))
+            unexpected[module].update(out[1:])
+    return {module: {**timer.as_dict(), 'budget': IMPORT_BUDGET.get(module), 'unexpected': sorted(unexpected[module])}
+            for module, timer in timers.items()}
+
+
+def check_budget(results):
+    """Violations of the import budget in `results` (of `run`), as messages"""
+    violations = []
+    for module, stats in results['results'].get('startup', {}).items():
+        if stats.get('budget') is not None and stats['p50'] > stats['budget']:
+            violations.append(f"{module}: imported in {stats['p50']*1000:.0f}ms, budget {stats['budget']*1000:.0f}ms")
+        if stats.get('unexpected'):
+            violations.append(f"{module}: imports {', '.join(stats['unexpected'])}")
+    return violations
+
+
+def _wait(call, *args, **kwargs):
+    # blocking call of an LLMClient request
+    done = threading.Event()
+    outcome = {}
+    call(*args, on_done=lambda result: (outcome.update(result=result), done.set()),
+         on_error=lambda e: (outcome.update(error=e), done.set()), **kwargs)
+    done.wait()
+    if 'error' in outcome:
+        raise outcome['error']
+    return outcome['result']
+
+
+SUITES = {'store': bench_store, 'apps': bench_apps, 'capture': bench_capture, 'llm': bench_llm,
+          'startup': bench_startup}
+
+
+def run(suites=tuple(SUITES), sessions=(10000,), seed=0, frames=None, quick=False):
+    """Results of the benchmark `suites` (the store one for each size of `sessions`)"""
+    results = {}
+    for suite in suites:
+        if suite == 'store':
+            for n in sessions:
+                results[f'store_{n}'] = bench_store(n, seed, fetches=20 if quick else 200)
+        elif suite == 'apps':
+            results['apps'] = bench_apps(20 if quick else 200, 100 if quick else 10000, seed)
+        elif suite == 'capture':
+            results['capture'] = bench_capture(3 if quick else 20, seed, frames)
+        elif suite == 'llm':
+            results['llm'] = bench_llm(3 if quick else 20, seed)
+        elif suite == 'startup':
+            results['startup'] = bench_startup(1 if quick else 10)
+        else:
+            raise ValueError(f'Unknown suite {suite}, one of {list(SUITES)}')
+    return {'meta': {'time': datetime.now().isoformat(timespec='seconds'), 'seed': seed,
+                     'python': platform.python_version(), 'platform': platform.platform(),
+                     'cpus': os.cpu_count(), 'numpy': np.__version__},
+            'results': results}
+
+
+def compare(baseline, current):
+    """p50 of `current` over p50 of `baseline` per suite and case (> 1: slower)"""
+    ratios = {}
+    for suite, cases in current['results'].items():
+        for case, stats in cases.items():
+            before = baseline['results'].get(suite, {}).get(case, {}).get('p50')
+            if before and stats.get('p50') is not None:
+                ratios.setdefault(suite, {})[case] = stats['p50'] / before
+    return ratios
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(prog='python -m adscape.bench')
+    parser.add_argument('--suite', action='append', choices=list(SUITES), help='default: all')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[10000], help='archive sizes of the store suite')
+    parser.add_argument('--frames', help='folder of recorded screenshots (default: synthetic frames)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--quick', action='store_true', help='few runs, to check the suites work')
+    parser.add_argument('--out', help='results file (default: stdout)')
+    parser.add_argument('--baseline', help='results of a previous run to compare with')
+    parser.add_argument('--check-budget', action='store_true', help='exit with 1 if the startup suite is over IMPORT_BUDGET')
+    args = parser.parse_args()
+    frames = recorded_frames(pathlib.Path(args.frames).glob('*.png')) if args.frames else None
+    results = run(args.suite or tuple(SUITES), args.sessions, args.seed, frames, args.quick)
+    if args.baseline:
+        results['baseline'] = compare(json.loads(pathlib.Path(args.baseline).read_text()), results)
+    output = json.dumps(results, indent=2)
+    if args.out:
+        pathlib.Path(args.out).write_text(output)
+    else:
+        sys.stdout.write(output + '\n')
+    if args.check_budget:
+        violations = check_budget(results)
+        for violation in violations:
+            sys.stderr.write(f'over budget: {violation}\n')
+        sys.exit(1 if violations else 0)
@@ -0,0 +1,33 @@
+import pytest
+from adscape.bench import *
+
+
+def test_synthetic_data():
+    assert list(synthetic_sessions(3, seed=1)) == list(synthetic_sessions(3, seed=1))
+    names = [s.name for s in synthetic_sessions(3)]
+    assert names == sorted(names) and len(set(names)) == 3
+    messages = long_conversation(turns=2)
+    assert [m['role'] for m in messages] == ['user', 'assistant'] * 2
+
+    frames = synthetic_frames(3, seed=1, base=np.zeros((64, 96, 4), dtype=np.uint8))
+    assert len(frames) == 3 and all(f.shape == (64, 96, 4) for f in frames)
+    assert (frames[1] != frames[0]).any()
+
+
+def test_run():
+    results = run(('store', 'apps', 'llm'), sessions=(50,), quick=True)
+    assert set(results['results']) == {'store_50', 'apps', 'llm'}
+    assert results['results']['store_50']['open']['count'] == 5
+    assert results['results']['llm']['cached']['p50'] < results['results']['llm']['generate']['p50']
+    # machine-readable, comparable with a previous run
+    results = json.loads(json.dumps(results))
+    assert compare(results, results)['apps']['save'] == 1.0
+
+
+def test_startup():
+    results = {'results': {'startup': bench_startup(runs=1, modules=('adscape', 'adscape.monitor'))}}
+    assert results['results']['startup']['adscape.monitor']['count'] == 1
+    # headless and lazy: no GUI toolkit, no LLM client nor detector pool in the monitor
+    assert not any(stats['unexpected'] for stats in results['results']['startup'].values())
+    results['results']['startup']['adscape']['p50'] = 1.0
+    assert check_budget(results) == ['adscape: imported in 1000ms, budget 5ms']
@@ -0,0 +1,228 @@
+import zlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+import numpy as np
+
+
+class FrameChange():
+    """Cheap frame-change detection on raw BGRA buffers: a sparse sample of the
+    bytes (every `sample_step`) is compared with the sample of the previous frame.
+
+    Same crc means unchanged; otherwise the fraction of sampled bytes that differ
+    must exceed `threshold` (so a blinking cursor or clock does not count).
+    """
+
+    def __init__(self, sample_step=251, threshold=0.002) -> None:
+        # odd step, so the sample does not keep hitting the same channel of BGRA pixels
+        self.sample_step = sample_step
+        self.threshold = threshold
+        self._sample = None
+        self._crc = None
+
+    def update(self, raw):
+        """Return True when `raw` differs from the previous frame (first frame is a change)"""
+        sample = np.frombuffer(raw, np.uint8)[::self.sample_step].tobytes()
+        crc = zlib.crc32(sample)
+        previous, self._sample = self._sample, sample
+        previous_crc, self._crc = self._crc, crc
+        if previous is None or len(previous) != len(sample):
+            return True
+        if crc == previous_crc:
+            return False
+        diff = np.count_nonzero(np.frombuffer(previous, np.uint8) != np.frombuffer(sample, np.uint8))
+        return diff / len(sample) > self.threshold
+
+
+class AdaptiveInterval():
+    """Polling delay: back to `min_delay` on change, backs off by `backoff` up to `max_delay` when idle"""
+
+    def __init__(self, min_delay=0.5, max_delay=10.0, backoff=1.5, delay=5.0) -> None:
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.delay = delay
+
+    def update(self, changed):
+        if changed:
+            self.delay = self.min_delay
+        else:
+            self.delay = min(self.max_delay, self.delay * self.backoff)
+        return self.delay
+
+
+class FrameCapture():
+    """Screen grabs kept in memory (raw BGRA from mss), only returned when the frame changed"""
+
+    def __init__(self, monitor=1, change=None) -> None:
+        self.monitor = monitor
+        self.change = change or FrameChange()
+        self._sct = None
+
+    def grab(self):
+        if self._sct is None:
+            # created lazily, in the capturing thread (mss handles are thread bound on some platforms)
+            import mss
+            self._sct = mss.mss()
+        return self._sct.grab(self._sct.monitors[self.monitor])
+
+    def grab_if_changed(self):
+        shot = self.grab()
+        return shot if self.change.update(shot.raw) else None
+
+    def close(self):
+        if self._sct is not None:
+            self._sct.close()
+            self._sct = None
+
+
+class Region(NamedTuple):
+    """Area of a monitor, in pixels from its top left corner"""
+    left: int
+    top: int
+    width: int
+    height: int
+
+
+class Crop(NamedTuple):
+    monitor: int
+    box: tuple      # x, y, w, h in desktop pixels
+    frame: np.ndarray
+    seq: int = -1   # of the whole frame in MultiCapture.ring, if any
+
+
+class DirtyTiles():
+    """Changed `tile` x `tile` squares between successive frames of a region.
+
+    Only a sparse grid of pixels (every `step` in both directions) is compared;
+    a tile is dirty when more than `threshold` of its sampled pixels differ.
+    """
+
+    def __init__(self, tile=128, step=8, threshold=0.01) -> None:
+        assert tile % step == 0
+        self.tile = tile
+        self.step = step
+        self.threshold = threshold
+        self._sample = None
+
+    def update(self, frame):
+        """Return the (rows, cols) boolean mask of dirty tiles (all dirty on the first frame)"""
+        sample = frame[::self.step, ::self.step].copy()
+        previous, self._sample = self._sample, sample
+        ny, nx = -(-frame.shape[0] // self.tile), -(-frame.shape[1] // self.tile)
+        if previous is None or previous.shape != sample.shape:
+            return np.ones((ny, nx), dtype=bool)
+        diff = (sample != previous).any(axis=2)
+        per = self.tile // self.step
+        padded = np.zeros((ny * per, nx * per), dtype=np.float32)
+        padded[:diff.shape[0], :diff.shape[1]] = diff
+        counts = padded.reshape(ny, per, nx, per).sum(axis=(1, 3))
+        # tiles cut by the frame border have fewer samples
+        sizes = np.zeros_like(padded)
+        sizes[:diff.shape[0], :diff.shape[1]] = 1
+        sizes = sizes.reshape(ny, per, nx, per).sum(axis=(1, 3))
+        return counts > self.threshold * sizes
+
+
+def dirty_boxes(mask, tile, shape, margin=1):
+    """Rectangles (x, y, w, h) covering the dirty tiles grown by `margin` tiles, clipped to `shape`.
+
+    Boxes are whole tiles (but at the frame border), so the same few crop sizes keep coming back.
+    """
+    ny, nx = mask.shape
+    if margin:
+        padded = np.pad(mask, margin)
+        grown = np.zeros_like(mask)
+        for dy in range(2 * margin + 1):
+            for dx in range(2 * margin + 1):
+                grown |= padded[dy:dy + ny, dx:dx + nx]
+        mask = grown
+    boxes, open_runs = [], {}
+    for y in range(ny + 1):
+        runs = {}
+        if y < ny:
+            row = np.concatenate(([False], mask[y], [False]))
+            edges = np.flatnonzero(row[1:] != row[:-1])
+            for x0, x1 in zip(edges[::2], edges[1::2]):
+                # a run with the same columns as the row above extends its box
+                runs[(x0, x1)] = open_runs.pop((x0, x1), y)
+        for (x0, x1), y0 in open_runs.items():
+            boxes.append((x0, y0, x1, y))
+        open_runs = runs
+    height, width = shape[:2]
+    return [(int(x0 * tile), int(y0 * tile), int(min(x1 * tile, width) - x0 * tile),
+             int(min(y1 * tile, height) - y0 * tile)) for x0, y0, x1, y1 in sorted(boxes, key=lambda b: (b[1], b[0]))]
+
+
+class MultiCapture():
+    """Dirty crops of regions of interest on several monitors, monitors grabbed in parallel.
+
+    `regions` maps monitor numbers (as in mss, 1 is the first) to lists of Region;
+    a monitor mapped to None, or every monitor when `regions` is None, is captured whole.
+    Only the tiles that changed since the previous grab (grown by `margin` tiles, so
+    an ad partly redrawn is still seen whole) are returned. With `history`, the last
+    `history` changed frames are kept in `ring` (a FrameRing sized for the largest region).
+    """
+
+    def __init__(self, regions=None, tile=128, step=8, threshold=0.01, margin=1, history=0) -> None:
+        self.regions = regions
+        self.tile = tile
+        self.margin = margin
+        self.history = history
+        self.ring = None
+        self._tiles_options = {'tile': tile, 'step': step, 'threshold': threshold}
+        self._targets = None
+        self._local = threading.local()
+        self._pool = None
+
+    def grab_dirty(self):
+        """Return the list of Crop that changed since the last call (empty when nothing did)"""
+        if self._targets is None:
+            self._targets = self._make_targets()
+            self._pool = ThreadPoolExecutor(len(self._targets), thread_name_prefix='capture')
+            if self.history:
+                from .ring import FrameRing
+                areas = [area for _, area, _ in self._targets]
+                self.ring = FrameRing((max(a['height'] for a in areas), max(a['width'] for a in areas), 4), self.history)
+        crops = []
+        for found in self._pool.map(self._grab_target, self._targets):
+            crops += found
+        return crops
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+    def _sct(self):
+        # one mss handle per capturing thread (they are thread bound on some platforms)
+        sct = getattr(self._local, 'sct', None)
+        if sct is None:
+            import mss
+            sct = self._local.sct = mss.mss()
+        return sct
+
+    def _make_targets(self):
+        monitors = self._sct().monitors
+        regions = self.regions if self.regions is not None else {i: None for i in range(1, len(monitors))}
+        targets = []
+        for number, areas in regions.items():
+            mon = monitors[number]
+            for r in areas or [Region(0, 0, mon['width'], mon['height'])]:
+                area = {'left': mon['left'] + r.left, 'top': mon['top'] + r.top, 'width': r.width, 'height': r.height}
+                targets.append((number, area, DirtyTiles(**self._tiles_options)))
+        return targets
+
+    def _grab_target(self, target):
+        number, area, tiles = target
+        shot = self._sct().grab(area)
+        frame = np.frombuffer(shot.raw, dtype=np.uint8).reshape(shot.height, shot.width, 4)
+        mask = tiles.update(frame)
+        if not mask.any():
+            return []
+        seq = self.ring.push(frame, number, (area['left'], area['top'])) if self.ring is not None else -1
+        return [Crop(number, (area['left'] + x, area['top'] + y, w, h), frame[y:y + h, x:x + w], seq)
+                for x, y, w, h in dirty_boxes(mask, self.tile, frame.shape, self.margin)]
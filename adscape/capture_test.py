@@ -0,0 +1,51 @@
+import pytest
+from adscape.capture import *
+import numpy as np
+
+
+def test_FrameChange():
+    fc = FrameChange(sample_step=7, threshold=0.01)
+    frame = bytearray(4 * 1000 * 100)
+    assert fc.update(frame)
+    assert not fc.update(frame)
+
+    # a few pixels (cursor blink) are below the threshold
+    frame[700:704] = b'\xff\xff\xff\xff'
+    assert not fc.update(frame)
+
+    frame[:40000] = b'\x80' * 40000
+    assert fc.update(frame)
+
+
+def test_AdaptiveInterval():
+    interval = AdaptiveInterval(min_delay=1, max_delay=4, backoff=2, delay=2)
+    assert interval.update(changed=False) == 4
+    assert interval.update(changed=False) == 4
+    assert interval.update(changed=True) == 1
+    assert interval.update(changed=False) == 2
+
+
+def test_DirtyTiles():
+    tiles = DirtyTiles(tile=32, step=4)
+    frame = np.zeros((100, 130, 4), dtype=np.uint8)
+    assert tiles.update(frame).all()
+    assert tiles.update(frame).shape == (4, 5)
+    assert not tiles.update(frame).any()
+
+    frame[40:50, 70:80] = 255
+    mask = tiles.update(frame)
+    assert mask.sum() == 1 and mask[1, 2]
+
+
+def test_dirty_boxes():
+    mask = np.zeros((4, 5), dtype=bool)
+    mask[1, 2] = True
+    assert dirty_boxes(mask, 32, (100, 130), margin=0) == [(64, 32, 32, 32)]
+    # grown by one tile, clipped to the frame
+    assert dirty_boxes(mask, 32, (100, 130)) == [(32, 0, 96, 96)]
+    mask[3, 4] = True
+    assert dirty_boxes(mask, 32, (100, 130), margin=0) == [(64, 32, 32, 32), (128, 96, 2, 4)]
+    # tiles of same columns in successive rows make one box
+    mask[:] = False
+    mask[0:3, 1:3] = True
+    assert dirty_boxes(mask, 32, (100, 130), margin=0) == [(32, 0, 64, 96)]
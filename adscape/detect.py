@@ -0,0 +1,413 @@
+import pathlib
+from collections import OrderedDict
+from typing import NamedTuple
+import numpy as np
+
+
+# Ad detection on raw screen frames (BGRA from mss), vectorized with NumPy:
+#  - perceptual (d)hash of known ad creatives, matched over a grid of windows
+#  - multi-scale normalized cross-correlation of "Sponsored"-like badges
+#  - layout heuristic: standard (IAB) ad sized blocks framed by a uniform margin
+# Signatures are precomputed once (SignatureLibrary) and cached per frame size.
+# The cost grows with the pixels: the real-time path detects the changed tiles
+# only (crops from MultiCapture.grab_dirty, a few ms each), a whole 1080p frame
+# takes a few hundred ms (first grab, offline runs). See bench_capture in adscape.bench.
+
+# common IAB ad unit sizes (w, h)
+IAB_SIZES = ((300, 250), (728, 90), (160, 600), (300, 600), (320, 50), (970, 250))
+
+
+class Detection(NamedTuple):
+    kind: str       # 'creative', 'badge' or 'layout'
+    box: tuple      # x, y, w, h in frame pixels
+    score: float
+    label: str = ''
+
+
+def frame_from_raw(raw, width, height):
+    """Zero-copy (h, w, 4) BGRA view over a raw mss buffer"""
+    return np.frombuffer(raw, dtype=np.uint8).reshape(height, width, 4)
+
+
+def load_image(path):
+    """Stored screenshot/creative as a BGRA frame (for offline runs and building signatures)"""
+    from PIL import Image
+    with Image.open(path) as img:
+        rgba = np.asarray(img.convert('RGBA'))
+    return rgba[..., [2, 1, 0, 3]]
+
+
+GRAY_WEIGHTS = np.array([0.114, 0.587, 0.299], dtype=np.float32)   # B, G, R
+
+
+def gray(frame):
+    # einsum reads the uint8 channels in place (no float copy of the whole frame)
+    return np.einsum('ijk,k->ij', frame[..., :3], GRAY_WEIGHTS)
+
+
+def integral(img):
+    """Summed-area table with a leading row/column of zeros"""
+    ii = np.zeros((img.shape[0] + 1, img.shape[1] + 1), dtype=np.float64)
+    np.cumsum(np.cumsum(img, axis=0, dtype=np.float64), axis=1, out=ii[1:, 1:])
+    return ii
+
+
+def box_sums(ii, h, w, step=1, y0=0, x0=0, ny=None, nx=None):
+    """Sums of the (h, w) boxes with top-left corners on the grid from (y0, x0) by `step`
+    (by default as many as fit), shape (ny, nx). Slicing only, no fancy indexing"""
+    H, W = ii.shape[0] - 1, ii.shape[1] - 1
+    ny = (H - h - y0) // step + 1 if ny is None else ny
+    nx = (W - w - x0) // step + 1 if nx is None else nx
+    ys, ys_h = slice(y0, y0 + (ny - 1) * step + 1, step), slice(y0 + h, y0 + h + (ny - 1) * step + 1, step)
+    xs, xs_w = slice(x0, x0 + (nx - 1) * step + 1, step), slice(x0 + w, x0 + w + (nx - 1) * step + 1, step)
+    return ii[ys_h, xs_w] - ii[ys, xs_w] - ii[ys_h, xs] + ii[ys, xs]
+
+
+def downscale(img, factor):
+    """Mean of factor x factor blocks"""
+    if factor == 1:
+        return img
+    h, w = img.shape[0] // factor, img.shape[1] // factor
+    # strided sums: a reshape and mean over its axes 1 and 3 is ~10x slower
+    rows = img[0:h * factor:factor, :w * factor].astype(np.float32)
+    for i in range(1, factor):
+        rows += img[i:h * factor:factor, :w * factor]
+    out = rows[:, 0::factor].copy()
+    for j in range(1, factor):
+        out += rows[:, j::factor]
+    return out * (1.0 / (factor * factor))
+
+
+def resize(img, h, w):
+    """Nearest-neighbour resize (signatures only, not on the per-frame path)"""
+    ys = (np.arange(h) * img.shape[0] / h).astype(np.intp)
+    xs = (np.arange(w) * img.shape[1] / w).astype(np.intp)
+    return img[ys[:, None], xs[None, :]]
+
+
+def dhash(img):
+    """64 bits difference hash of a gray image (8x9 cell means, compared left to right)
+    and the mask of its significant bits"""
+    bits, mask = _window_dhash(integral(img), img.shape[0], img.shape[1], 1)
+    return bits[0, 0], mask[0, 0]
+
+
+def _window_dhash(ii, h, w, step, tolerance=2.0):
+    """dhash of every (h, w) window on the grid by `step`, as uint64 of shape (ny, nx),
+    with the mask of bits whose cells differ by more than `tolerance` gray levels
+    (comparing near-equal cells of flat areas is noise)"""
+    H, W = ii.shape[0] - 1, ii.shape[1] - 1
+    ny, nx = (H - h) // step + 1, (W - w) // step + 1
+    r_edges = np.round(np.linspace(0, h, 9)).astype(np.intp)
+    c_edges = np.round(np.linspace(0, w, 10)).astype(np.intp)
+    corners = np.empty((9, 10, ny, nx))
+    for r, re in enumerate(r_edges):
+        for c, ce in enumerate(c_edges):
+            corners[r, c] = ii[re:re + (ny - 1) * step + 1:step, ce:ce + (nx - 1) * step + 1:step]
+    # column strips then cells (8, 9, ny, nx): float32 once the large prefix sums are subtracted
+    cells = np.diff(np.diff(corners, axis=1).astype(np.float32), axis=0)
+    diff = np.diff(cells, axis=1).reshape(64, ny, nx)
+    cell_area = (h / 8) * (w / 9)
+    return _pack64(diff > 0), _pack64(np.abs(diff) > tolerance * cell_area)
+
+
+def _pack64(bits):
+    """(64, ...) bits, the first the most significant, as uint64 (...)"""
+    packed = np.moveaxis(np.packbits(bits, axis=0), 0, -1)
+    return np.ascontiguousarray(packed).view('>u8')[..., 0].astype(np.uint64)
+
+
+def hamming(a, b, mask=None):
+    x = np.bitwise_xor(a, b)
+    return np.bitwise_count(x if mask is None else x & mask)
+
+
+class SignatureLibrary():
+    """Precomputed ad signatures: dhash + native size of creatives, gray badge templates"""
+
+    def __init__(self) -> None:
+        self.creative_hashes = np.zeros(0, dtype=np.uint64)
+        self.creative_masks = np.zeros(0, dtype=np.uint64)
+        self.creative_sizes = np.zeros((0, 2), dtype=np.int32)   # w, h
+        self.creative_labels: list[str] = []
+        self.badges: list[np.ndarray] = []
+        self.badge_labels: list[str] = []
+
+    def add_creative(self, frame, label=''):
+        g = gray(frame)
+        bits, mask = dhash(g)
+        self.creative_hashes = np.append(self.creative_hashes, bits)
+        self.creative_masks = np.append(self.creative_masks, mask)
+        self.creative_sizes = np.vstack([self.creative_sizes, [g.shape[1], g.shape[0]]]).astype(np.int32)
+        self.creative_labels.append(label)
+
+    def add_badge(self, frame, label=''):
+        self.badges.append(gray(frame))
+        self.badge_labels.append(label)
+
+    @classmethod
+    def from_dirs(cls, creatives_dir=None, badges_dir=None):
+        lib = cls()
+        for d, add in ((creatives_dir, lib.add_creative), (badges_dir, lib.add_badge)):
+            if d is not None:
+                for f in sorted(pathlib.Path(d).glob('*.png')):
+                    add(load_image(f), f.stem)
+        return lib
+
+    def save(self, path):
+        arrays = {f'badge_{i}': b for i, b in enumerate(self.badges)}
+        np.savez_compressed(path, creative_hashes=self.creative_hashes, creative_masks=self.creative_masks,
+                            creative_sizes=self.creative_sizes,
+                            creative_labels=np.array(self.creative_labels, dtype=str),
+                            badge_labels=np.array(self.badge_labels, dtype=str), **arrays)
+
+    @classmethod
+    def load(cls, path):
+        lib = cls()
+        with np.load(path) as data:
+            lib.creative_hashes = data['creative_hashes']
+            lib.creative_masks = data['creative_masks']
+            lib.creative_sizes = data['creative_sizes']
+            lib.creative_labels = list(data['creative_labels'])
+            lib.badge_labels = list(data['badge_labels'])
+            lib.badges = [data[f'badge_{i}'] for i in range(len(lib.badge_labels))]
+        return lib
+
+
+class AdDetector():
+    """Match a SignatureLibrary against frames.
+
+    Matching runs on the frame downscaled by `coarse`; badge candidates are then
+    confirmed at full resolution in a small neighbourhood only. Everything depending
+    only on the library and the frame size (scaled templates and their spectra,
+    size groups) is computed on the first frame of a given size and reused.
+    """
+
+    def __init__(self, library, scales=(0.67, 0.8, 1.0, 1.25), coarse=2, stride=8, max_mismatch=0.08,
+                 min_bits=40, badge_threshold=0.8, coarse_threshold=0.5, layout=True) -> None:
+        self.library = library
+        self.min_bits = min_bits
+        self.scales = scales
+        self.coarse = coarse
+        self.stride = stride
+        self.max_mismatch = max_mismatch
+        self.badge_threshold = badge_threshold
+        self.coarse_threshold = coarse_threshold
+        self.layout = layout
+        self._shape = None
+        self._badge_specs = []
+        self._creative_groups = []
+        # prepared state of recently seen frame sizes (crops come in a few sizes)
+        self._prepared = OrderedDict()
+        self.max_prepared = 16
+
+    def detect_raw(self, raw, width, height):
+        return self.detect(frame_from_raw(raw, width, height))
+
+    def detect(self, frame):
+        """Detections in a BGRA `frame` or crop, boxes in its pixels. Meant for changed-tile
+        crops (a few ms at 128x128), a whole 1080p frame takes a few hundred ms"""
+        g_full = gray(frame)
+        if g_full.shape != self._shape:
+            self._use_shape(g_full.shape)
+        g = downscale(g_full, self.coarse)
+        ii, ii2 = integral(g), integral(g * g)
+        detections = self._match_badges(g, ii, ii2, g_full)
+        detections += self._match_creatives(ii, ii2)
+        if self.layout and self.library.badges:
+            detections += self._match_layout(ii, ii2, [d for d in detections if d.kind == 'badge'])
+        return detections
+
+    @staticmethod
+    def is_ad(detections):
+        return any(d.kind in ('creative', 'badge') for d in detections)
+
+    def _use_shape(self, shape):
+        prepared = self._prepared.get(shape)
+        if prepared is None:
+            self._prepare(shape)
+            self._prepared[shape] = (self._badge_specs, self._creative_groups)
+            if len(self._prepared) > self.max_prepared:
+                self._prepared.popitem(last=False)
+        else:
+            self._prepared.move_to_end(shape)
+            self._shape = shape
+            self._badge_specs, self._creative_groups = prepared
+
+    def _prepare(self, shape):
+        self._shape = shape
+        c = self.coarse
+        H, W = shape[0] // c, shape[1] // c
+        # badge templates: full-size (zero-mean) for confirmation, coarse spectrum for the search
+        self._badge_specs = []
+        for template, label in zip(self.library.badges, self.library.badge_labels):
+            for s in self.scales:
+                h, w = round(template.shape[0] * s), round(template.shape[1] * s)
+                if h < 2 * c or w < 2 * c or h > shape[0] or w > shape[1]:
+                    continue
+                t_full = resize(template, h, w)
+                t_full = t_full - t_full.mean()
+                t = downscale(t_full, c)
+                t = t - t.mean()
+                norm, full_norm = np.sqrt((t * t).sum()), np.sqrt((t_full * t_full).sum())
+                if norm == 0:
+                    continue
+                spec = np.conj(np.fft.rfft2(t.astype(np.float32), s=(H, W)))
+                self._badge_specs.append((spec, t.shape[0], t.shape[1], norm, t_full, full_norm, label))
+        # creatives: grouped by displayed size (in coarse pixels)
+        groups = {}
+        for i, (w, h) in enumerate(self.library.creative_sizes):
+            for s in self.scales:
+                sw, sh = round(w * s / c), round(h * s / c)
+                if 8 <= sh <= H and 8 <= sw <= W:
+                    groups.setdefault((sh, sw), []).append(i)
+        self._creative_groups = [(h, w, np.array(ids)) for (h, w), ids in groups.items()]
+
+    def _match_badges(self, g, ii, ii2, g_full):
+        if not self._badge_specs:
+            return []
+        H, W = g.shape
+        c = self.coarse
+        spec = np.fft.rfft2(g.astype(np.float32))
+        detections = []
+        for t_spec, h, w, t_norm, t_full, full_norm, label in self._badge_specs:
+            num = np.fft.irfft2(spec * t_spec, s=(H, W))[:H - h + 1, :W - w + 1]
+            s1 = box_sums(ii, h, w)
+            var = box_sums(ii2, h, w) - s1 * s1 / (h * w)
+            # absolute value: dark-on-light and light-on-dark (video overlay) badges alike
+            ncc = np.abs(num) / (np.sqrt(np.maximum(var, 1e-6)) * t_norm)
+            # flat regions cannot hold text
+            ncc[var < 1e-3 * h * w * 255 * 255] = 0
+            for (x, y, _, _), _ in _peaks(ncc, self.coarse_threshold, h, w):
+                found = self._confirm(g_full, t_full, full_norm, x * c, y * c, c)
+                if found is not None:
+                    box, score = found
+                    detections.append(Detection('badge', box, score, label))
+        return _suppress(detections)
+
+    def _confirm(self, g_full, t, t_norm, x, y, radius):
+        """Full resolution ncc of template `t` around (x, y)"""
+        h, w = t.shape
+        y0, x0 = max(0, y - radius), max(0, x - radius)
+        patch = g_full[y0:y + h + radius, x0:x + w + radius]
+        if patch.shape[0] < h or patch.shape[1] < w:
+            return None
+        windows = np.lib.stride_tricks.sliding_window_view(patch, (h, w))
+        windows = windows - windows.mean(axis=(2, 3), keepdims=True)
+        num = np.abs(np.einsum('ijkl,kl->ij', windows, t))
+        ncc = num / (np.sqrt(np.einsum('ijkl,ijkl->ij', windows, windows)) * t_norm + 1e-6)
+        dy, dx = np.unravel_index(ncc.argmax(), ncc.shape)
+        if ncc[dy, dx] < self.badge_threshold:
+            return None
+        return (int(x0 + dx), int(y0 + dy), w, h), float(ncc[dy, dx])
+
+    def _match_creatives(self, ii, ii2):
+        if len(self.library.creative_hashes) == 0:
+            return []
+        c = self.coarse
+        step = max(1, self.stride // c)
+        detections = []
+        for h, w, ids in self._creative_groups:
+            hashes, masks = _window_dhash(ii, h, w, step)                    # (ny, nx)
+            # only bits significant in both window and signature are compared
+            common = masks[:, :, None] & self.library.creative_masks[ids][None, None, :]
+            n_common = np.bitwise_count(common)
+            mismatch = hamming(hashes[:, :, None], self.library.creative_hashes[ids][None, None, :], common) \
+                / np.maximum(n_common, 1)
+            mismatch[n_common < self.min_bits] = 1.0
+            best = mismatch.min(axis=2)
+            # the hash of a (nearly) flat window is noise
+            s1 = box_sums(ii, h, w, step)
+            best[box_sums(ii2, h, w, step) - s1 * s1 / (h * w) < 100 * h * w] = 1.0
+            for y, x in np.argwhere(best <= self.max_mismatch):
+                k = ids[mismatch[y, x].argmin()]
+                detections.append(Detection('creative', (int(x * step * c), int(y * step * c), w * c, h * c),
+                                            1.0 - float(best[y, x]), self.library.creative_labels[k]))
+        return _suppress(detections)
+
+    def _match_layout(self, ii, ii2, badges, margin=6):
+        """IAB sized blocks with busy content and a uniform ring around, kept when
+        a badge lies within or just around (localizes the ad unit of a badge)"""
+        if not badges:
+            return []
+        c = self.coarse
+        m = max(1, margin // c)
+        step = max(1, 2 * self.stride // c)
+        H, W = ii.shape[0] - 1, ii.shape[1] - 1
+        detections = []
+        for iw, ih in IAB_SIZES:
+            for s in self.scales:
+                w, h = round(iw * s / c), round(ih * s / c)
+                if h + 2 * m > H or w + 2 * m > W:
+                    continue
+                ny, nx = (H - h - 2 * m) // step + 1, (W - w - 2 * m) // step + 1
+                n_in, n_out = h * w, (h + 2 * m) * (w + 2 * m) - h * w
+                s_in, q_in = (box_sums(a, h, w, step, m, m, ny, nx) for a in (ii, ii2))
+                s_all, q_all = (box_sums(a, h + 2 * m, w + 2 * m, step, 0, 0, ny, nx) for a in (ii, ii2))
+                var_in = q_in / n_in - (s_in / n_in) ** 2
+                var_out = (q_all - q_in) / n_out - ((s_all - s_in) / n_out) ** 2
+                for y, x in np.argwhere((var_in > 400) & (var_out < 25)):
+                    box = (int((x * step + m) * c), int((y * step + m) * c), w * c, h * c)
+                    around = (box[0] - 4 * margin, box[1] - 4 * margin, box[2] + 8 * margin, box[3] + 8 * margin)
+                    if any(_contains(around, b.box) for b in badges):
+                        detections.append(Detection('layout', box, 0.5, f'{iw}x{ih}'))
+        return _suppress(detections)
+
+
+def _peaks(score_map, threshold, h, w, max_peaks=100):
+    """Local maxima above threshold, greedily separated by the template size"""
+    flat = score_map.ravel()
+    candidates = np.flatnonzero(flat > threshold)
+    if len(candidates) > 20 * max_peaks:
+        candidates = candidates[np.argpartition(flat[candidates], -20 * max_peaks)[-20 * max_peaks:]]
+    candidates = candidates[np.argsort(flat[candidates])[::-1]]
+    # area around the peaks taken so far: a lookup per candidate, not a scan of the peaks
+    taken = np.zeros(score_map.shape, dtype=bool)
+    peaks = []
+    for c in candidates:
+        y, x = divmod(int(c), score_map.shape[1])
+        if not taken[y, x]:
+            peaks.append(((x, y, w, h), float(flat[c])))
+            if len(peaks) == max_peaks:
+                break
+            taken[max(0, y - h + 1):y + h, max(0, x - w + 1):x + w] = True
+    return peaks
+
+
+def _overlap(a, b):
+    ax, ay, aw, ah = a
+    bx, by, bw, bh = b
+    ix = max(0, min(ax + aw, bx + bw) - max(ax, bx))
+    iy = max(0, min(ay + ah, by + bh) - max(ay, by))
+    return ix * iy / min(aw * ah, bw * bh)
+
+
+def _contains(outer, inner):
+    return _overlap(outer, inner) > 0.9
+
+
+def _suppress(detections, max_overlap=0.5):
+    kept = []
+    for d in sorted(detections, key=lambda d: d.score, reverse=True):
+        if all(_overlap(d.box, k.box) <= max_overlap for k in kept):
+            kept.append(d)
+    return kept
+
+
+if __name__ == '__main__':
+    # offline runs:
+    #   python -m adscape.detect build library.npz creatives_dir badges_dir
+    #   python -m adscape.detect run library.npz ss/*.png
+    import sys
+    import time
+    if sys.argv[1] == 'build':
+        SignatureLibrary.from_dirs(sys.argv[3], sys.argv[4]).save(sys.argv[2])
+    else:
+        detector = AdDetector(SignatureLibrary.load(sys.argv[2]))
+        for path in sys.argv[3:]:
+            frame = load_image(path)
+            start = time.perf_counter()
+            found = detector.detect(frame)
+            print(f'{path}: ad={AdDetector.is_ad(found)} in {1000 * (time.perf_counter() - start):.1f}ms')
+            for d in found:
+                print('   ', d)
@@ -0,0 +1,58 @@
+import pytest
+from adscape.detect import *
+import pathlib
+
+screenshot = pathlib.Path(__file__).parent.parent / 'ss' / 'Screenshot - withads(sponsored).png'
+
+
+@pytest.fixture(scope='module')
+def frame():
+    return load_image(screenshot)
+
+
+@pytest.fixture(scope='module')
+def library(frame):
+    lib = SignatureLibrary()
+    lib.add_badge(frame[231:242, 1514:1557], 'sponsored')
+    lib.add_creative(frame[296:412, 1472:1588], 'cisco')
+    return lib
+
+
+def test_gray_downscale(frame):
+    f = frame[:101, :203].astype(np.float32)
+    assert np.allclose(gray(frame[:101, :203]), f[..., 2] * 0.299 + f[..., 1] * 0.587 + f[..., 0] * 0.114, atol=1e-3)
+    g = gray(frame[:101, :203])
+    for factor in (2, 3):
+        h, w = 101 // factor, 203 // factor
+        expected = g[:h * factor, :w * factor].reshape(h, factor, w, factor).mean(axis=(1, 3))
+        assert np.allclose(downscale(g, factor), expected, atol=1e-3)
+
+
+def test_dhash(frame):
+    g = gray(frame[296:412, 1472:1588])
+    bits, mask = dhash(g)
+    assert dhash(g) == (bits, mask)
+    assert hamming(bits, dhash(g[:, ::-1])[0], mask) > 8
+
+
+def test_AdDetector(frame, library):
+    detector = AdDetector(library)
+    found = detector.detect(frame)
+    assert AdDetector.is_ad(found)
+    badges = {d.box[:2] for d in found if d.kind == 'badge'}
+    assert {(1514, 231), (1591, 365)} <= badges
+    creatives = [d for d in found if d.kind == 'creative']
+    assert [d.label for d in creatives] == ['cisco']
+    assert abs(creatives[0].box[0] - 1472) <= 8 and abs(creatives[0].box[1] - 296) <= 8
+
+    # raw mss-like BGRA buffer, blank screen
+    blank = bytes(1920 * 1080 * 4)
+    assert not AdDetector.is_ad(detector.detect_raw(blank, 1920, 1080))
+
+
+def test_SignatureLibrary(library, tmp_path):
+    library.save(tmp_path / 'signatures.npz')
+    lib = SignatureLibrary.load(tmp_path / 'signatures.npz')
+    assert lib.badge_labels == ['sponsored'] and lib.creative_labels == ['cisco']
+    assert (lib.creative_hashes == library.creative_hashes).all()
+    assert (lib.badges[0] == library.badges[0]).all()
@@ -0,0 +1,510 @@
+import json
+import time
+import queue
+import sqlite3
+import hashlib
+import pathlib
+import threading
+from collections import deque
+import requests
+from requests.adapters import HTTPAdapter
+
+from .trace import tracer
+
+
+class LLMCancelled(Exception):
+    pass
+
+
+class LLMBusy(Exception):
+    """Too many requests in flight"""
+    pass
+
+
+class TokenBuffer():
+    """Tokens received by the streaming thread, drained by the UI at its own (throttled) pace"""
+
+    def __init__(self) -> None:
+        self._tokens: list[str] = []
+        self._lock = threading.Lock()
+
+    def append(self, token):
+        with self._lock:
+            self._tokens.append(token)
+
+    def drain(self):
+        with self._lock:
+            tokens, self._tokens = self._tokens, []
+        return ''.join(tokens)
+
+
+def stream_generate(url, payload, on_token=None, http=None, timeout=None, cancelled=None):
+    """POST `payload` to an Ollama endpoint in streaming mode and consume its NDJSON chunks
+    as they arrive, calling `on_token` for each token.
+
+    Return the full text and the metrics of the call (time to first token, total time
+    and Ollama's own eval counters when sent in the final chunk)
+    """
+    http = http or requests
+    start = time.perf_counter()
+    ttft = None
+    parts = []
+    final = {}
+    with http.post(url, json={**payload, "stream": True}, stream=True, timeout=timeout) as response:
+        response.raise_for_status()
+        for line in response.iter_lines():
+            if cancelled is not None and cancelled.is_set():
+                raise LLMCancelled()
+            if not line:
+                continue
+            chunk = json.loads(line)
+            if "error" in chunk:
+                raise RuntimeError(chunk["error"])
+            # /api/generate sends 'response', /api/chat a 'message'
+            token = chunk.get("response") or chunk.get("message", {}).get("content", "")
+            if token:
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+                parts.append(token)
+                if on_token:
+                    on_token(token)
+            if chunk.get("done"):
+                final = chunk
+                break
+    return ''.join(parts), _metrics(final, start, ttft)
+
+
+def _metrics(final, start, ttft=None):
+    return {
+        "ttft": ttft,
+        "total": time.perf_counter() - start,
+        "eval_count": final.get("eval_count"),
+        "prompt_eval_count": final.get("prompt_eval_count"),
+        "prompt_eval_duration": final.get("prompt_eval_duration"),
+        "eval_duration": final.get("eval_duration"),
+        # /api/generate only: encoded conversation, to pass back as "context" to continue it
+        "context": final.get("context"),
+    }
+
+
+def estimate_tokens(text):
+    # ~4 characters per token for English text with the usual BPE vocabularies
+    return len(text) // 4 + 4
+
+
+class ChatHistory():
+    """Messages of a conversation as sent to /api/chat, within a token budget.
+
+    Ollama keeps the KV state of the last prompt while the model stays loaded
+    (`keep_alive`) and only evaluates what follows the common prefix. So the sent
+    history must only grow at its end: when over `max_tokens`, the oldest messages
+    are dropped down to `trim_to` of the budget at once, not one per turn (which
+    would change the prefix, hence re-evaluate everything, on every turn).
+    """
+
+    def __init__(self, system=None, max_tokens=4096, trim_to=0.5, messages=()) -> None:
+        self.system = system
+        self.max_tokens = max_tokens
+        self.trim_to = trim_to
+        self._messages: list[dict] = []
+        self._tokens: list[int] = []
+        self._start = 0
+        self._kept_tokens = 0
+        for message in messages:
+            self.append(message["role"], message["content"])
+
+    def __len__(self):
+        return len(self._messages)
+
+    def append(self, role, content):
+        self._messages.append({"role": role, "content": content})
+        self._tokens.append(estimate_tokens(content))
+        self._kept_tokens += self._tokens[-1]
+        budget = self.max_tokens - (estimate_tokens(self.system) if self.system else 0)
+        if self._kept_tokens > budget:
+            # the last message is always kept
+            while self._start < len(self._messages) - 1 and self._kept_tokens > self.trim_to * budget:
+                self._kept_tokens -= self._tokens[self._start]
+                self._start += 1
+
+    def messages(self):
+        """The messages to send: system prompt and the kept window of the conversation"""
+        system = [{"role": "system", "content": self.system}] if self.system else []
+        return system + self._messages[self._start:]
+
+    def payload(self, model, keep_alive="30m", **extra):
+        return {"model": model, "messages": self.messages(), "keep_alive": keep_alive, **extra}
+
+
+class PromptCache():
+    """On-disk cache (SQLite) of deterministic generations, keyed by endpoint, model
+    digest and the request itself (prompt or messages, options..).
+
+    Least recently used entries are evicted beyond `max_bytes`, entries expire after
+    `ttl` seconds. Used from the client worker threads.
+    """
+
+    def __init__(self, cache_file, max_bytes=64*1024*1024, ttl=30*24*3600) -> None:
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = self.misses = self.skipped = self.evictions = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(cache_file, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, text TEXT, metrics TEXT, '
+                             'size INTEGER, created REAL, used REAL)')
+            self._db.execute('CREATE INDEX IF NOT EXISTS entries_used ON entries (used)')
+        self.nbytes = self._db.execute('SELECT coalesce(sum(size), 0) FROM entries').fetchone()[0]
+
+    @staticmethod
+    def deterministic(payload):
+        """Greedy or seeded sampling: the same request gives the same reply"""
+        options = payload.get("options") or {}
+        return options.get("temperature") == 0 or "seed" in options
+
+    @staticmethod
+    def key(path, payload, digest):
+        request = {k: v for k, v in payload.items() if k not in ("stream", "keep_alive")}
+        return hashlib.sha256(json.dumps([path, digest, request], sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        """(text, metrics) of a live entry, or None"""
+        now = time.time()
+        with self._lock:
+            row = self._db.execute('SELECT text, metrics, size, created FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is not None and row[3] + self.ttl < now:
+                with self._db:
+                    self._db.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self.nbytes -= row[2]
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            with self._db:
+                self._db.execute('UPDATE entries SET used = ? WHERE key = ?', (now, key))
+            self.hits += 1
+            return row[0], json.loads(row[1])
+
+    def put(self, key, text, metrics):
+        metrics = json.dumps(metrics)
+        size = len(text) + len(metrics)
+        now = time.time()
+        with self._lock, self._db:
+            old = self._db.execute('SELECT size FROM entries WHERE key = ?', (key,)).fetchone()
+            self._db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?)', (key, text, metrics, size, now, now))
+            self.nbytes += size - (old[0] if old else 0)
+            while self.nbytes > self.max_bytes:
+                evicted = self._db.execute('SELECT key, size FROM entries WHERE key != ? ORDER BY used LIMIT 32',
+                                           (key,)).fetchall()
+                if not evicted:
+                    break
+                for evicted_key, evicted_size in evicted:
+                    if self.nbytes <= self.max_bytes:
+                        break
+                    self._db.execute('DELETE FROM entries WHERE key = ?', (evicted_key,))
+                    self.nbytes -= evicted_size
+                    self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            count = self._db.execute('SELECT count(*) FROM entries').fetchone()[0]
+            return {"hits": self.hits, "misses": self.misses, "skipped": self.skipped, "evictions": self.evictions,
+                    "entries": count, "bytes": self.nbytes}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+class ModelCatalog():
+    """Models known to the server (the /api/tags reply), cached for `ttl` seconds.
+
+    `models(on_done)` answers right away from the cache (even stale, e.g. from the
+    `cache_file` of a previous run) and again once a background refresh of a stale
+    catalog completes.
+    """
+
+    def __init__(self, client, ttl=300, cache_file=None) -> None:
+        self.client = client
+        self.ttl = ttl
+        self.cache_file = pathlib.Path(cache_file) if cache_file else None
+        self.tags = None
+        self.fetched_at = None
+        self._refreshing = False
+        self._lock = threading.Lock()   # updated from worker threads too (see LLMClient._model_digest)
+        if self.cache_file and self.cache_file.exists():
+            try:
+                self.tags = json.loads(self.cache_file.read_text(encoding='utf-8'))
+            except ValueError:
+                pass
+
+    def fresh(self):
+        return self.fetched_at is not None and time.monotonic() - self.fetched_at < self.ttl
+
+    def update(self, tags):
+        with self._lock:
+            self.tags = tags
+            self.fetched_at = time.monotonic()
+            if self.cache_file:
+                self.cache_file.write_text(json.dumps(tags), encoding='utf-8')
+
+    def refresh(self, on_done=None, on_error=None):
+        """Reload the catalog in the background (once at a time)"""
+        if self._refreshing:
+            return
+        self._refreshing = True
+
+        def done(tags):
+            self._refreshing = False
+            self.update(tags)
+            if on_done:
+                on_done(tags)
+
+        def failed(e):
+            self._refreshing = False
+            if on_error:
+                on_error(e)
+
+        try:
+            self.client.tags(on_done=done, on_error=failed)
+        except LLMBusy as e:
+            failed(e)
+
+    def models(self, on_done, on_error=None):
+        if self.tags is not None:
+            on_done(self.tags)
+        if not self.fresh():
+            self.refresh(on_done, on_error)
+
+    def names(self):
+        return [m["name"] for m in (self.tags or {}).get("models", [])]
+
+    def digest(self, model):
+        digests = {m["name"]: m.get("digest") for m in (self.tags or {}).get("models", [])}
+        return digests.get(model) or digests.get(f"{model}:latest")
+
+
+class LLMRequest():
+
+    def __init__(self, method, path, payload, on_done, on_error, on_token, timeout, cache=None) -> None:
+        self.method = method
+        self.path = path
+        self.payload = payload
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_token = on_token
+        self.timeout = timeout
+        self.cache = cache
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        """Stop a streamed reply at its next chunk, or a queued request before it is sent. A
+        non-streamed request cannot be interrupted in flight: its reply is discarded when it
+        arrives (or at the read timeout), the worker is busy until then"""
+        self.cancelled.set()
+
+
+class FanOut():
+    """One prompt to several models, at most `max_in_flight` requests at once (what the
+    Ollama host serves in parallel, see OLLAMA_NUM_PARALLEL), the others waiting their turn.
+
+    `payload_of(model)` gives the request of each model. `on_reply(model, text, metrics)`
+    or `on_error(model, e)` come as each model completes (metrics gain `queued`, the seconds
+    waited for a slot), `on_done(results)` once all did, results (the (text, metrics)
+    or the exception) by model in the order of `models`.
+    """
+
+    def __init__(self, client, models, payload_of, path="/api/chat", max_in_flight=2, on_reply=None, on_error=None,
+                 on_token=None, on_done=None, cache=None) -> None:
+        self.client = client
+        self.models = list(models)
+        self.payload_of = payload_of
+        self.path = path
+        self.max_in_flight = max(1, max_in_flight)
+        self.on_reply = on_reply
+        self.on_error = on_error
+        self.on_token = on_token
+        self.on_done = on_done
+        self.cache = cache
+        self.results: dict[str, object] = {}
+        self.requests: dict[str, LLMRequest] = {}
+        self._waiting = deque(self.models)
+        self._in_flight = 0
+        self._cancelled = False
+        self._lock = threading.Lock()
+        self._start = time.perf_counter()
+        for _ in range(self.max_in_flight):
+            self._next()
+
+    def cancel(self):
+        with self._lock:
+            self._cancelled = True
+            waiting, self._waiting = list(self._waiting), deque()
+            requests = list(self.requests.values())
+        for request in requests:
+            request.cancel()
+        for model in waiting:
+            self._completed(model, LLMCancelled(), False)
+
+    def _next(self):
+        with self._lock:
+            if self._cancelled or not self._waiting or self._in_flight >= self.max_in_flight:
+                return
+            model = self._waiting.popleft()
+            self._in_flight += 1
+        queued = time.perf_counter() - self._start
+        on_token = (lambda token: self.on_token(model, token)) if self.on_token else None
+        try:
+            self.requests[model] = self.client.generate(
+                self.payload_of(model), lambda result: self._completed(model, (result[0], {**result[1], "queued": queued})),
+                lambda e: self._completed(model, e), on_token, self.path, self.cache)
+        except LLMBusy as e:
+            self._completed(model, e)
+
+    def _completed(self, model, result, in_flight=True):
+        with self._lock:
+            self.results[model] = result
+            if in_flight:
+                self._in_flight -= 1
+            all_done = len(self.results) == len(self.models)
+        # next one first: the host is kept busy while the reply is handled
+        self._next()
+        if isinstance(result, Exception):
+            if self.on_error:
+                self.on_error(model, result)
+        elif self.on_reply:
+            self.on_reply(model, *result)
+        if all_done and self.on_done:
+            self.on_done({m: self.results[m] for m in self.models})
+
+
+class LLMClient():
+    """Ollama client running requests on worker threads, over pooled keep-alive connections.
+
+    At most `max_pending` requests are queued or running (`LLMBusy` is raised beyond).
+    Callbacks are handed to `dispatch(fn, *args)`, e.g. to run them on the Kivy main thread.
+    With a PromptCache, deterministic generations (see `PromptCache.deterministic`) are
+    answered from the cache when possible. `on_error` gets LLMCancelled for a cancelled
+    request, see `LLMRequest.cancel`; stream (give `on_token`) what the user may stop.
+    """
+
+    def __init__(self, base_url, workers=2, max_pending=8, timeout=(3.05, 300), dispatch=None, cache=None,
+                 catalog_ttl=300, catalog_file=None) -> None:
+        self.base_url = base_url
+        self.timeout = timeout
+        self.dispatch = dispatch or (lambda fn, *args: fn(*args))
+        self.cache = cache
+        self.catalog = ModelCatalog(self, catalog_ttl, catalog_file)
+        self.http = requests.Session()
+        self.http.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self.http.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._queue: queue.Queue[LLMRequest] = queue.Queue()
+        self._workers = [threading.Thread(target=self._work, daemon=True) for _ in range(workers)]
+        for w in self._workers:
+            w.start()
+
+    def submit(self, method, path, payload=None, on_done=None, on_error=None, on_token=None, timeout=None, cache=None):
+        if not self._slots.acquire(blocking=False):
+            raise LLMBusy(f'{method} {path}')
+        request = LLMRequest(method, path, payload, on_done, on_error, on_token, timeout or self.timeout, cache)
+        self._queue.put(request)
+        return request
+
+    def generate(self, payload, on_done=None, on_error=None, on_token=None, path="/api/generate", cache=None):
+        """Generation streamed when `on_token` is given, `on_done` gets (text, metrics) in both cases.
+
+        `cache`: None caches deterministic requests only, False never, True always.
+        """
+        return self.submit("POST", path, payload, on_done, on_error, on_token, cache=cache)
+
+    def chat(self, history, model, on_done=None, on_error=None, on_token=None, keep_alive="30m", cache=None, **extra):
+        """Next reply in a ChatHistory (the caller appends it once done)"""
+        return self.generate(history.payload(model, keep_alive, **extra), on_done, on_error, on_token, "/api/chat",
+                             cache)
+
+    def fan_out(self, models, payload_of, path="/api/chat", max_in_flight=2, on_reply=None, on_error=None,
+                on_token=None, on_done=None, cache=None):
+        """Same prompt to several models concurrently, see FanOut (the client needs as
+        many `workers` as requests in flight)"""
+        return FanOut(self, models, payload_of, path, min(max_in_flight, len(self._workers)), on_reply, on_error,
+                      on_token, on_done, cache)
+
+    def tags(self, on_done=None, on_error=None):
+        return self.submit("GET", "/api/tags", None, on_done, on_error, timeout=self.timeout[0])
+
+    def warm_up(self, model, keep_alive="30m", on_done=None, on_error=None):
+        """Load `model` ahead of the first prompt (a request without prompt only loads it)"""
+        return self.generate({"model": model, "keep_alive": keep_alive}, on_done, on_error, cache=False)
+
+    def close(self, timeout=5.0):
+        """Stop the workers once the queued requests are done, waiting up to `timeout`
+        seconds for them before the connection pool is closed"""
+        for _ in self._workers:
+            self._queue.put(None)
+        deadline = time.monotonic() + timeout
+        for w in self._workers:
+            if w is not threading.current_thread():
+                w.join(max(0.0, deadline - time.monotonic()))
+        self.http.close()
+
+    def _work(self):
+        while (request := self._queue.get()) is not None:
+            try:
+                if request.cancelled.is_set():
+                    raise LLMCancelled()
+                # round-trip (or cache lookup) only, callbacks are timed by the app
+                with tracer.span('llm.http', path=request.path):
+                    result = self._run(request)
+                if request.cancelled.is_set():
+                    raise LLMCancelled()
+            except Exception as e:
+                if request.on_error:
+                    self.dispatch(request.on_error, e)
+            else:
+                if request.on_done:
+                    self.dispatch(request.on_done, result)
+            finally:
+                self._slots.release()
+
+    def _run(self, request):
+        url = self.base_url + request.path
+        if request.method == "GET":
+            response = self.http.get(url, timeout=request.timeout)
+            response.raise_for_status()
+            return response.json()
+        if self.cache is None or request.cache is False:
+            return self._generate(request)
+        if not (request.cache or self.cache.deterministic(request.payload)):
+            self.cache.skipped += 1
+            return self._generate(request)
+        digest = self._model_digest(request.payload.get("model"))
+        key = self.cache.key(request.path, request.payload, digest)
+        cached = self.cache.get(key)
+        if cached is not None:
+            text, metrics = cached
+            if request.on_token:
+                request.on_token(text)
+            return text, {**metrics, "ttft": 0.0, "total": 0.0, "cached": True}
+        text, metrics = self._generate(request)
+        self.cache.put(key, text, metrics)
+        return text, metrics
+
+    def _generate(self, request):
+        url = self.base_url + request.path
+        if request.on_token:
+            return stream_generate(url, request.payload, request.on_token, self.http, request.timeout, request.cancelled)
+        start = time.perf_counter()
+        response = self.http.post(url, json={**request.payload, "stream": False}, timeout=request.timeout)
+        response.raise_for_status()
+        final = response.json()
+        text = final.get("response") or final.get("message", {}).get("content", "")
+        return text, _metrics(final, start)
+
+    def _model_digest(self, model):
+        # digests are part of the cache keys: a pulled model update misses
+        if not self.catalog.fresh():
+            response = self.http.get(self.base_url + "/api/tags", timeout=self.timeout[0])
+            response.raise_for_status()
+            self.catalog.update(response.json())
+        return self.catalog.digest(model)
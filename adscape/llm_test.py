@@ -0,0 +1,233 @@
+import pytest
+from adscape.llm import *
+
+
+def test_ChatHistory():
+    history = ChatHistory(system='be brief', max_tokens=100, trim_to=0.5)
+    for i in range(4):
+        history.append('user', 'x' * 60)      # 19 tokens
+    sent = history.messages()
+    assert len(sent) == 5 and sent[0]['role'] == 'system'
+
+    # over budget: trimmed to half of it at once, then the prefix is stable for a while
+    history.append('assistant', 'y' * 60)
+    first = history.messages()
+    assert len(first) == 3 and first[-1]['content'] == 'y' * 60
+    history.append('user', 'z' * 60)
+    assert history.messages()[:3] == first
+
+    # the last message is kept even alone over budget
+    history.append('user', 'w' * 1000)
+    assert history.messages()[1:] == [{'role': 'user', 'content': 'w' * 1000}]
+
+    payload = history.payload('llama3', keep_alive='1h', options={'num_ctx': 2048})
+    assert payload['keep_alive'] == '1h' and payload['messages'][0]['content'] == 'be brief'
+
+
+def test_PromptCache(tmp_path):
+    cache = PromptCache(tmp_path / 'cache.db', max_bytes=200, ttl=60)
+    assert PromptCache.deterministic({'options': {'seed': 1}})
+    assert not PromptCache.deterministic({'options': {'temperature': 0.7}})
+
+    payload = {'model': 'llama3', 'prompt': 'hi', 'options': {'seed': 1}}
+    key = PromptCache.key('/api/generate', payload, 'sha256:1')
+    # stream and keep_alive are not part of the request, the model digest is
+    assert key == PromptCache.key('/api/generate', {**payload, 'stream': True, 'keep_alive': '1h'}, 'sha256:1')
+    assert key != PromptCache.key('/api/generate', payload, 'sha256:2')
+
+    assert cache.get(key) is None
+    cache.put(key, 'hello', {'eval_count': 2})
+    assert cache.get(key) == ('hello', {'eval_count': 2})
+
+    # least recently used evicted beyond max_bytes
+    cache.put('k2', 'x' * 100, {})
+    cache.get(key)
+    cache.put('k3', 'y' * 100, {})
+    assert cache.get('k2') is None and cache.get(key) is not None
+    stats = cache.stats()
+    assert stats['evictions'] == 1 and stats['hits'] == 3 and stats['bytes'] <= 200
+    cache.close()
+
+    # persistent, entries expire
+    cache = PromptCache(tmp_path / 'cache.db', ttl=-1)
+    assert cache.get(key) is None and cache.stats()['entries'] == 1
+
+
+class FakeClient():
+    def __init__(self):
+        self.calls = 0
+
+    def tags(self, on_done=None, on_error=None):
+        self.calls += 1
+        on_done({'models': [{'name': 'llama3:latest', 'digest': 'abc'}]})
+
+
+def test_ModelCatalog(tmp_path):
+    client = FakeClient()
+    catalog = ModelCatalog(client, ttl=60, cache_file=tmp_path / 'models.json')
+    seen = []
+    catalog.models(seen.append)
+    assert client.calls == 1 and len(seen) == 1
+    assert catalog.names() == ['llama3:latest'] and catalog.digest('llama3') == 'abc'
+    # fresh: answered from the cache only
+    catalog.models(seen.append)
+    assert client.calls == 1 and len(seen) == 2
+
+    # next run: the saved catalog is shown right away, then refreshed
+    catalog = ModelCatalog(client, ttl=60, cache_file=tmp_path / 'models.json')
+    assert not catalog.fresh() and catalog.names() == ['llama3:latest']
+    catalog.models(seen.append)
+    assert client.calls == 2 and len(seen) == 4
+
+
+def test_LLMClient(tmp_path):
+    from adscape.ollama_stub import OllamaStub
+    from adscape.bench import _wait
+
+    with OllamaStub(latency=0.01, token_seconds=0.001, reply_tokens=16, load_seconds=0.01) as stub:
+        client = LLMClient(stub.url, cache=PromptCache(tmp_path / 'cache.db'))
+        try:
+            text, metrics = _wait(client.warm_up, 'llama3')
+            assert text == '' and stub.loaded == {'llama3'}
+
+            tokens = []
+            payload = {'model': 'llama3', 'prompt': 'window size', 'options': {'seed': 0}}
+            text, metrics = _wait(client.generate, payload, on_token=tokens.append)
+            assert ''.join(tokens) == text and metrics['eval_count'] == 16 and metrics['ttft'] > 0
+            # seeded: the same reply, from the cache
+            assert _wait(client.generate, payload) == (text, {**metrics, 'ttft': 0.0, 'total': 0.0, 'cached': True})
+            assert stub.requests['/api/generate'] == 2
+
+            history = ChatHistory('be brief')
+            history.append('user', 'hello')
+            text, metrics = _wait(client.chat, history, 'llama3')
+            assert len(text.split()) == 16 and metrics['prompt_eval_count'] > 0
+
+            with pytest.raises(requests.HTTPError):
+                _wait(client.generate, {'model': 'gpt', 'prompt': 'x'})
+        finally:
+            client.close()
+            client.cache.close()
+
+
+def test_FanOut():
+    from adscape.ollama_stub import OllamaStub
+    from adscape.bench import _wait
+
+    models = ['llama3', 'mistral', 'phi3']
+    with OllamaStub(latency=0.05, token_seconds=0.001, reply_tokens=8, load_seconds=0,
+                    models=[f'{m}:latest' for m in models + ['gemma']]) as stub:
+        client = LLMClient(stub.url, workers=2)
+        try:
+            replies, errors = [], []
+            history = ChatHistory('be brief')
+            history.append('user', 'hello')
+            results = _wait(lambda on_done, on_error: client.fan_out(
+                models + ['gpt'], lambda model: history.payload(model), max_in_flight=2,
+                on_reply=lambda model, text, metrics: replies.append((model, metrics)),
+                on_error=lambda model, e: errors.append(model), on_done=on_done))
+            assert list(results) == models + ['gpt']
+            assert sorted(m for m, _ in replies) == sorted(models) and errors == ['gpt']
+            assert stub.max_in_flight == 2
+            # the 3rd model waited for a slot
+            queued = {m: metrics['queued'] for m, metrics in replies}
+            assert queued['phi3'] > 0.04 > queued['llama3']
+            assert isinstance(results['gpt'], requests.HTTPError)
+
+            # cancelled: waiting models are not sent
+            done = []
+            fan_out = client.fan_out(models, lambda model: history.payload(model), max_in_flight=1, on_done=done.append)
+            fan_out.cancel()
+            while not done:
+                time.sleep(0.01)
+            assert all(isinstance(r, LLMCancelled) for m, r in done[0].items() if m != 'llama3')
+            assert stub.requests['/api/chat'] <= 5
+        finally:
+            client.close()
+
+
+def test_stream_generate():
+    from adscape.ollama_stub import OllamaStub
+
+    with OllamaStub(latency=0.01, token_seconds=0.01, reply_tokens=50, load_seconds=0) as stub:
+        url = stub.url + '/api/generate'
+        buffer = TokenBuffer()
+        text, metrics = stream_generate(url, {'model': 'llama3', 'prompt': 'hi'}, buffer.append)
+        assert buffer.drain() == text and buffer.drain() == ''
+        assert metrics['eval_count'] == 50 and 0 < metrics['ttft'] < metrics['total']
+
+        # cancelled mid-stream: stops reading at the next chunk
+        cancelled = threading.Event()
+        tokens = []
+
+        def on_token(token):
+            tokens.append(token)
+            if len(tokens) == 3:
+                cancelled.set()
+        with pytest.raises(LLMCancelled):
+            stream_generate(url, {'model': 'llama3', 'prompt': 'hi'}, on_token, cancelled=cancelled)
+        assert len(tokens) == 3
+
+        # no answer within the read timeout
+        stub.latency = 0.5
+        with pytest.raises(requests.Timeout):
+            stream_generate(url, {'model': 'llama3', 'prompt': 'hi'}, timeout=(1, 0.1))
+
+        with pytest.raises(requests.HTTPError):
+            stream_generate(url, {'model': 'gpt', 'prompt': 'hi'})
+
+
+def test_LLMClient_cancel():
+    from adscape.ollama_stub import OllamaStub
+
+    def request(call, *args, **kwargs):
+        outcome, done = {}, threading.Event()
+        outcome['request'] = call(*args, on_done=lambda result: (outcome.update(result=result), done.set()),
+                                  on_error=lambda e: (outcome.update(error=e), done.set()), **kwargs)
+        outcome['wait'] = lambda: done.wait(10) and outcome
+        return outcome
+
+    with OllamaStub(latency=0.3, token_seconds=0.01, reply_tokens=50, load_seconds=0) as stub:
+        client = LLMClient(stub.url, workers=1, max_pending=2)
+        try:
+            payload = {'model': 'llama3', 'prompt': 'hi'}
+            # streamed: stops mid-reply
+            streamed = request(client.generate, payload,
+                               on_token=lambda token: streamed['request'].cancel())
+            # queued behind it, cancelled before it is sent
+            queued = request(client.generate, payload)
+            with pytest.raises(LLMBusy):
+                client.generate(payload)
+            queued['request'].cancel()
+            assert isinstance(streamed['wait']()['error'], LLMCancelled)
+            assert isinstance(queued['wait']()['error'], LLMCancelled)
+            assert stub.requests['/api/generate'] == 1
+
+            # not streamed: the reply is awaited, then discarded
+            start = time.perf_counter()
+            plain = request(client.generate, payload)
+            while stub.requests['/api/generate'] < 2:
+                time.sleep(0.01)
+            plain['request'].cancel()
+            assert isinstance(plain['wait']()['error'], LLMCancelled) and time.perf_counter() - start > 0.3
+        finally:
+            client.close()
+
+        client = LLMClient(stub.url, workers=1, timeout=(1, 0.1))
+        try:
+            assert isinstance(request(client.generate, payload)['wait']()['error'], requests.Timeout)
+        finally:
+            client.close()
+
+
+def test_LLMClient_close():
+    from adscape.ollama_stub import OllamaStub
+
+    with OllamaStub(latency=0.2, load_seconds=0) as stub:
+        client = LLMClient(stub.url, workers=1)
+        results = []
+        client.generate({'model': 'llama3', 'prompt': 'hi'}, on_done=results.append, on_error=results.append)
+        # the request in flight is done before the connection pool is closed
+        client.close()
+        assert len(results) == 1 and not isinstance(results[0], Exception)
+        assert not any(w.is_alive() for w in client._workers)
@@ -1,29 +1,498 @@
 
-import zipfile
 import pathlib
-import dataclasses
 from datetime import datetime
 import os
 import json
+import struct
+import bisect
+import re
+import zlib
+import threading
+import time
+from collections import OrderedDict
 
-@dataclasses.dataclass
-class Session():
-    name: str = f'session_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json' 
-    meta: dict = None
-    questions: list[str] = None
-    answers: list[str] = None
+from .session import Session
+
+
+class SessionJournal():
+    """Append-only JSONL journal of a live session, next to its snapshot file
+    (session_x.json -> session_x.jsonl).
+
+    First line is the session header (dict), every other line a `[key, item]`
+    record meaning `session[key].append(item)`. Replay starts from the existing
+    snapshot if any, else from the header. Closing folds the journal into a
+    compact snapshot and removes it.
+
+    A live journal is marked by an OS lock on its lock file (session_x.jsonl.lock),
+    held until it is folded: the lock is seen by other processes (several apps on the
+    same folder) and dropped by the OS when the process dies, so `recover` folds the
+    journals of crashed apps only.
+    """
+
+    SUFFIX = '.jsonl'
+    LOCK_SUFFIX = '.lock'
+
+    def __init__(self, snapshot_file, header=None, fsync_every=8, fsync_interval=2.0) -> None:
+        self.snapshot_file = pathlib.Path(snapshot_file)
+        self.journal_file = self.snapshot_file.with_suffix(self.SUFFIX)
+        self.fsync_every = fsync_every
+        self.fsync_interval = fsync_interval
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+        self._lock_f = self._lock(self.journal_file)
+        if self._lock_f is None:
+            raise RuntimeError(f'Session journal in use by another process: {self.journal_file}')
+        is_new = not self.journal_file.exists()
+        self._f = open(self.journal_file, 'a', encoding='utf-8')
+        if is_new:
+            self._write(header or {})
+            self.sync()
+
+    def append(self, key, item):
+        self._write([key, item])
+        self._unsynced += 1
+        if self._unsynced >= self.fsync_every or time.monotonic() - self._last_sync >= self.fsync_interval:
+            self.sync()
+
+    def sync(self):
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._unsynced = 0
+        self._last_sync = time.monotonic()
+
+    def close(self):
+        """Fold the journal into the snapshot"""
+        if self._f.closed:
+            return
+        self.sync()
+        self._f.close()
+        # still locked: not folded by another process meanwhile
+        self.fold(self.journal_file)
+        self._unlock(self._lock_f)
+
+    def _write(self, record):
+        self._f.write(json.dumps(record, separators=(',', ':')) + '\n')
 
     @classmethod
-    def from_json(cls, json_s):
-        json_d = json.loads(json_s)
-        return Session(**json_d)
+    def replay(cls, journal_file):
+        journal_file = pathlib.Path(journal_file)
+        snapshot_file = journal_file.with_suffix('.json')
+        session = None
+        if snapshot_file.exists():
+            with open(snapshot_file, encoding='utf-8') as snapshot_f:
+                session = json.load(snapshot_f)
+        with open(journal_file, encoding='utf-8') as journal_f:
+            for n, line in enumerate(journal_f):
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    break   # torn last line after a crash
+                if n == 0:
+                    session = session if session is not None else record
+                else:
+                    key, item = record
+                    if session.get(key) is None:
+                        session[key] = []
+                    session[key].append(item)
+        return session
 
-    def to_json(self):
-        return json.dumps(dataclasses.asdict(self))
-    
-    def has_content(self):
-        return self.questions is not None
-    
+    @classmethod
+    def fold(cls, journal_file):
+        journal_file = pathlib.Path(journal_file)
+        session = cls.replay(journal_file)
+        snapshot_file = journal_file.with_suffix('.json')
+        if session is not None:
+            tmp_file = snapshot_file.with_name(snapshot_file.name + '.tmp')
+            with open(tmp_file, 'w', encoding='utf-8') as snapshot_f:
+                json.dump(session, snapshot_f, separators=(',', ':'))
+            os.replace(tmp_file, snapshot_file)
+        os.remove(journal_file)
+        return snapshot_file
+
+    @classmethod
+    def recover(cls, directory):
+        """Fold journals left over by a crash or an app not properly closed, the ones
+        still locked (live, in this or another process) are left alone"""
+        recovered = []
+        for journal_file in pathlib.Path(directory).iterdir():
+            if journal_file.name[:8] == 'session_' and journal_file.suffix == cls.SUFFIX and journal_file.is_file():
+                lock_f = cls._lock(journal_file)
+                if lock_f is None:
+                    continue
+                # folded by its app between the listing and the lock
+                if journal_file.exists():
+                    recovered.append(cls.fold(journal_file))
+                cls._unlock(lock_f)
+        return recovered
+
+    @classmethod
+    def _lock(cls, journal_file):
+        """Open lock file of the journal, locked (non-blocking), else None"""
+        lock_f = open(journal_file.with_name(journal_file.name + cls.LOCK_SUFFIX), 'a')
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                lock_f.seek(0)
+                msvcrt.locking(lock_f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(lock_f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_f.close()
+            return None
+        return lock_f
+
+    @staticmethod
+    def _unlock(lock_f):
+        # removed while still locked on POSIX, on Windows an open file can't be removed:
+        # closed (unlocked) first, it may then be locked again by another process
+        if os.name != 'nt':
+            os.remove(lock_f.name)
+        lock_f.close()
+        if os.name == 'nt':
+            try:
+                os.remove(lock_f.name)
+            except OSError:
+                pass
+
+
+class SessionDirectory():
+    """Sorted in-memory listing of the session files of a folder, for paging
+    through them without listing the folder on every move.
+
+    The app keeps it up to date with `add`/`discard` for the sessions it creates
+    (listed even before their file is written); `poll` is the watcher for changes
+    made by others: it rescans only when the folder mtime changed.
+    """
+
+    def __init__(self, directory, suffix='.json') -> None:
+        self.directory = pathlib.Path(directory)
+        self.suffix = suffix
+        self.names: list[str] = []
+        self._own: set[str] = set()
+        self._mtime = None
+        self.poll()
+
+    def __len__(self):
+        return len(self.names)
+
+    def __getitem__(self, i):
+        return self.names[i]
+
+    def page(self, start, size):
+        return self.names[max(0, start):max(0, start + size)]
+
+    def find(self, name):
+        """Position of `name` or -1"""
+        i = bisect.bisect_left(self.names, name)
+        return i if i < len(self.names) and self.names[i] == name else -1
+
+    def add(self, name):
+        """List a session of this app, return its position"""
+        self._own.add(name)
+        i = bisect.bisect_left(self.names, name)
+        if i == len(self.names) or self.names[i] != name:
+            # new sessions are timestamped: usually appended
+            self.names.insert(i, name)
+        return i
+
+    def read(self, name, meta=None):
+        """Session `name`, empty (with `meta`) for a session of this app not written yet"""
+        path = self.directory / name
+        if name in self._own and not path.exists():
+            return Session(name, meta=meta, messages=[])
+        return Session.read(path)
+
+    def discard(self, name):
+        self._own.discard(name)
+        i = self.find(name)
+        if i >= 0:
+            del self.names[i]
+
+    def poll(self):
+        """Rescan if the folder changed since the last scan, True if the listing changed"""
+        mtime = self.directory.stat().st_mtime_ns
+        if mtime == self._mtime:
+            return False
+        self._mtime = mtime
+        names = {entry.name for entry in os.scandir(self.directory)
+                 if entry.name.endswith(self.suffix) and entry.is_file()}
+        # own sessions are listed by the scan once written
+        self._own -= names
+        names = sorted(names | self._own)
+        changed = names != self.names
+        self.names = names
+        return changed
+
+
+
+# archive member codecs. 'zdict': raw deflate with a preset dictionary trained on
+# previous sessions (stored in the archive under DICT_PREFIX), members are written
+# as stored with a DICT_COMMENT naming their dictionary: small sessions compress
+# well while each one is still read on its own.
+# zipfile (and sqlite3, for the search index) is imported by the methods reading or
+# writing archives: the apps import this module at startup for the journal and the
+# listing only. Values: zipfile.ZIP_STORED, ZIP_DEFLATED, ZIP_LZMA
+CODECS = {'stored': 0, 'deflate': 8, 'lzma': 14, 'zdict': None}
+# codec of a member by its compress_type (zdict members are told by their dictionary id)
+CODEC_NAMES = {v: k for k, v in CODECS.items() if v is not None}
+DICT_PREFIX = 'zdict/'
+# archive segments: one archive per period, named <stem>-<period><suffix>
+SEGMENTS = {None: None, 'month': '%Y%m', 'year': '%Y'}
+DICT_COMMENT = b'zdict:'
+
+
+def train_dictionary(samples, size=32*1024):
+    """Preset dictionary for zlib from sample sessions (bytes): deflate only looks back 32KB,
+    so the samples are clipped to share it, the most recent last (closest, cheapest to refer to)"""
+    if not samples:
+        return b''
+    share = max(1024, size // len(samples))
+    return b''.join(sample[:share] for sample in samples)[-size:]
+
+
+class SessionIndex():
+    """Sidecar index of the archive members, kept sorted by name.
+
+    Fixed-size records (name, offset, sizes, crc, mtime, dictionary id) so opening
+    the store and seeking to any session never needs the zip central directory.
+    Indexing gives the member name, `entry(i)` the full record.
+    """
+
+    HEADER = struct.Struct('<4sHQQ')       # magic, version, archive size, count
+    RECORD = struct.Struct('<64sQQQHIQI')  # name, header_offset, compress_size, file_size, compress_type, crc, mtime, dict_id
+    NAME_SIZE = 64
+    MAGIC = b'SSIX'
+    VERSION = 2
+
+    def __init__(self, index_file) -> None:
+        self.index_file = pathlib.Path(index_file)
+        self.archive_size = 0
+        self.count = 0
+        if self.index_file.exists():
+            with open(self.index_file, 'rb') as idx_f:
+                magic, version, self.archive_size, self.count = self.HEADER.unpack(idx_f.read(self.HEADER.size))
+            if magic != self.MAGIC:
+                raise ValueError(f'Invalid session index {self.index_file}')
+            if version != self.VERSION:
+                # older format: stale, rebuilt by the store
+                self.archive_size = self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.entry(i)[0]
+
+    def entry(self, i):
+        if i < 0:
+            i += self.count
+        if not 0 <= i < self.count:
+            raise IndexError(i)
+        with open(self.index_file, 'rb') as idx_f:
+            idx_f.seek(self.HEADER.size + i * self.RECORD.size)
+            return self._unpack(idx_f.read(self.RECORD.size))
+
+    def entries(self):
+        """All the records, read in one pass"""
+        if self.count == 0:
+            return []
+        with open(self.index_file, 'rb') as idx_f:
+            idx_f.seek(self.HEADER.size)
+            data = idx_f.read(self.count * self.RECORD.size)
+        return [self._decode(*fields) for fields in self.RECORD.iter_unpack(data)]
+
+    def find(self, name):
+        """Position of `name` (binary search over the records) or -1"""
+        i = bisect.bisect_left(self, name)
+        if i < self.count and self[i] == name:
+            return i
+        return -1
+
+    def is_valid_for(self, archive_file):
+        return self.index_file.exists() and archive_file.exists() and archive_file.stat().st_size == self.archive_size
+
+    @classmethod
+    def fits(cls, name):
+        """Whether `name` fits in a record (UTF-8 bytes)"""
+        return len(name.encode('utf-8')) <= cls.NAME_SIZE
+
+    def add(self, zip_infos, archive_size):
+        """Add members written to the archive (same name replaces the record)
+        """
+        new_entries = sorted(self._entry_of(zi) for zi in zip_infos if not zi.filename.startswith(DICT_PREFIX))
+        if self.count == 0 or (new_entries and new_entries[0][0] > self[-1]):
+            # usual case: new sessions sort after all existing ones, just append records
+            with open(self.index_file, 'r+b' if self.index_file.exists() else 'wb') as idx_f:
+                idx_f.seek(self.HEADER.size + self.count * self.RECORD.size)
+                for e in new_entries:
+                    idx_f.write(self._pack(e))
+                self.count += len(new_entries)
+                self.archive_size = archive_size
+                idx_f.seek(0)
+                idx_f.write(self.HEADER.pack(self.MAGIC, self.VERSION, self.archive_size, self.count))
+        else:
+            entries = {e[0]: e for e in self.entries()}
+            entries.update((e[0], e) for e in new_entries)
+            self._rewrite(sorted(entries.values()), archive_size)
+
+    def rebuild(self, archive_file):
+        """(Re)create the index from the zip central directory (one-off, for missing or stale index)
+        """
+        import zipfile
+        with zipfile.ZipFile(archive_file, mode='r') as z_f:
+            # last member wins on duplicate names, like ZipFile.getinfo()
+            entries = {zi.filename: self._entry_of(zi) for zi in z_f.infolist() if not zi.filename.startswith(DICT_PREFIX)}
+        self._rewrite(sorted(entries.values()), archive_file.stat().st_size)
+
+    def _rewrite(self, entries, archive_size):
+        tmp_file = self.index_file.with_name(self.index_file.name + '.tmp')
+        with open(tmp_file, 'wb') as idx_f:
+            idx_f.write(self.HEADER.pack(self.MAGIC, self.VERSION, archive_size, len(entries)))
+            for e in entries:
+                idx_f.write(self._pack(e))
+        os.replace(tmp_file, self.index_file)
+        self.archive_size, self.count = archive_size, len(entries)
+
+    @staticmethod
+    def _entry_of(zi):
+        dict_id = int(zi.comment[len(DICT_COMMENT):], 16) if zi.comment.startswith(DICT_COMMENT) else 0
+        return (zi.filename, zi.header_offset, zi.compress_size, zi.file_size, zi.compress_type, zi.CRC,
+                int(datetime(*zi.date_time).timestamp()), dict_id)
+
+    def _pack(self, e):
+        name = e[0].encode('utf-8')
+        if len(name) > self.NAME_SIZE:
+            raise ValueError(f'Session name too long for index: {e[0]}')
+        return self.RECORD.pack(name, *e[1:])
+
+    def _unpack(self, record):
+        return self._decode(*self.RECORD.unpack(record))
+
+    @staticmethod
+    def _decode(name, *rest):
+        return (name.rstrip(b'\0').decode('utf-8'), *rest)
+
+
+class SegmentedIndex():
+    """The indexes of the archive segments (oldest first) seen as one: positions
+    run through the segments in order, `locate(i)` gives the segment and the
+    position in it. A name in several segments is found in the newest.
+    """
+
+    def __init__(self) -> None:
+        self.archive_files: list[pathlib.Path] = []
+        self.indexes: list[SessionIndex] = []
+
+    def add_segment(self, archive_file):
+        index = SessionIndex(archive_file.with_name(archive_file.name + '.idx'))
+        self.archive_files.append(archive_file)
+        self.indexes.append(index)
+        return index
+
+    def segment(self, archive_file):
+        return self.indexes[self.archive_files.index(archive_file)]
+
+    def __len__(self):
+        return sum(len(index) for index in self.indexes)
+
+    def __getitem__(self, i):
+        k, j = self.locate(i)
+        return self.indexes[k][j]
+
+    def entry(self, i):
+        k, j = self.locate(i)
+        return self.indexes[k].entry(j)
+
+    def offset(self, k):
+        return sum(len(index) for index in self.indexes[:k])
+
+    def locate(self, i):
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError(i)
+        for k, index in enumerate(self.indexes):
+            if i < len(index):
+                return k, i
+            i -= len(index)
+
+    def find(self, name):
+        for k in range(len(self.indexes) - 1, -1, -1):
+            j = self.indexes[k].find(name)
+            if j >= 0:
+                return self.offset(k) + j
+        return -1
+
+    def is_valid_for(self, archive_file):
+        return self.segment(archive_file).is_valid_for(archive_file)
+
+
+class SessionCache():
+    """LRU cache of loaded sessions keyed by name, bounded by entry count and bytes
+    (size of the serialized session)
+    """
+
+    def __init__(self, max_entries=64, max_bytes=8*1024*1024) -> None:
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.nbytes = 0
+        self._entries: OrderedDict[str, tuple[Session, int]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, name):
+        return name in self._entries
+
+    def get(self, name):
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+                return self._entries[name][0]
+
+    def put(self, name, session, size):
+        with self._lock:
+            if name in self._entries:
+                self.nbytes -= self._entries.pop(name)[1]
+            self._entries[name] = (session, size)
+            self.nbytes += size
+            while len(self._entries) > 1 and (len(self._entries) > self.max_entries or self.nbytes > self.max_bytes):
+                _, (_, evicted_size) = self._entries.popitem(last=False)
+                self.nbytes -= evicted_size
+
+
+class SessionList():
+    """List-like view of all sessions: archived ones (lazily, from the index
+    and the cache) followed by the pending ones not yet stored
+    """
+
+    def __init__(self, index, cache) -> None:
+        self.index = index
+        self.cache = cache
+        self.pending: list[Session] = []
+
+    def __len__(self):
+        return len(self.index) + len(self.pending)
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        if i >= len(self.index):
+            return self.pending[i - len(self.index)]
+        name = self.index[i]
+        return self.cache.get(name) or Session(name=name)
+
+    def append(self, session):
+        self.pending.append(session)
+
+    def archived(self, names):
+        """Drop pending sessions now found in the index"""
+        self.pending = [s for s in self.pending if s.name not in names]
 
 
 class SessionStore():
@@ -31,57 +500,396 @@ class SessionStore():
     # to bet defined by caller ..
     # zip_file = pathlib.Path('kivy_data_folder', 'session_store.archive') 
     
-    def __init__(self, archive_file) -> None:
+    # sessions the zdict dictionary is trained on: at least, at most (most recent)
+    DICT_MIN_SAMPLES = 16
+    DICT_MAX_SAMPLES = 64
+
+    def __init__(self, archive_file, cache_entries=64, cache_bytes=8*1024*1024, prefetch=3, codec='deflate',
+                 segment=None) -> None:
+        """`segment`: None for a single archive, else 'month' or 'year' to roll over to a
+        new archive file per period (`archive_file` itself, if any, is the oldest segment)"""
+        if codec not in CODECS:
+            raise ValueError(f'Unknown codec {codec}, one of {list(CODECS)}')
+        if segment not in SEGMENTS:
+            raise ValueError(f'Unknown segment {segment}, one of {list(SEGMENTS)}')
         self.archive_file = pathlib.Path(archive_file)
-        self.sessions : list[Session] = None
-        
+        self.codec = codec
+        self.segment = segment
+        self._dicts: dict[int, bytes] = {}
+        self._dict_id = None
+        # pending session files whose name is too long for the index, renamed *.rejected
+        self.rejected: list[pathlib.Path] = []
+        self.index = SegmentedIndex()
+        for segment_file in self.segment_files():
+            self.index.add_segment(segment_file)
+        self.cache = SessionCache(cache_entries, cache_bytes)
+        from .search import SessionSearch
+        self.search_index = SessionSearch(self.archive_file.with_name(self.archive_file.name + '.fts'))
+        self.sessions : SessionList = None
+        # long-lived read handle per segment, shared (under lock) with the prefetch thread
+        self._archive_fs: dict[pathlib.Path, object] = {}
+        self._archive_lock = threading.Lock()
+
         # in case of app crash or not properly closed
-        all_sorted_names = self.store_sessions()
-        self.sessions = [Session(name=n) for n in all_sorted_names]
+        self.store_sessions()
+        self.sessions = SessionList(self.index, self.cache)
         self.current_idx = len(self.sessions)-1
 
+        self.prefetch = prefetch
+        self._prefetch_cond = threading.Condition()
+        self._prefetch_center = None
+        self._closed = False
+        self._prefetch_thread = None
+        if prefetch > 0:
+            self._prefetch_thread = threading.Thread(target=self._prefetch_loop, daemon=True)
+            self._prefetch_thread.start()
+
+    def close(self):
+        with self._prefetch_cond:
+            self._closed = True
+            self._prefetch_cond.notify()
+        if self._prefetch_thread is not None:
+            self._prefetch_thread.join()
+        with self._archive_lock:
+            for a_f in self._archive_fs.values():
+                a_f.close()
+            self._archive_fs.clear()
+        self.search_index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 
     def add_session(self, new_session):
+        if not SessionIndex.fits(new_session.name):
+            raise ValueError(f'Session name too long for index: {new_session.name}')
         self.sessions.append(new_session)
         with open(new_session.name, 'w', encoding='utf-8') as session_f:
             session_f.write(new_session.to_json())
+        self.search_index.add([(new_session.name, new_session)])
+
+    def search(self, query, limit=20):
+        """Ranked (position, SearchHit) of the sessions matching all the words of `query`"""
+        found = []
+        for hit in self.search_index.search(query, limit):
+            i = self.index.find(hit.name)
+            if i < 0:
+                i = next((len(self.index) + j for j, s in enumerate(self.sessions.pending) if s.name == hit.name), -1)
+            if i >= 0:
+                found.append((i, hit))
+        return found
     
+    def get_session(self, i):
+        """Loaded session at position i, from the cache or else read (and cached) from the archive"""
+        session = self.sessions[i]
+        if session.has_content() or i >= len(self.index):
+            return session
+        data = self.read_member(i)
+        session = Session.load(data)
+        self.cache.put(self.index[i], session, len(data))
+        return session
+
     def fetch_previous_session(self, size=10):
         if not self.is_empty() and self.current_idx > 0:
             #cache ´size´ previous session
-            with zipfile.ZipFile(self.archive_file, mode='r') as z_f:
-                from_idx = 0 if self.current_idx-size < 0 else self.current_idx-size
-                for i in range(from_idx, self.current_idx+1):
-                    with z_f.open(name=self.sessions[i].name) as session_f:
-                        # only if not fecthed previously
-                        if not self.sessions[i].has_content():
-                            session_json = json.load(session_f)
-                            self.sessions[i] = Session.from_json(session_json)
-
+            from_idx = 0 if self.current_idx-size < 0 else self.current_idx-size
+            for i in range(self.current_idx, from_idx-1, -1):
+                self.get_session(i)
             return self.sessions[self.current_idx]
-    
+
     def previous_session(self):
         if  0 < self.current_idx <= len(self.sessions) - 1:
             self.current_idx -= 1
-            return self.sessions[self.current_idx]
-    
+            return self._navigate()
+
     def next_session(self):
         if 0 <= self.current_idx < len(self.sessions) - 1:
             self.current_idx += 1
-            return self.sessions[self.current_idx]
-    
+            return self._navigate()
+
+    def _navigate(self):
+        session = self.get_session(self.current_idx)
+        with self._prefetch_cond:
+            self._prefetch_center = self.current_idx
+            self._prefetch_cond.notify()
+        return session
+
+    def _prefetch_loop(self):
+        """Background loading of the sessions on both sides of the current one (nearest first)"""
+        import zipfile
+        while True:
+            with self._prefetch_cond:
+                while self._prefetch_center is None and not self._closed:
+                    self._prefetch_cond.wait()
+                if self._closed:
+                    return
+                center, self._prefetch_center = self._prefetch_center, None
+            for d in range(1, self.prefetch+1):
+                for i in (center+d, center-d):
+                    if self._prefetch_center is not None or self._closed:
+                        break   # user moved on, re-center
+                    if 0 <= i < len(self.index) and self.index[i] not in self.cache:
+                        try:
+                            self.get_session(i)
+                        except (OSError, ValueError, zipfile.BadZipFile):
+                            pass
+
+    def read_member(self, i):
+        """Read the i-th archived session straight from its offset (no central directory scan).
+        Members are session encodings (older ones JSON): `Session.load` takes views over the
+        returned buffer, a stored member is not copied again once read
+        """
+        import zipfile
+        k, j = self.index.locate(i)
+        archive_file = self.index.archive_files[k]
+        name, header_offset, compress_size, _, compress_type, _, _, dict_id = self.index.indexes[k].entry(j)
+        with self._archive_lock:
+            a_f = self._archive_fs.get(archive_file)
+            if a_f is None:
+                # unbuffered: a read buffer would keep bytes the next append overwrites (old central directory)
+                a_f = self._archive_fs[archive_file] = open(archive_file, 'rb', buffering=0)
+            a_f.seek(header_offset)
+            header = a_f.read(zipfile.sizeFileHeader)
+            if header[:4] != zipfile.stringFileHeader:
+                raise zipfile.BadZipFile(f'Bad local header for {name}, index is stale?')
+            name_len, extra_len = struct.unpack('<HH', header[26:30])
+            a_f.seek(name_len + extra_len, os.SEEK_CUR)
+            data = a_f.read(compress_size)
+        if dict_id:
+            decompressor = zlib.decompressobj(-15, zdict=self._dictionary(dict_id, archive_file))
+            return decompressor.decompress(data) + decompressor.flush()
+        if compress_type == zipfile.ZIP_STORED:
+            return data
+        if compress_type == zipfile.ZIP_DEFLATED:
+            return zlib.decompress(data, -15)
+        if compress_type == zipfile.ZIP_LZMA:
+            return zipfile.LZMADecompressor().decompress(data)
+        with zipfile.ZipFile(archive_file, mode='r') as z_f:
+            return z_f.read(name)
+
     def store_sessions(self):
-        """Save all pending session files
-        and return all session-name sorted by name
+        """Save all pending session files to the current segment, update the indexes
+        incrementally and return the index of all session-names
         """
-        with zipfile.ZipFile(self.archive_file, mode='a') as z_f:
-            for session_file in self.pending_session_files():
-                z_f.write(session_file)
-            names = sorted(z_f.namelist())
-        # clean-up pending session-files
+        import zipfile
+        # journals of live sessions not properly closed become pending session files
+        SessionJournal.recover(self.archive_file.parent)
+        pending_files = []
         for session_file in self.pending_session_files():
+            if SessionIndex.fits(session_file.name):
+                pending_files.append(session_file)
+            else:
+                # can't be indexed: set aside (kept, no longer pending) before anything is appended to the archive
+                rejected_file = session_file.with_name(session_file.name + '.rejected')
+                os.replace(session_file, rejected_file)
+                self.rejected.append(rejected_file)
+        active = self.active_segment()
+        # validity is checked before appending, as appending changes the archive size
+        stale = [f for f in self.index.archive_files if not self.index.is_valid_for(f)]
+        search_valid = all(self.search_index.is_valid_for(f) for f in self.index.archive_files if f.exists())
+        pending_data = [session_file.read_bytes() for session_file in pending_files]
+        # pending JSON files are archived in the binary encoding
+        pending_sessions = [_parse(data) for data in pending_data]
+        member_data = [_encode(session, data) for session, data in zip(pending_sessions, pending_data)]
+        new_infos = []
+        if pending_files or (self.segment is None and not active.exists()):
+            if active not in self.index.archive_files:
+                # rollover: new segment
+                self.index.add_segment(active)
+                stale.append(active)
+            dictionary = None
+            if self.codec == 'zdict' and pending_files:
+                dictionary = self._current_dictionary(member_data)
+            with zipfile.ZipFile(active, mode='a') as z_f:
+                if dictionary is not None and dictionary[0] not in self._written_dicts(z_f):
+                    z_f.writestr(f'{DICT_PREFIX}{dictionary[0]:08x}', dictionary[1], compress_type=zipfile.ZIP_DEFLATED)
+                for session_file, data in zip(pending_files, member_data):
+                    self._write_member(z_f, zipfile.ZipInfo.from_file(session_file, session_file.name), data, self.codec, dictionary)
+                new_infos = z_f.infolist()[len(z_f.infolist())-len(pending_files):] if pending_files else []
+        for segment_file in stale:
+            # missing or stale (archive changed outside the store): rebuild once
+            if segment_file.exists():
+                self.index.segment(segment_file).rebuild(segment_file)
+        if new_infos and active not in stale:
+            self.index.segment(active).add(new_infos, active.stat().st_size)
+        if not search_valid:
+            self.search_index.rebuild(self._archived_sessions(), [f for f in self.index.archive_files if f.exists()])
+        elif active.exists():
+            # sessions just archived are indexed from the pending files (no read back)
+            self.search_index.add(((zi.filename, session) for zi, session in zip(new_infos, pending_sessions)
+                                   if session is not None), active)
+        if self.sessions is not None:
+            self.sessions.archived({zi.filename for zi in new_infos})
+        # clean-up pending session-files
+        for session_file in pending_files:
             os.remove(session_file)
-        return names
+        return self.index
+
+    def segment_files(self):
+        """Existing archive files, oldest first"""
+        files = [self.archive_file] if self.segment is None or self.archive_file.exists() else []
+        if self.segment is not None:
+            stem, suffix = self.archive_file.stem, self.archive_file.suffix
+            n_digits = len(time.strftime(SEGMENTS[self.segment]))
+            pattern = re.compile(rf'{re.escape(stem)}-\d{{{n_digits}}}{re.escape(suffix)}')
+            files += sorted(f for f in self.archive_file.parent.glob(f'{stem}-*{suffix}') if pattern.fullmatch(f.name))
+        return files
+
+    def active_segment(self):
+        """Archive file new sessions are stored in"""
+        if self.segment is None:
+            return self.archive_file
+        period = time.strftime(SEGMENTS[self.segment])
+        return self.archive_file.with_name(f'{self.archive_file.stem}-{period}{self.archive_file.suffix}')
+
+    def compact(self, codec=None):
+        """Rewrite each segment without duplicate members (the last one wins) nor members
+        superseded by a newer segment; open and list times stay proportional to the sessions.
+        Each member keeps its codec (and dictionary), unless re-encoded with `codec`
+        (see recompress to also make it the store's)
+        """
+        if codec is not None and codec not in CODECS:
+            raise ValueError(f'Unknown codec {codec}, one of {list(CODECS)}')
+        dictionary = self._current_dictionary([]) if codec == 'zdict' else None
+        newer = set()
+        for k in range(len(self.index.indexes) - 1, -1, -1):
+            index = self.index.indexes[k]
+            names = {e[0] for e in index.entries()}
+            self._rewrite_segment(k, codec, dictionary, drop=newer)
+            newer |= names
+        self.current_idx = min(self.current_idx, len(self.sessions) - 1)
+
+    def recompress(self, codec=None):
+        """Rewrite the whole archive with `codec` (default: the store's), e.g. to migrate
+        an archive of stored members. Members are decoded and re-encoded into a temporary
+        archive that then replaces the archive (duplicates are dropped, last one wins)
+        """
+        codec = codec or self.codec
+        if codec not in CODECS:
+            raise ValueError(f'Unknown codec {codec}, one of {list(CODECS)}')
+        dictionary = None
+        if codec == 'zdict' and len(self.index):
+            samples = [self.read_member(i) for i in range(max(0, len(self.index) - self.DICT_MAX_SAMPLES), len(self.index))]
+            dictionary = self._new_dictionary(samples)
+        for k in range(len(self.index.indexes)):
+            self._rewrite_segment(k, codec, dictionary)
+        self.codec = codec
+        self._dict_id = dictionary[0] if dictionary is not None else None
+
+    def _rewrite_segment(self, k, codec, dictionary, drop=()):
+        import zipfile
+        # into a temporary archive, atomically renamed over the segment; `codec` None:
+        # each member is re-encoded with its own codec and dictionary
+        archive_file, index = self.index.archive_files[k], self.index.indexes[k]
+        if not archive_file.exists():
+            return
+        offset = self.index.offset(k)
+        entries = index.entries()
+        if codec is None:
+            # the dictionaries of the segment, also one stored before any member used it
+            with zipfile.ZipFile(archive_file) as z_f:
+                dict_ids = [int(n[len(DICT_PREFIX):], 16) for n in z_f.namelist() if n.startswith(DICT_PREFIX)]
+            dict_ids += [e[7] for e in entries if e[7] and e[7] not in dict_ids]
+            dictionaries = [(dict_id, self._dictionary(dict_id, archive_file)) for dict_id in dict.fromkeys(dict_ids)]
+        else:
+            dictionaries = [dictionary] if dictionary is not None else []
+        tmp_file = archive_file.with_name(archive_file.name + '.tmp')
+        with zipfile.ZipFile(tmp_file, mode='w') as z_f:
+            for dict_id, zdict in dictionaries:
+                z_f.writestr(f'{DICT_PREFIX}{dict_id:08x}', zdict, compress_type=zipfile.ZIP_DEFLATED)
+            for j, (name, _, _, _, compress_type, _, mtime, dict_id) in enumerate(entries):
+                if name in drop:
+                    continue
+                zinfo = zipfile.ZipInfo(name, datetime.fromtimestamp(mtime).timetuple()[:6])
+                # JSON members of older archives are migrated to the binary encoding
+                data = self.read_member(offset + j)
+                if codec is not None:
+                    member_codec, member_dictionary = codec, dictionary
+                elif dict_id:
+                    member_codec, member_dictionary = 'zdict', (dict_id, self._dictionary(dict_id, archive_file))
+                else:
+                    member_codec, member_dictionary = CODEC_NAMES.get(compress_type, 'deflate'), None
+                self._write_member(z_f, zinfo, _encode(_parse(data), data), member_codec, member_dictionary)
+        with self._archive_lock:
+            a_f = self._archive_fs.pop(archive_file, None)
+            if a_f is not None:
+                a_f.close()
+            os.replace(tmp_file, archive_file)
+            index.rebuild(archive_file)
+        # same sessions: the search index stays valid
+        self.search_index.add([], archive_file)
+
+    def _write_member(self, z_f, zinfo, data, codec, dictionary):
+        import zipfile
+        if codec != 'zdict' or dictionary is None:
+            # zdict without a dictionary yet (too few sessions): plain deflate
+            z_f.writestr(zinfo, data, compress_type=CODECS[codec] or zipfile.ZIP_DEFLATED)
+            return
+        dict_id, zdict = dictionary
+        compressor = zlib.compressobj(9, zlib.DEFLATED, -15, zdict=zdict)
+        zinfo.comment = DICT_COMMENT + b'%08x' % dict_id
+        z_f.writestr(zinfo, compressor.compress(data) + compressor.flush(), compress_type=zipfile.ZIP_STORED)
+
+    def _current_dictionary(self, pending_data):
+        """(id, dictionary) to compress new members with, trained once enough sessions were seen"""
+        import zipfile
+        if self._dict_id is None:
+            self._dict_id = 0
+            if len(self.index):
+                # the dictionary of the latest session, else one stored before any session used it
+                self._dict_id = self.index.entry(-1)[7]
+            for archive_file in reversed(self.index.archive_files):
+                if self._dict_id or not archive_file.exists():
+                    break
+                with zipfile.ZipFile(archive_file) as z_f:
+                    stored = [n for n in z_f.namelist() if n.startswith(DICT_PREFIX)]
+                if stored:
+                    self._dict_id = int(stored[-1][len(DICT_PREFIX):], 16)
+        if self._dict_id:
+            return self._dict_id, self._dictionary(self._dict_id)
+        n_archived = min(len(self.index), max(0, self.DICT_MAX_SAMPLES - len(pending_data)))
+        if n_archived + len(pending_data) < self.DICT_MIN_SAMPLES:
+            return None
+        samples = [self.read_member(i) for i in range(len(self.index) - n_archived, len(self.index))]
+        dictionary = self._new_dictionary(samples + pending_data)
+        self._dict_id = dictionary[0]
+        return dictionary
+
+    def _new_dictionary(self, samples):
+        zdict = train_dictionary(samples)
+        dict_id = zlib.crc32(zdict) or 1
+        self._dicts[dict_id] = zdict
+        return dict_id, zdict
+
+    def _dictionary(self, dict_id, archive_file=None):
+        import zipfile
+        zdict = self._dicts.get(dict_id)
+        if zdict is None:
+            # stored in the segments using it, look in the given one first
+            name = f'{DICT_PREFIX}{dict_id:08x}'
+            for candidate in [archive_file] + self.index.archive_files[::-1]:
+                if candidate is None or not candidate.exists():
+                    continue
+                with zipfile.ZipFile(candidate) as z_f:
+                    if name in z_f.NameToInfo:
+                        zdict = self._dicts[dict_id] = z_f.read(name)
+                        break
+            else:
+                raise KeyError(f'Missing dictionary {name}')
+        return zdict
+
+    @staticmethod
+    def _written_dicts(z_f):
+        return {int(n[len(DICT_PREFIX):], 16) for n in z_f.namelist() if n.startswith(DICT_PREFIX)}
+
+    def _archived_sessions(self):
+        for i in range(len(self.index)):
+            session = _parse(self.read_member(i))
+            if session is not None:
+                yield self.index[i], session
 
     def is_empty(self):
         return len(self.sessions) == 0
@@ -90,4 +898,16 @@ class SessionStore():
         for session_file in self.archive_file.parent.iterdir():
             if session_file.name[:8] == 'session_' and session_file.suffix == '.json' and session_file.is_file():
                 yield session_file
-        
\ No newline at end of file
+        
+
+
+def _parse(data):
+    # sessions that can't be parsed are archived as is but not searchable
+    try:
+        return Session.load(data)
+    except (ValueError, TypeError, KeyError, struct.error):
+        return None
+
+
+def _encode(session, data):
+    return session.encode() if session is not None else data
@@ -1,8 +1,12 @@
 import pytest
-from main import *
+from adscape.main import *
 import zipfile
+import zlib
 import os
 import pathlib
+import json
+import subprocess
+import sys
 
 my_session = Session(meta={'llm': 'lxxx'}, questions=['q1', 'q2'], answers=['a1','a2'])
 
@@ -14,6 +18,9 @@ def cleanup(session_zfile: str):
     session_zfile = pathlib.Path(session_zfile)
     if session_zfile.exists():
         os.remove(session_zfile)
+    fts_file = session_zfile.with_name(session_zfile.name + '.fts')
+    if fts_file.exists():
+        os.remove(fts_file)
        
     for s_f in session_zfile.parent.iterdir():
         if s_f.name[:8] == 'session_' and s_f.suffix == '.json' and s_f.is_file():
@@ -38,9 +45,354 @@ def test_SessionStore():
     assert pathlib.Path(f'./{my_session.name}').exists()
     ss.store_sessions()
     assert not pathlib.Path(f'./{my_session.name}').exists()
+    ss.close()
 
     # to mock an existing session store and test get_session, next, previous ...
 
 
     cleanup(m_s)    
 
+
+
+def test_SessionStore_index():
+
+    m_s = './my_store.zip'
+    cleanup(m_s)
+    m_i = pathlib.Path(m_s + '.idx')
+    if m_i.exists():
+        os.remove(m_i)
+
+    ss = SessionStore(m_s)
+    names = [f'session_2025010{i}_120000.json' for i in range(1, 4)]
+    for n in names:
+        ss.add_session(Session(name=n, meta={}, questions=['q'], answers=[n]))
+    ss.store_sessions()
+    assert list(ss.index) == names
+    assert len(ss.sessions) == 3
+
+    # re-open from the index only, out of order name is inserted at its sorted position
+    ss = SessionStore(m_s)
+    assert ss.index.is_valid_for(pathlib.Path(m_s))
+    assert ss.index.find(names[1]) == 1
+    ss.add_session(Session(name='session_20240101_120000.json', meta={}, questions=['q'], answers=['old']))
+    ss.store_sessions()
+    assert ss.index[0] == 'session_20240101_120000.json'
+    index = ss.index.segment(pathlib.Path(m_s))
+    assert index.entries() == [index.entry(i) for i in range(4)]
+    assert Session.load(ss.read_member(3)).answers == [names[2]]
+    # archived in the binary encoding
+    assert ss.read_member(3)[:4] == Session.MAGIC
+
+    # stale index (archive changed behind our back) is rebuilt
+    with zipfile.ZipFile(m_s, mode='a') as z_f:
+        z_f.writestr('session_20990101_000000.json', Session(name='x').to_json())
+    ss = SessionStore(m_s)
+    assert len(ss.index) == 5
+    assert ss.fetch_previous_session().name == 'x'
+    ss.close()
+
+    cleanup(m_s)
+    os.remove(m_i)
+
+
+def test_SessionStore_long_name(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    m_s = tmp_path / 'my_store.zip'
+    long_name = f'session_{"x" * 60}.json'
+    with SessionStore(m_s, prefetch=0) as ss:
+        with pytest.raises(ValueError):
+            ss.add_session(Session(name=long_name))
+        assert len(ss.sessions) == 0
+
+    # written by someone else: set aside, the other sessions are archived and indexed
+    (tmp_path / long_name).write_text(Session(name=long_name).to_json())
+    (tmp_path / 'session_1.json').write_text(Session(name='session_1.json').to_json())
+    with SessionStore(m_s, prefetch=0) as ss:
+        assert list(ss.index) == ['session_1.json'] and zipfile.ZipFile(m_s).namelist() == ['session_1.json']
+        assert ss.rejected == [tmp_path / (long_name + '.rejected')] and ss.rejected[0].exists()
+    with SessionStore(m_s, prefetch=0) as ss:
+        assert ss.index.is_valid_for(m_s) and len(ss.index) == 1 and not ss.rejected
+
+
+def test_SessionCache():
+    cache = SessionCache(max_entries=2, max_bytes=100)
+    for n in ('s1', 's2', 's3'):
+        cache.put(n, Session(name=n), 10)
+    assert 's1' not in cache and len(cache) == 2
+    cache.get('s2')
+    cache.put('s4', Session(name='s4'), 85)
+    assert 's3' not in cache and 's2' in cache and cache.nbytes == 95
+    cache.put('s5', Session(name='s5'), 50)
+    assert len(cache) == 1 and cache.nbytes == 50
+
+
+def test_SessionStore_navigation():
+
+    m_s = './my_store.zip'
+    cleanup(m_s)
+    m_i = pathlib.Path(m_s + '.idx')
+    if m_i.exists():
+        os.remove(m_i)
+
+    ss = SessionStore(m_s)
+    for i in range(6):
+        ss.add_session(Session(name=f'session_2025010{i}_120000.json', meta={}, questions=['q'], answers=[str(i)]))
+    ss.store_sessions()
+    ss.close()
+
+    with SessionStore(m_s, cache_entries=3) as ss:
+        assert ss.current_idx == 5
+        assert ss.previous_session().answers == ['4']
+        assert ss.previous_session().answers == ['3']
+        assert ss.next_session().answers == ['4']
+        assert len(ss.cache) <= 3
+
+    cleanup(m_s)
+    os.remove(m_i)
+
+
+def test_SessionJournal():
+
+    m_s = './my_store.zip'
+    cleanup(m_s)
+
+    name = 'session_20250301_120000.json'
+    journal = SessionJournal(name, header={'name': name, 'meta': {}})
+    journal.append('questions', 'q1')
+    journal.append('answers', 'a1')
+    journal.sync()
+    assert SessionJournal.replay(journal.journal_file)['answers'] == ['a1']
+    journal.close()
+    assert not journal.journal_file.exists()
+
+    # continue from the snapshot, then "crash" leaving a torn line
+    journal = SessionJournal(name)
+    journal.append('questions', 'q2')
+    journal.sync()
+    with open(journal.journal_file, 'a') as j_f:
+        j_f.write('["answers", "a')
+    # live: not recovered
+    assert SessionJournal.recover('.') == []
+    with pytest.raises(RuntimeError):
+        SessionJournal(name)
+    journal._f.close()
+    journal._lock_f.close()
+
+    # the store recovers the journal before sweeping pending session files
+    with SessionStore(m_s, prefetch=0) as ss:
+        session = ss.get_session(ss.index.find(name))
+        assert session.questions == ['q1', 'q2'] and session.answers == ['a1']
+    assert not journal.journal_file.exists()
+    assert not pathlib.Path(str(journal.journal_file) + SessionJournal.LOCK_SUFFIX).exists()
+
+    cleanup(m_s)
+    os.remove(m_s + '.idx')
+
+
+def test_SessionJournal_other_process(tmp_path):
+    # a journal live in another app, then that app crashes
+    script = ('import sys; from adscape.main import SessionJournal; '
+              'journal = SessionJournal(sys.argv[1], header={"messages": []}); '
+              'journal.append("messages", "m1"); journal.sync(); print("ready", flush=True); sys.stdin.read()')
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([str(pathlib.Path(__file__).parent.parent),
+                                                       os.environ.get('PYTHONPATH', '')]))
+    snapshot_file = tmp_path / 'session_20250301_120000.json'
+    app = subprocess.Popen([sys.executable, '-c', script, str(snapshot_file)], env=env,
+                           stdin=subprocess.PIPE, stdout=subprocess.PIPE, text=True)
+    try:
+        assert app.stdout.readline() == 'ready\n'
+        assert SessionJournal.recover(tmp_path) == []
+        assert snapshot_file.with_suffix('.jsonl').exists()
+    finally:
+        app.kill()
+        app.wait()
+    assert SessionJournal.recover(tmp_path) == [snapshot_file]
+    assert json.loads(snapshot_file.read_text()) == {'messages': ['m1']}
+    assert sorted(tmp_path.iterdir()) == [snapshot_file]
+
+
+def test_SessionStore_search():
+
+    m_s = './my_store.zip'
+    cleanup(m_s)
+    m_i = pathlib.Path(m_s + '.idx')
+    if m_i.exists():
+        os.remove(m_i)
+
+    with SessionStore(m_s, prefetch=0) as ss:
+        ss.add_session(Session(name='session_20250101_120000.json', meta={'model': 'llama3'},
+                               questions=['how to resize a Kivy window?'], answers=['use Window.size']))
+        ss.add_session(Session(name='session_20250102_120000.json', meta={'model': 'mistral'},
+                               questions=['numpy broadcasting rules'], answers=['shapes are compared, kivy not involved']))
+        # pending sessions are searchable already
+        assert [i for i, _ in ss.search('kivy')] == [0, 1]
+        ss.store_sessions()
+        ss.add_session(Session(name='session_20250103_120000.json', meta={'model': 'llama3'},
+                               questions=['resizing images'], answers=['PIL']))
+
+        # questions rank before answers, last word is a prefix
+        hits = ss.search('Kivy')
+        assert [i for i, _ in hits] == [0, 1] and '**Kivy**' in hits[0][1].snippet
+        assert sorted(i for i, _ in ss.search('resiz')) == [0, 2]
+        assert [i for i, _ in ss.search('llama3 window')] == [0]
+        assert ss.search('20250102')[0][0] == 1
+        assert ss.search('"*') == []
+
+    # index missing or stale: rebuilt from the archive
+    os.remove(m_s + '.fts')
+    with SessionStore(m_s, prefetch=0) as ss:
+        assert len(ss.search_index) == 3
+        assert [i for i, _ in ss.search('mistral')] == [1]
+
+    cleanup(m_s)
+    os.remove(m_i)
+
+
+def test_SessionStore_codecs():
+
+    m_s = './my_store.zip'
+    cleanup(m_s)
+    m_i = pathlib.Path(m_s + '.idx')
+    if m_i.exists():
+        os.remove(m_i)
+
+    def sessions(start, n):
+        return [Session(name=f'session_202501{i:02d}_120000.json', meta={'llm': 'llama3'},
+                        questions=[f'question {i} about the kivy window size'],
+                        answers=[f'**Answer {i}**\n\nUse Window.size, the window size of kivy.\n']) for i in range(start, start + n)]
+
+    # an archive of stored members, as written before codecs
+    with SessionStore(m_s, prefetch=0, codec='stored') as ss:
+        for s in sessions(1, 20):
+            ss.add_session(s)
+        ss.store_sessions()
+
+    # too few sessions for a dictionary yet: deflate, then the dictionary is trained
+    with SessionStore(m_s, prefetch=0, codec='zdict') as ss:
+        ss.DICT_MIN_SAMPLES = 25
+        for s in sessions(21, 2):
+            ss.add_session(s)
+        ss.store_sessions()
+        assert ss.index.entry(-1)[4] == zipfile.ZIP_DEFLATED and ss.index.entry(-1)[7] == 0
+        for s in sessions(23, 4):
+            ss.add_session(s)
+        ss.store_sessions()
+        assert ss.index.entry(-1)[7] != 0
+        assert ss.get_session(25).answers == sessions(26, 1)[0].answers
+        dict_names = [n for n in zipfile.ZipFile(m_s).namelist() if n.startswith('zdict/')]
+        assert len(dict_names) == 1 and len(ss.index) == 26
+
+    # reopened: same dictionary for new members, every codec decodes
+    with SessionStore(m_s, prefetch=0, codec='zdict') as ss:
+        ss.add_session(sessions(27, 1)[0])
+        ss.store_sessions()
+        assert ss.index.entry(-1)[7] == ss.index.entry(-2)[7]
+        # stored, deflated and zdict members
+        assert [ss.get_session(i).answers for i in (0, 20, 26)] == [sessions(i, 1)[0].answers for i in (1, 21, 27)]
+
+        # migration of the whole archive
+        expected = [Session.load(ss.read_member(i)) for i in range(len(ss.index))]
+        ss.recompress('lzma')
+        assert {ss.index.entry(i)[4] for i in range(len(ss.index))} == {zipfile.ZIP_LZMA}
+        ss.recompress('zdict')
+        assert [Session.load(ss.read_member(i)) for i in range(len(ss.index))] == expected
+        assert ss.search_index.is_valid_for(pathlib.Path(m_s))
+        # members: 1/3 of deflate alone
+        deflated = sum(len(zlib.compress(ss.read_member(i))) for i in range(len(ss.index)))
+        assert sum(ss.index.entry(i)[2] for i in range(len(ss.index))) * 3 < deflated
+        entries = [ss.index.entry(i) for i in range(len(ss.index))]
+
+    # compacted by a store of another codec: the members keep theirs, and the dictionary
+    with SessionStore(m_s, prefetch=0) as ss:
+        ss.compact()
+        assert [ss.index.entry(i)[4:] for i in range(len(ss.index))] == [e[4:] for e in entries]
+        assert [n for n in zipfile.ZipFile(m_s).namelist() if n.startswith('zdict/')] == [f'zdict/{entries[-1][7]:08x}']
+        assert [Session.load(ss.read_member(i)) for i in range(len(ss.index))] == expected
+        ss.compact('deflate')
+        assert {ss.index.entry(i)[4] for i in range(len(ss.index))} == {zipfile.ZIP_DEFLATED}
+        assert not any(ss.index.entry(i)[7] for i in range(len(ss.index)))
+        with pytest.raises(ValueError):
+            ss.compact('bzip3')
+
+    with pytest.raises(ValueError):
+        SessionStore(m_s, codec='bzip3')
+
+    cleanup(m_s)
+    os.remove(m_i)
+
+
+@pytest.mark.filterwarnings('ignore:Duplicate name')
+def test_SessionStore_segments(tmp_path, monkeypatch):
+
+    # session files are written to the working directory, next to the archive
+    monkeypatch.chdir(tmp_path)
+    m_s = tmp_path / 'my_store.zip'
+
+    def session(i, answer='answer'):
+        return Session(name=f'session_2025{i:04d}_120000.json', questions=[f'question {i}'], answers=[answer])
+
+    # a legacy single archive, one session saved twice
+    with SessionStore(m_s, prefetch=0) as ss:
+        for s in (session(101), session(102), session(101, 'edited')):
+            ss.add_session(s)
+            ss.store_sessions()
+        # the index keeps the last copy, the archive all of them
+        assert len(ss.index) == 2 and len(zipfile.ZipFile(m_s).namelist()) == 3
+
+    # segmented: the legacy archive is the oldest segment, new sessions roll over per month
+    with SessionStore(m_s, prefetch=0, segment='month') as ss:
+        assert ss.index.archive_files == [m_s]
+        for month in ('202501', '202502'):
+            ss.active_segment = lambda: tmp_path / f'my_store-{month}.zip'
+            ss.add_session(session(int(month[-2:]) * 100 + 1, month))
+            ss.store_sessions()
+        assert ss.segment_files() == [m_s, tmp_path / 'my_store-202501.zip', tmp_path / 'my_store-202502.zip']
+        assert len(ss.index) == 4
+        answers = [Session.load(ss.read_member(i)).answers for i in range(4)]
+        assert answers == [['edited'], ['answer'], ['202501'], ['202502']]
+        # the newest copy of a name wins
+        assert ss.index.find(session(101).name) == 2
+        assert [h.name for _, h in ss.search('202502')] == [session(201).name]
+
+        ss.compact()
+        assert len(ss.index) == 3 and zipfile.ZipFile(m_s).namelist() == [session(102).name]
+        assert [ss.get_session(i).answers for i in range(3)] == [['answer'], ['202501'], ['202502']]
+        assert ss.current_idx < len(ss.sessions)
+
+    with SessionStore(m_s, prefetch=0, segment='month') as ss:
+        assert len(ss.index) == 3
+        assert ss.search_index.is_valid_for(m_s)
+        assert ss.get_session(0).name == session(102).name
+
+    with pytest.raises(ValueError):
+        SessionStore(m_s, segment='week')
+
+
+def test_SessionDirectory(tmp_path):
+    for n in ('session_2.json', 'session_1.json', 'session_1.jsonl', 'notes.txt'):
+        (tmp_path / n).write_text('{}')
+    sessions = SessionDirectory(tmp_path)
+    assert list(sessions) == ['session_1.json', 'session_2.json']
+    assert not sessions.poll()
+
+    # created by the app: listed before its file is written
+    assert sessions.add('session_3.json') == 2
+    assert sessions.page(1, 5) == ['session_2.json', 'session_3.json']
+    assert sessions.find('session_3.json') == 2 and sessions.find('session_4.json') == -1
+
+    # changes by others
+    (tmp_path / 'session_0.json').write_text('{}')
+    os.remove(tmp_path / 'session_2.json')
+    assert sessions.poll()
+    assert list(sessions) == ['session_0.json', 'session_1.json', 'session_3.json']
+
+    # navigating back to it before its first message: empty, not an error
+    session = sessions.read('session_3.json', meta={'model': 'm'})
+    assert session.name == 'session_3.json' and session.meta == {'model': 'm'} and not session.messages
+    with pytest.raises(FileNotFoundError):
+        sessions.read('session_2.json')
+    (tmp_path / 'session_3.json').write_bytes(Session('session_3.json', messages=[{'role': 'user', 'content': 'hi'}]).encode())
+    assert sessions.read('session_3.json').messages[0]['content'] == 'hi'
+
+    sessions.discard('session_3.json')
+    assert len(sessions) == 2
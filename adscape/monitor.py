@@ -0,0 +1,144 @@
+import time
+import pathlib
+import threading
+
+from .capture import MultiCapture, AdaptiveInterval
+from .detect import AdDetector, SignatureLibrary
+from .trace import tracer
+
+
+# Headless part of the background monitor: capture loop and ad detection, no GUI
+# toolkit in scope. Findings are reported through callbacks (from the monitor
+# thread or a pipeline thread); the app builds its UI only once an event has to
+# be shown (see main_backgroud_event.py). The detector process pool is imported
+# and started with the first changed frame, not at import. The last changed
+# frames are kept in a shared memory ring (see adscape.ring): detector workers
+# read their crops from it and events are exported with the frames around them.
+
+
+class Monitor():
+    """Watches `regions` (see MultiCapture) for the ads of `library`.
+
+    Changed crops go to `workers` detector processes, or with 0 workers are
+    detected in the capture loop. `on_event(detections)` is called for a frame
+    with an ad, `on_clear(detections, box)` for a detected crop without, `box` its
+    position (x, y, w, h) in desktop pixels.
+
+    `history` changed frames are kept (`capture.ring`, about 8MB per full HD frame).
+    With an `evidence_dir`, the frames of an event, from `evidence_seconds[0]` before it
+    to `evidence_seconds[1]` after, are exported there (see EvidenceExporter).
+    """
+
+    def __init__(self, library, regions=None, workers=2, on_event=None, on_clear=None, history=8,
+                 evidence_dir=None, evidence_seconds=(3.0, 1.0)) -> None:
+        self.library = library
+        self.workers = workers
+        self.on_event = on_event
+        self.on_clear = on_clear
+        self.evidence_dir = evidence_dir
+        self.evidence_seconds = evidence_seconds
+        self.exporter = None
+        self.capture = MultiCapture(regions, history=history)
+        self.detector = AdDetector(library) if workers == 0 else None
+        self.interval = AdaptiveInterval()
+        self.pipeline = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    @classmethod
+    def from_file(cls, signatures_file, **kwargs):
+        """Monitor of the signatures precomputed in `signatures_file`"""
+        signatures_file = pathlib.Path(signatures_file)
+        if not signatures_file.exists():
+            # without signatures no ad would ever be found: not a silent empty library
+            raise FileNotFoundError(f'Missing ad signatures {signatures_file}, built with: '
+                                    f'python -m adscape.detect build {signatures_file} <creatives_dir> <badges_dir>')
+        return cls(SignatureLibrary.load(signatures_file), **kwargs)
+
+    def start(self):
+        """Run the capture loop in a daemon thread"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self.run, daemon=True, name='monitor')
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+        if self.pipeline is not None:
+            self.pipeline.close()
+            self.pipeline = None
+        if self.exporter is not None:
+            self.exporter.close()
+            self.exporter = None
+        self.capture.close()
+
+    def run(self):
+        """Capture loop, until `stop`: polls faster while the screen changes, backs off when idle"""
+        while not self._stop.wait(self.interval.delay):
+            self.step()
+
+    def step(self):
+        """One iteration: grab the changed crops and detect (or submit) them, True if any"""
+        with tracer.span('monitor.iteration') as span:
+            start = time.perf_counter()
+            with tracer.span('capture.grab'):
+                crops = self.capture.grab_dirty()
+            self.interval.update(changed=bool(crops))
+            span.set(crops=len(crops))
+            if not crops:
+                return False
+            if self.workers > 0:
+                self._submit(crops, time.perf_counter() - start)
+            else:
+                self._detect(crops)
+            return True
+
+    def metrics(self):
+        """Pipeline metrics (queue depth, dropped frames, stage latencies), None while serial or not started"""
+        return self.pipeline.metrics() if self.pipeline is not None else None
+
+    def _detect(self, crops):
+        event = False
+        for crop in crops:
+            with tracer.span('detect', pixels=crop.frame.shape[0] * crop.frame.shape[1]):
+                detections = self.detector.detect(crop.frame)
+            if crop.box[:2] != (0, 0):
+                x, y = crop.box[:2]
+                detections = [d._replace(box=(d.box[0] + x, d.box[1] + y, d.box[2], d.box[3])) for d in detections]
+            if not AdDetector.is_ad(detections):
+                self._on_result(detections, (crop.monitor, crop.box))
+            elif not event:
+                event = True
+                self._on_event(detections)
+
+    def _submit(self, crops, capture_seconds):
+        if self.pipeline is None:
+            from .pipeline import FramePipeline
+            # first grab: every region is dirty and whole, slots fit the largest one
+            shape = (max(c.frame.shape[0] for c in crops), max(c.frame.shape[1] for c in crops), 4)
+            self.pipeline = FramePipeline(self.library, shape, workers=self.workers, ring=self.capture.ring,
+                                          on_result=self._on_result, on_event=self._on_event)
+        for crop in crops:
+            if crop.seq >= 0:
+                # read by the workers from the ring, not copied
+                self.pipeline.submit_ring(crop.seq, crop.box, capture_seconds=capture_seconds,
+                                          key=(crop.monitor, crop.box))
+            else:
+                self.pipeline.submit(crop.frame, capture_seconds=capture_seconds,
+                                     key=(crop.monitor, crop.box), origin=crop.box[:2])
+
+    def _on_result(self, detections, key):
+        # key: (monitor, box) of the crop
+        if not AdDetector.is_ad(detections) and self.on_clear:
+            self.on_clear(detections, key[1])
+
+    def _on_event(self, detections):
+        if self.evidence_dir is not None and self.capture.ring is not None:
+            if self.exporter is None:
+                from .ring import EvidenceExporter
+                self.exporter = EvidenceExporter(self.capture.ring, self.evidence_dir, *self.evidence_seconds)
+            self.exporter.export(detections)
+        if self.on_event:
+            self.on_event(detections)
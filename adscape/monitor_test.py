@@ -0,0 +1,90 @@
+import pytest
+from adscape.monitor import *
+from adscape.capture import Crop
+from adscape.alert import AlertState, ALERTING, HIDDEN
+from adscape.detect import load_image
+import adscape
+import pathlib
+import numpy as np
+
+screenshot = pathlib.Path(__file__).parent.parent / 'ss' / 'Screenshot - withads(sponsored).png'
+
+
+class FakeCapture():
+    def __init__(self, frames) -> None:
+        self.frames = list(frames)
+
+    def grab_dirty(self):
+        # frames (whole) or lists of crops
+        if not self.frames:
+            return []
+        frame = self.frames.pop(0)
+        if isinstance(frame, list):
+            return frame
+        return [Crop(1, (0, 0, frame.shape[1], frame.shape[0]), frame)]
+
+    def close(self):
+        pass
+
+
+def test_Monitor():
+    frame = load_image(screenshot)
+    library = SignatureLibrary()
+    library.add_badge(frame[231:242, 1514:1557], 'sponsored')
+    events, clears = [], []
+    monitor = Monitor(library, workers=0, on_event=events.append, on_clear=lambda d, box: clears.append(box))
+    monitor.capture = FakeCapture([np.zeros_like(frame), frame])
+    assert monitor.step() and not events and len(clears) == 1
+    assert monitor.step() and len(events) == 1 and AdDetector.is_ad(events[0])
+    # nothing changed: no detection, slower polling
+    delay = monitor.interval.delay
+    assert not monitor.step() and monitor.interval.delay > delay
+    assert monitor.metrics() is None and monitor.pipeline is None
+    monitor.stop()
+
+
+def test_Monitor_from_file(tmp_path):
+    signatures_file = tmp_path / 'signatures.npz'
+    with pytest.raises(FileNotFoundError, match='adscape.detect build'):
+        Monitor.from_file(signatures_file, workers=0)
+    library = SignatureLibrary()
+    library.add_badge(load_image(screenshot)[231:242, 1514:1557], 'sponsored')
+    library.save(signatures_file)
+    monitor = Monitor.from_file(signatures_file, workers=0)
+    assert len(monitor.library.badges) == 1
+    monitor.stop()
+
+
+def test_Monitor_alerts():
+    frame = load_image(screenshot)
+    library = SignatureLibrary()
+    library.add_badge(frame[231:242, 1514:1557], 'sponsored')
+    timers = []
+    alerts = AlertState(schedule=lambda delay, callback: timers.append(callback))
+    monitor = Monitor(library, workers=0, on_event=alerts.event, on_clear=lambda d, box: alerts.clear(box))
+
+    def crop(x, y, image):
+        return Crop(1, (x, y, 128, 128), image[y:y + 128, x:x + 128])
+
+    blank = np.zeros_like(frame)
+    changing = frame.copy()
+    monitor.capture = FakeCapture([[crop(1472, 200, frame)]] + [[crop(1472, 400, changing)]] * 3
+                                  + [[crop(1472, 400, changing), crop(1472, 200, blank)]])
+    monitor.step()
+    assert alerts.state == ALERTING and alerts.boxes
+    # the ad tile is unchanged (not captured), the tile below changes: still alerting
+    for _ in range(3):
+        changing[400:528, 1472:1600] ^= 0x55
+        monitor.step()
+    assert alerts.state == ALERTING and not timers
+    # the ad tile is captured again, without the ad
+    monitor.step()
+    timers.pop()()
+    assert alerts.state == HIDDEN
+    monitor.stop()
+
+
+def test_lazy_exports():
+    assert adscape.Monitor is Monitor and 'SessionStore' in dir(adscape)
+    with pytest.raises(AttributeError):
+        adscape.Nothing
@@ -0,0 +1,203 @@
+import json
+import time
+import random
+import hashlib
+import threading
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from .llm import estimate_tokens
+
+
+# Local stand-in for an Ollama server, for benchmarks and tests without a GPU:
+# /api/tags, /api/generate and /api/chat (streamed NDJSON or not), with simulated
+# model load time, prompt latency and token rate. Replies are made of words drawn
+# from a generator seeded by the request, so the same request gets the same reply.
+
+WORDS = ('the', 'window', 'size', 'kivy', 'layout', 'widget', 'event', 'screen', 'python', 'thread',
+         'cache', 'index', 'session', 'model', 'token', 'reply', 'format', 'list', 'value', 'file')
+
+
+class OllamaStub():
+    """Ollama-like HTTP server on a background thread.
+
+    `load_seconds` is spent on the first request for a model (a request without prompt
+    only loads it, as for Ollama), `latency` before the first token of every reply,
+    `token_seconds` between tokens. `requests` counts the calls per path, `max_in_flight`
+    is the most generations served at once.
+    """
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0.05, token_seconds=0.005, reply_tokens=64,
+                 load_seconds=0.2, models=('llama3:latest', 'mistral:latest')) -> None:
+        self.latency = latency
+        self.token_seconds = token_seconds
+        self.reply_tokens = reply_tokens
+        self.load_seconds = load_seconds
+        self.models = list(models)
+        self.loaded: set[str] = set()
+        self.requests: dict[str, int] = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), _Handler)
+        self._server.daemon_threads = True
+        self._server.stub = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def tags(self):
+        return {'models': [{'name': name, 'model': name, 'size': 4 * 1024**3,
+                            'digest': hashlib.sha256(name.encode()).hexdigest()} for name in self.models]}
+
+    def reply(self, path, payload):
+        """Tokens of the reply, the prompt size (in tokens) and the load time spent"""
+        model = payload.get('model')
+        if model not in self.models and f'{model}:latest' not in self.models:
+            raise KeyError(f"model '{model}' not found")
+        load = 0.0
+        with self._lock:
+            if model not in self.loaded:
+                self.loaded.add(model)
+                load = self.load_seconds
+        time.sleep(load)
+        if path == '/api/chat':
+            prompt = '\n'.join(m.get('content', '') for m in payload.get('messages') or [])
+            empty = not payload.get('messages')
+        else:
+            prompt = (payload.get('system') or '') + (payload.get('prompt') or '')
+            empty = not payload.get('prompt')
+        if empty:
+            return [], 0, load
+        options = payload.get('options') or {}
+        rng = random.Random(json.dumps([model, prompt, options.get('seed')], sort_keys=True))
+        n_tokens = min(options.get('num_predict') or self.reply_tokens, self.reply_tokens)
+        tokens = [(' ' if i else '') + rng.choice(WORDS) for i in range(n_tokens)]
+        return tokens, estimate_tokens(prompt), load
+
+
+class _Handler(BaseHTTPRequestHandler):
+
+    protocol_version = 'HTTP/1.1'   # keep-alive, chunked streaming
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        stub = self.server.stub
+        self._count()
+        if self.path == '/api/tags':
+            self._send_json(200, stub.tags())
+        else:
+            self._send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        stub = self.server.stub
+        self._count()
+        payload = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))) or b'{}')
+        if self.path not in ('/api/generate', '/api/chat'):
+            self._send_json(404, {'error': 'not found'})
+            return
+        start = time.perf_counter_ns()
+        try:
+            tokens, prompt_tokens, load = stub.reply(self.path, payload)
+        except KeyError as e:
+            self._send_json(404, {'error': e.args[0]})
+            return
+        with stub._lock:
+            stub.in_flight += 1
+            stub.max_in_flight = max(stub.max_in_flight, stub.in_flight)
+        try:
+            self._generate(payload, tokens, prompt_tokens, load, start)
+        finally:
+            with stub._lock:
+                stub.in_flight -= 1
+
+    def _generate(self, payload, tokens, prompt_tokens, load, start):
+        stub = self.server.stub
+        loaded = time.perf_counter_ns()
+        time.sleep(stub.latency if tokens else 0.0)
+        prompt_done = time.perf_counter_ns()
+
+        def chunk(token):
+            if self.path == '/api/chat':
+                return {'model': payload['model'], 'message': {'role': 'assistant', 'content': token}, 'done': False}
+            return {'model': payload['model'], 'response': token, 'done': False}
+
+        def final():
+            end = time.perf_counter_ns()
+            done = {**chunk(''), 'done': True, 'done_reason': 'stop' if tokens else 'load',
+                    'total_duration': end - start, 'load_duration': int(load * 1e9),
+                    'prompt_eval_count': prompt_tokens, 'prompt_eval_duration': prompt_done - loaded,
+                    'eval_count': len(tokens), 'eval_duration': end - prompt_done}
+            if self.path == '/api/generate':
+                done['context'] = list(range(prompt_tokens + len(tokens)))
+            return done
+
+        if payload.get('stream', True):
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/x-ndjson')
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            try:
+                for token in tokens:
+                    time.sleep(stub.token_seconds)
+                    self._send_chunk(chunk(token))
+                self._send_chunk(final())
+                self.wfile.write(b'0\r\n\r\n')
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True   # client cancelled
+        else:
+            time.sleep(stub.token_seconds * len(tokens))
+            reply = final()
+            if self.path == '/api/chat':
+                reply['message']['content'] = ''.join(tokens)
+            else:
+                reply['response'] = ''.join(tokens)
+            self._send_json(200, reply)
+
+    def _count(self):
+        stub = self.server.stub
+        with stub._lock:
+            stub.requests[self.path] = stub.requests.get(self.path, 0) + 1
+
+    def _send_chunk(self, obj):
+        data = json.dumps(obj).encode() + b'\n'
+        self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+        self.wfile.flush()
+
+    def _send_json(self, status, obj):
+        data = json.dumps(obj).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+if __name__ == '__main__':
+    # python -m adscape.ollama_stub [port]: point the apps' ollama_url at it
+    import sys
+    with OllamaStub(port=int(sys.argv[1]) if len(sys.argv) > 1 else 11434) as stub:
+        print(f'Ollama stub on {stub.url}')
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
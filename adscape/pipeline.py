@@ -0,0 +1,276 @@
+import time
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+from typing import NamedTuple
+import numpy as np
+
+from .detect import AdDetector
+from .ring import FrameRing
+from .trace import tracer
+
+
+# Capture -> bounded frame queue (drop oldest) -> pool of detector processes.
+# Frames are copied once into slots of a shared memory block, workers read them
+# in place: only the slot offset and shape are sent, never the pixels. Frames
+# already in a FrameRing (see adscape.ring) are not copied at all: workers attach
+# the ring and read the crop by seq, a frame overwritten meanwhile is dropped.
+
+
+class StageStats():
+    """Count and latency (last, mean, max) of a pipeline stage"""
+
+    def __init__(self) -> None:
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.last = seconds
+        self.max = max(self.max, seconds)
+
+    def as_dict(self):
+        return {'count': self.count, 'last': self.last, 'max': self.max,
+                'mean': self.total / self.count if self.count else 0.0}
+
+
+class _Job(NamedTuple):
+    slot: int           # None for a ring frame
+    shape: tuple
+    key: object
+    origin: tuple
+    captured_at: float
+    queued_at: float
+    ring_seq: int = -1
+    box: tuple = None   # desktop box of the crop of the ring frame
+
+
+class FramePipeline():
+    """Detection of captured frames by `workers` processes.
+
+    `submit` never blocks the capture: when `depth` frames already wait, the oldest
+    one is dropped. Frames may be crops of any size up to `frame_shape`. `on_result(detections, key)` is called
+    (from a pool thread) for every detected frame, with the `key` it was submitted with, `on_event(detections)` at most once per `coalesce` seconds for
+    frames with ads, the latest ones winning.
+    """
+
+    def __init__(self, library, frame_shape, workers=2, depth=2, coalesce=1.0,
+                 on_result=None, on_event=None, detector_options=None, ring=None) -> None:
+        self.frame_shape = tuple(frame_shape)
+        self.slot_size = int(np.prod(self.frame_shape))
+        self.workers = workers
+        self.on_result = on_result
+        self.on_event = on_event
+        self.coalesce = coalesce
+        n_slots = depth + workers
+        self._shm = shared_memory.SharedMemory(create=True, size=self.slot_size * n_slots)
+        self._free = list(range(n_slots))
+        self._pending: deque = deque()
+        self._depth = depth
+        self._in_flight = 0
+        self._lock = threading.Condition()
+        self._closed = False
+        self.ring = ring
+        self._pool = ProcessPoolExecutor(workers, initializer=_init_worker,
+                                         initargs=(library, detector_options or {}, ring.spec if ring else None))
+        self.dropped = 0
+        self.errors = 0         # frames whose detection raised in a worker
+        self.last_error = None
+        self.stats = {'capture': StageStats(), 'queue': StageStats(), 'detect': StageStats(),
+                      'total': StageStats()}
+        self._last_event = 0.0
+        self._event_timer = None
+        self._event_detections = None
+        self._dispatcher = threading.Thread(target=self._dispatch_loop, daemon=True)
+        self._dispatcher.start()
+
+    def submit(self, frame, captured_at=None, capture_seconds=None, key=None, origin=(0, 0)):
+        """Copy a frame into a free slot and queue it, dropping the oldest waiting frame if needed.
+
+        `frame` is a raw buffer of `frame_shape` or an array (a crop) no larger than it.
+        A waiting frame with the same `key` (e.g. the same screen region) is superseded.
+        Detection boxes are shifted by `origin` (x, y), the crop position.
+        """
+        now = time.perf_counter()
+        if capture_seconds is not None:
+            self.stats['capture'].add(capture_seconds)
+        if isinstance(frame, np.ndarray):
+            shape = frame.shape
+        else:
+            shape = self.frame_shape
+            frame = np.frombuffer(frame, dtype=np.uint8).reshape(shape)
+        if frame.nbytes > self.slot_size:
+            raise ValueError(f'frame {shape} larger than the pipeline slots {self.frame_shape}')
+        with self._lock:
+            if self._closed:
+                return
+            if key is not None:
+                self._drop(lambda job: job.key == key)
+            if not self._free:
+                # all slots busy: waiting queue is full, recycle the oldest frame
+                self._drop(lambda job: True)
+            slot = self._free.pop()
+        view = np.ndarray(shape, dtype=np.uint8, buffer=self._shm.buf, offset=slot * self.slot_size)
+        view[...] = frame
+        with self._lock:
+            self._pending.append(_Job(slot, shape, key, origin, captured_at or now, now))
+            while len(self._pending) > self._depth:
+                self._drop(lambda job: True)
+            self._lock.notify()
+
+    def submit_ring(self, seq, box, captured_at=None, capture_seconds=None, key=None):
+        """Queue the crop `box` (desktop pixels) of the frame `seq` of the pipeline's ring,
+        no copy. Detection boxes are shifted to desktop pixels"""
+        now = time.perf_counter()
+        if capture_seconds is not None:
+            self.stats['capture'].add(capture_seconds)
+        with self._lock:
+            if self._closed:
+                return
+            if key is not None:
+                self._drop(lambda job: job.key == key)
+            self._pending.append(_Job(None, (box[3], box[2]), key, tuple(box[:2]), captured_at or now, now,
+                                      seq, tuple(box)))
+            while len(self._pending) > self._depth:
+                self._drop(lambda job: True)
+            self._lock.notify()
+
+    def _drop(self, which):
+        # called with the lock held: recycle the slot of the first waiting frame matching `which`
+        for job in self._pending:
+            if which(job):
+                self._pending.remove(job)
+                if job.slot is not None:
+                    self._free.append(job.slot)
+                self.dropped += 1
+                return
+
+    def queue_depth(self):
+        with self._lock:
+            return len(self._pending)
+
+    def metrics(self):
+        with self._lock:
+            return {'queue_depth': len(self._pending), 'in_flight': self._in_flight, 'dropped': self.dropped,
+                    'errors': self.errors, 'last_error': self.last_error, **{name: s.as_dict() for name, s in self.stats.items()}}
+
+    def close(self):
+        with self._lock:
+            self._closed = True
+            self._lock.notify()
+        self._dispatcher.join()
+        self._pool.shutdown(wait=True, cancel_futures=True)
+        if self._event_timer is not None:
+            self._event_timer.cancel()
+        self._shm.close()
+        self._shm.unlink()
+
+    def _dispatch_loop(self):
+        while True:
+            with self._lock:
+                while not self._closed and (not self._pending or self._in_flight >= self.workers):
+                    self._lock.wait()
+                if self._closed:
+                    return
+                job = self._pending.popleft()
+                self._in_flight += 1
+            started = time.perf_counter()
+            self.stats['queue'].add(started - job.queued_at)
+            if job.slot is None:
+                future = self._pool.submit(_detect_ring, job.ring_seq, job.box)
+            else:
+                future = self._pool.submit(_detect_slot, self._shm.name, job.slot * self.slot_size, job.shape)
+            future.add_done_callback(lambda f, job=job: self._done(f, job))
+
+    def _done(self, future, job):
+        with self._lock:
+            self._in_flight -= 1
+            if job.slot is not None:
+                self._free.append(job.slot)
+            self._lock.notify()
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is not None:
+            # not reported as a frame without ads
+            with self._lock:
+                self.errors += 1
+                self.last_error = repr(error)
+            tracer.count('pipeline.errors')
+            return
+        detections, seconds = future.result()
+        if detections is None:
+            # ring frame overwritten before it was detected
+            with self._lock:
+                self.dropped += 1
+            return
+        if job.origin != (0, 0):
+            ox, oy = job.origin
+            detections = [d._replace(box=(d.box[0] + ox, d.box[1] + oy, d.box[2], d.box[3])) for d in detections]
+        self.stats['detect'].add(seconds)
+        self.stats['total'].add(time.perf_counter() - job.captured_at)
+        if self.on_result:
+            self.on_result(detections, job.key)
+        if self.on_event and AdDetector.is_ad(detections):
+            self._coalesce_event(detections)
+
+    def _coalesce_event(self, detections):
+        with self._lock:
+            self._event_detections = detections
+            wait = self._last_event + self.coalesce - time.monotonic()
+            if self._event_timer is not None:
+                return      # a flush is already scheduled, it will send the latest detections
+            if wait > 0:
+                self._event_timer = threading.Timer(wait, self._flush_event)
+                self._event_timer.daemon = True
+                self._event_timer.start()
+                return
+        self._flush_event()
+
+    def _flush_event(self):
+        with self._lock:
+            detections, self._event_detections = self._event_detections, None
+            self._event_timer = None
+            self._last_event = time.monotonic()
+        if detections is not None:
+            self.on_event(detections)
+
+
+# worker process side
+
+_worker = {}
+
+
+def _init_worker(library, options, ring_spec=None):
+    _worker['detector'] = AdDetector(library, **options)
+    _worker['shm'] = {}
+    _worker['ring'] = FrameRing.attach(ring_spec) if ring_spec else None
+
+
+def _detect_slot(shm_name, offset, shape):
+    shm = _worker['shm'].get(shm_name)
+    if shm is None:
+        # pool processes share the resource tracker of the capture process, which owns (unlinks) the block
+        shm = shared_memory.SharedMemory(name=shm_name)
+        _worker['shm'][shm_name] = shm
+    frame = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=offset)
+    start = time.perf_counter()
+    detections = _worker['detector'].detect(frame)
+    return detections, time.perf_counter() - start
+
+
+def _detect_ring(seq, box):
+    ring = _worker['ring']
+    found = ring.get(seq)
+    if found is None:
+        return None, 0.0
+    x, y, w, h = box[0] - found.origin[0], box[1] - found.origin[1], box[2], box[3]
+    start = time.perf_counter()
+    detections = _worker['detector'].detect(found.frame[y:y + h, x:x + w])
+    seconds = time.perf_counter() - start
+    # read while being overwritten: not a frame that was captured
+    return (detections if ring.valid(seq) else None), seconds
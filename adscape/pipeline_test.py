@@ -0,0 +1,76 @@
+import pytest
+from adscape.pipeline import *
+from adscape.detect import SignatureLibrary, load_image
+import pathlib
+import threading
+import time
+
+screenshot = pathlib.Path(__file__).parent.parent / 'ss' / 'Screenshot - withads(sponsored).png'
+
+
+def test_FramePipeline():
+    frame = load_image(screenshot)
+    library = SignatureLibrary()
+    library.add_badge(frame[231:242, 1514:1557], 'sponsored')
+    blank = np.zeros_like(frame)
+
+    results, events = [], []
+    done = threading.Semaphore(0)
+    pipeline = FramePipeline(library, frame.shape, workers=1, depth=1, coalesce=60,
+                             on_result=lambda d, key: (results.append(d), done.release()),
+                             on_event=events.append)
+    try:
+        pipeline.submit(frame.tobytes(), capture_seconds=0.01)
+        assert done.acquire(timeout=60)
+        # while the worker is busy, only the latest waiting frame is kept
+        for f in (blank, blank, frame, blank):
+            pipeline.submit(f.tobytes())
+        assert pipeline.queue_depth() <= 1
+        while pipeline.metrics()['detect']['count'] + pipeline.dropped < 5:
+            assert done.acquire(timeout=60)
+
+        assert any(d.kind == 'badge' for d in results[0])
+        # ads in several frames within `coalesce` make a single notification
+        assert len(events) == 1
+        metrics = pipeline.metrics()
+        assert metrics['dropped'] >= 1
+        assert metrics['capture']['count'] == 1 and metrics['detect']['max'] > 0
+    finally:
+        pipeline.close()
+
+
+def test_FramePipeline_crops():
+    frame = load_image(screenshot)
+    library = SignatureLibrary()
+    library.add_badge(frame[231:242, 1514:1557], 'sponsored')
+
+    results = []
+    done = threading.Semaphore(0)
+    pipeline = FramePipeline(library, (256, 256, 4), workers=1,
+                             on_result=lambda d, key: (results.append(d), done.release()))
+    try:
+        with pytest.raises(ValueError):
+            pipeline.submit(frame)
+        pipeline.submit(frame[200:328, 1472:1600], key='side', origin=(1472, 200))
+        assert done.acquire(timeout=60)
+        # boxes in frame coordinates
+        x, y, w, h = next(d for d in results[0] if d.kind == 'badge').box
+        assert abs(x - 1514) <= 2 and abs(y - 231) <= 2
+    finally:
+        pipeline.close()
+
+
+def test_FramePipeline_errors():
+    results = []
+    pipeline = FramePipeline(SignatureLibrary(), (64, 64, 4), workers=1, on_result=lambda d, key: results.append(d))
+    try:
+        # no ring attached to the workers: the detection raises
+        pipeline.submit_ring(0, (0, 0, 64, 64))
+        deadline = time.monotonic() + 60
+        while pipeline.errors == 0 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        metrics = pipeline.metrics()
+        assert metrics['errors'] == 1 and 'AttributeError' in metrics['last_error']
+        assert not results and metrics['detect']['count'] == 0
+    finally:
+        pipeline.close()
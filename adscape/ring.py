@@ -0,0 +1,209 @@
+import io
+import os
+import json
+import time
+import queue
+import pathlib
+import zipfile
+import threading
+from datetime import datetime
+from multiprocessing import shared_memory
+from typing import NamedTuple
+import numpy as np
+
+from .trace import tracer
+
+
+# Ring buffer of the last captured frames in shared memory, for detection
+# lookback and the evidence of an event (the frames around it). Slots are
+# preallocated: a frame is copied in place (no allocation per frame) and read as
+# a NumPy view over the block, from this process or from another one attached by
+# name (detector workers). Each slot has a meta record whose seq is -1 while the
+# slot is written: readers check the seq before and after using a view (seqlock).
+
+META = np.dtype([('seq', '<i8'), ('time', '<f8'), ('height', '<u4'), ('width', '<u4'),
+                 ('monitor', '<u4'), ('left', '<i4'), ('top', '<i4'), ('_pad', '<u4')])
+
+
+class RingFrame(NamedTuple):
+    seq: int
+    time: float             # time.time() of the capture
+    monitor: int
+    origin: tuple           # desktop position (x, y) of the frame
+    frame: np.ndarray       # view over the ring slot, valid while FrameRing.valid(seq)
+
+
+class FrameRing():
+    """The last `capacity` frames, each up to `frame_shape` (uint8, same channels), in a
+    shared memory block. `push` is thread safe as long as fewer than `capacity` pushes
+    run at once. Another process reads the ring with `FrameRing.attach(ring.spec)`.
+    """
+
+    def __init__(self, frame_shape, capacity=8, name=None) -> None:
+        self.frame_shape = tuple(frame_shape)
+        self.capacity = capacity
+        self.slot_size = int(np.prod(self.frame_shape))
+        self._frames_offset = -(-(8 + META.itemsize * capacity) // 64) * 64
+        self.owner = name is None
+        self._shm = shared_memory.SharedMemory(name=name, create=self.owner,
+                                               size=self._frames_offset + self.slot_size * capacity if self.owner else 0)
+        self._next = np.ndarray((1,), '<i8', buffer=self._shm.buf)
+        self.meta = np.ndarray((capacity,), META, buffer=self._shm.buf, offset=8)
+        if self.owner:
+            self._next[0] = 0
+            self.meta['seq'] = -1
+        self._lock = threading.Lock()
+
+    @property
+    def spec(self):
+        """(name, frame_shape, capacity), picklable: what `attach` needs"""
+        return self._shm.name, self.frame_shape, self.capacity
+
+    @classmethod
+    def attach(cls, spec):
+        name, frame_shape, capacity = spec
+        return cls(frame_shape, capacity, name=name)
+
+    def push(self, frame, monitor=0, origin=(0, 0), captured_at=None):
+        """Copy `frame` into the oldest slot, return its seq"""
+        if frame.shape[2:] != self.frame_shape[2:] or frame.shape[0] > self.frame_shape[0] \
+                or frame.shape[1] > self.frame_shape[1]:
+            raise ValueError(f'frame {frame.shape} does not fit the ring slots {self.frame_shape}')
+        with self._lock:
+            seq = int(self._next[0])
+            self._next[0] = seq + 1
+            slot = seq % self.capacity
+            self.meta['seq'][slot] = -1
+        np.copyto(self._view(slot, frame.shape), frame)
+        record = self.meta[slot:slot + 1]
+        record['time'] = captured_at if captured_at is not None else time.time()
+        record['height'], record['width'] = frame.shape[:2]
+        record['monitor'] = monitor
+        record['left'], record['top'] = origin
+        # published last
+        record['seq'] = seq
+        return seq
+
+    def get(self, seq):
+        """RingFrame of `seq`, None if overwritten (or being written)"""
+        slot = seq % self.capacity
+        record = self.meta[slot]
+        if seq < 0 or record['seq'] != seq:
+            return None
+        shape = (int(record['height']), int(record['width'])) + self.frame_shape[2:]
+        frame = RingFrame(seq, float(record['time']), int(record['monitor']),
+                          (int(record['left']), int(record['top'])), self._view(slot, shape))
+        return frame if self.valid(seq) else None
+
+    def valid(self, seq):
+        return seq >= 0 and self.meta['seq'][seq % self.capacity] == seq
+
+    @property
+    def last_seq(self):
+        """seq of the last pushed frame, -1 if none"""
+        return int(self._next[0]) - 1
+
+    def frames(self):
+        """The frames in the ring, oldest first (views)"""
+        last = self.last_seq
+        found = (self.get(seq) for seq in range(max(0, last - self.capacity + 1), last + 1))
+        return [frame for frame in found if frame is not None]
+
+    def snapshot(self, start, end):
+        """Copies of the frames captured between `start` and `end` (time.time()), oldest first"""
+        copies = []
+        for frame in self.frames():
+            if start <= frame.time <= end:
+                copy = frame.frame.copy()
+                if self.valid(frame.seq):
+                    copies.append(frame._replace(frame=copy))
+        return copies
+
+    def close(self):
+        """Detach, and for the creating process free the block"""
+        self._next = self.meta = None
+        try:
+            self._shm.close()
+        except BufferError:
+            pass    # views still held by the caller, unmapped when they are collected
+        if self.owner:
+            self._shm.unlink()
+
+    def _view(self, slot, shape):
+        return np.ndarray(shape, dtype=np.uint8, buffer=self._shm.buf,
+                          offset=self._frames_offset + slot * self.slot_size)
+
+
+class EvidenceExporter():
+    """Writes the frames of `ring` captured around detection events, from `before` seconds
+    before the event to `after` seconds after, to a zip per event in `directory`: PNG frames
+    (RGB) and `event.json` (detections, frames meta). Runs in a background thread, failed
+    exports are counted in `errors` (and `evidence.errors` of the tracer).
+    """
+
+    def __init__(self, ring, directory, before=3.0, after=1.0, compress_level=6) -> None:
+        self.ring = ring
+        self.directory = pathlib.Path(directory)
+        self.before = before
+        self.after = after
+        self.compress_level = compress_level
+        self.exported: list[pathlib.Path] = []
+        self.errors = 0
+        self.last_error = None
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._export_loop, daemon=True, name='evidence')
+        self._thread.start()
+
+    def export(self, detections, at=None):
+        """Queue the export of the frames around an event at time `at` (default now)"""
+        self._queue.put((at if at is not None else time.time(), list(detections)))
+
+    def close(self):
+        """Finish the queued exports"""
+        self._queue.put(None)
+        self._thread.join()
+
+    def _export_loop(self):
+        while (job := self._queue.get()) is not None:
+            at, detections = job
+            # frames captured after the event are in the ring `after` seconds later
+            time.sleep(max(0.0, at + self.after - time.time()))
+            try:
+                self._write(at, detections)
+            except Exception as e:
+                # the next events are still exported
+                self.errors += 1
+                self.last_error = repr(e)
+                tracer.count('evidence.errors')
+
+    def _write(self, at, detections):
+        from PIL import Image
+        with tracer.span('evidence.export') as span:
+            frames = self.ring.snapshot(at - self.before, at + self.after)
+            span.set(frames=len(frames))
+            self.directory.mkdir(parents=True, exist_ok=True)
+            stamp = datetime.fromtimestamp(at).strftime('%Y%m%d_%H%M%S_%f')[:-3]
+            path = self.directory / f'evidence_{stamp}.zip'
+            tmp_path = path.with_name(path.name + '.tmp')
+            event = {'time': at, 'detections': [d._asdict() if hasattr(d, '_asdict') else d for d in detections],
+                     'frames': []}
+            # PNG is compressed already: members are stored
+            with zipfile.ZipFile(tmp_path, 'w', zipfile.ZIP_STORED) as z_f:
+                for f in frames:
+                    name = f'frame_{f.seq:08d}_m{f.monitor}.png'
+                    png = io.BytesIO()
+                    Image.fromarray(np.ascontiguousarray(f.frame[..., 2::-1])).save(
+                        png, 'PNG', compress_level=self.compress_level)
+                    z_f.writestr(name, png.getvalue())
+                    event['frames'].append({'name': name, 'seq': f.seq, 'time': f.time, 'monitor': f.monitor,
+                                            'origin': f.origin})
+                z_f.writestr('event.json', json.dumps(event, indent=1, default=_json_value),
+                             compress_type=zipfile.ZIP_DEFLATED)
+            os.replace(tmp_path, path)
+            self.exported.append(path)
+            return path
+
+
+def _json_value(value):
+    # numpy scalars of the detections
+    return value.item() if hasattr(value, 'item') else str(value)
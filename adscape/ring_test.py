@@ -0,0 +1,95 @@
+import pytest
+from adscape.ring import *
+from adscape.pipeline import FramePipeline
+from adscape.detect import SignatureLibrary, load_image
+import json
+import pathlib
+import threading
+import time
+import zipfile
+
+screenshot = pathlib.Path(__file__).parent.parent / 'ss' / 'Screenshot - withads(sponsored).png'
+
+
+def test_FrameRing():
+    ring = FrameRing((20, 30, 4), capacity=3)
+    try:
+        assert ring.last_seq == -1 and ring.frames() == [] and ring.get(0) is None
+        with pytest.raises(ValueError):
+            ring.push(np.zeros((40, 30, 4), dtype=np.uint8))
+        seqs = [ring.push(np.full((10, 20, 4), i, dtype=np.uint8), monitor=2, origin=(5, 7), captured_at=100.0 + i)
+                for i in range(4)]
+        assert seqs == [0, 1, 2, 3] and ring.last_seq == 3
+        # the first frame was overwritten by the fourth
+        assert not ring.valid(0) and ring.get(0) is None
+        frame = ring.get(3)
+        assert frame.frame.shape == (10, 20, 4) and (frame.frame == 3).all()
+        assert frame.monitor == 2 and frame.origin == (5, 7) and frame.time == 103.0
+        assert [f.seq for f in ring.frames()] == [1, 2, 3]
+
+        # attached by name: the same frames, no copy
+        other = FrameRing.attach(ring.spec)
+        assert (other.get(2).frame == 2).all()
+        ring.push(np.full((10, 20, 4), 9, dtype=np.uint8))
+        assert (other.get(4).frame == 9).all()
+        del frame
+        other.close()
+
+        copies = ring.snapshot(102.0, 103.5)
+        assert [f.seq for f in copies] == [2, 3]
+        ring.push(np.zeros((10, 20, 4), dtype=np.uint8))
+        assert (copies[1].frame == 3).all()
+    finally:
+        ring.close()
+
+
+def test_EvidenceExporter(tmp_path):
+    ring = FrameRing((8, 8, 4), capacity=4)
+    try:
+        for i in range(4):
+            ring.push(np.full((8, 8, 4), i * 10, dtype=np.uint8), captured_at=100.0 + i)
+        exporter = EvidenceExporter(ring, tmp_path, before=1.5, after=0)
+        exporter.export([{'kind': 'badge', 'score': np.float32(0.5)}], at=103.0)
+        exporter.close()
+        [path] = exporter.exported
+        with zipfile.ZipFile(path) as z_f:
+            event = json.loads(z_f.read('event.json'))
+            assert [f['seq'] for f in event['frames']] == [2, 3]
+            assert event['detections'] == [{'kind': 'badge', 'score': 0.5}]
+            assert sorted(z_f.namelist()) == sorted(['event.json'] + [f['name'] for f in event['frames']])
+        assert list(tmp_path.iterdir()) == [path]
+
+        # a failed export is counted, the next ones still run
+        exporter = EvidenceExporter(ring, tmp_path / 'failing', before=1.5, after=0)
+        snapshot, ring.snapshot = ring.snapshot, lambda start, end: 1 / 0
+        exporter.export([], at=103.0)
+        while not exporter.errors:
+            time.sleep(0.01)
+        ring.snapshot = snapshot
+        exporter.export([], at=103.0)
+        exporter.close()
+        assert exporter.errors == 1 and 'ZeroDivisionError' in exporter.last_error and len(exporter.exported) == 1
+    finally:
+        ring.close()
+
+
+def test_FramePipeline_ring():
+    frame = load_image(screenshot)
+    library = SignatureLibrary()
+    library.add_badge(frame[231:242, 1514:1557], 'sponsored')
+    ring = FrameRing(frame.shape, capacity=2)
+
+    results = []
+    done = threading.Semaphore(0)
+    pipeline = FramePipeline(library, (256, 256, 4), workers=1, ring=ring,
+                             on_result=lambda d, key: (results.append(d), done.release()))
+    try:
+        # the frame of a monitor at (1000, 0): crops and boxes in desktop pixels
+        seq = ring.push(frame, 1, (1000, 0))
+        pipeline.submit_ring(seq, (2472, 200, 128, 128))
+        assert done.acquire(timeout=60)
+        x, y, w, h = next(d for d in results[0] if d.kind == 'badge').box
+        assert abs(x - 2514) <= 2 and abs(y - 231) <= 2
+    finally:
+        pipeline.close()
+        ring.close()
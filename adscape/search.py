@@ -0,0 +1,98 @@
+import re
+import pathlib
+import sqlite3
+from typing import NamedTuple
+
+
+class SearchHit(NamedTuple):
+    name: str
+    score: float        # bm25, lower is better
+    snippet: str
+
+
+class SessionSearch():
+    """Full-text index of sessions (questions, answers and meta), a SQLite FTS5
+    sidecar of the archive.
+
+    Sessions are added (or replaced, by name) one transaction per batch; like the
+    SessionIndex it records the size of the archive (of each segment) it is valid for. Hits are ranked by
+    bm25, questions weighing more than answers and meta (model, dates..) less.
+    """
+
+    WEIGHTS = (2.0, 1.0, 0.5)   # questions, answers, meta
+
+    def __init__(self, index_file) -> None:
+        self.index_file = pathlib.Path(index_file)
+        self._db = sqlite3.connect(self.index_file)
+        self._db.execute('PRAGMA synchronous=NORMAL')
+        with self._db:
+            new = self._db.execute("SELECT 1 FROM sqlite_master WHERE name='docs'").fetchone() is None
+            # docs rowid is the id of the session name (FTS5 columns have no index to look a name up)
+            self._db.execute('CREATE TABLE IF NOT EXISTS names (id INTEGER PRIMARY KEY, name TEXT UNIQUE)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value)')
+            self._db.execute("CREATE VIRTUAL TABLE IF NOT EXISTS docs USING fts5(questions, answers, meta, "
+                             "tokenize='unicode61 remove_diacritics 2')")
+            if new:
+                self._db.execute("INSERT INTO docs(docs, rank) VALUES ('rank', ?)",
+                                 ('bm25({})'.format(', '.join(map(str, self.WEIGHTS))),))
+
+    def __len__(self):
+        return self._db.execute('SELECT count(*) FROM names').fetchone()[0]
+
+    def close(self):
+        self._db.close()
+
+    def is_valid_for(self, archive_file):
+        row = self._db.execute('SELECT value FROM state WHERE key = ?', (f'size:{archive_file.name}',)).fetchone()
+        return row is not None and archive_file.exists() and archive_file.stat().st_size == row[0]
+
+    def add(self, sessions, archive_file=None):
+        """Index (name, session) pairs, replacing sessions already indexed under the same name,
+        then record the size of `archive_file` they were written to"""
+        with self._db:
+            for name, session in sessions:
+                self._add(name, session)
+            if archive_file is not None:
+                self._set_archive_size(archive_file)
+
+    def rebuild(self, sessions, archive_files):
+        """Index all the (name, session) of the archives from scratch"""
+        with self._db:
+            self._db.execute('DELETE FROM names')
+            self._db.execute('DELETE FROM docs')
+            self._db.execute('DELETE FROM state')
+            for name, session in sessions:
+                self._add(name, session)
+            for archive_file in archive_files:
+                self._set_archive_size(archive_file)
+
+    def search(self, query, limit=20):
+        """Best `limit` hits for the words of `query`, all required (the last one as a prefix)"""
+        match = self.match_expression(query)
+        if match is None:
+            return []
+        rows = self._db.execute(
+            "SELECT names.name, docs.rank, snippet(docs, -1, '**', '**', '...', 12) FROM docs "
+            'JOIN names ON names.id = docs.rowid WHERE docs MATCH ? ORDER BY docs.rank LIMIT ?', (match, limit))
+        return [SearchHit(*row) for row in rows]
+
+    @staticmethod
+    def match_expression(query):
+        # words only, quoted: user input never reaches the FTS5 query syntax
+        words = re.findall(r'\w+', query)
+        if not words:
+            return None
+        return ' '.join(f'"{w}"' for w in words) + '*'
+
+    def _add(self, name, session):
+        self._db.execute('INSERT OR IGNORE INTO names (name) VALUES (?)', (name,))
+        doc_id = self._db.execute('SELECT id FROM names WHERE name = ?', (name,)).fetchone()[0]
+        self._db.execute('DELETE FROM docs WHERE rowid = ?', (doc_id,))
+        meta = ' '.join([name] + [f'{k} {v}' for k, v in (session.meta or {}).items()])
+        self._db.execute('INSERT INTO docs (rowid, questions, answers, meta) VALUES (?, ?, ?, ?)',
+                         (doc_id, '\n'.join(map(str, session.questions or [])),
+                          '\n'.join(map(str, session.answers or [])), meta))
+
+    def _set_archive_size(self, archive_file):
+        self._db.execute('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)',
+                         (f'size:{archive_file.name}', archive_file.stat().st_size))
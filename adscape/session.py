@@ -0,0 +1,322 @@
+import sys
+import json
+import struct
+from array import array
+from datetime import datetime
+
+
+# The one session model of the store and the LLM apps: a name, a meta dict and
+# the messages. Messages are kept in a MessageStore: role ids and end offsets in
+# arrays, bodies utf-8 encoded one after the other in a single buffer and decoded
+# only when read: no per-message objects while a session is just held (cache,
+# prefetch) and no decoding of the messages that are never shown.
+#
+# The binary encoding is that layout as is, so decoding (e.g. an archive member)
+# parses a small header and takes views over the rest of the buffer, no copy:
+#   header     <4sHHIIQ: magic, version, flags, count, head size, body size
+#   head       json: name, meta, roles table, extra fields of the messages by position
+#   role ids   uint16 * count, padded to 8 bytes
+#   ends       uint64 * count, end offset of each body
+#   bodies
+# JSON stays the export/import format (and the one of the live session files).
+# Older shapes are imported too: the questions/answers lists of the archive, the
+# `messages` of LLMApp and the `conversation` of ConversationApp.
+
+
+class Message():
+    """A message: role ('user', 'assistant'), content and extra fields (model, latency..).
+    Also read like the dicts the apps used to store: `message['role']`, `message.get('fanout')`"""
+
+    __slots__ = ('role', 'content', 'extra')
+
+    def __init__(self, role, content, extra=None) -> None:
+        self.role = role
+        self.content = content
+        self.extra = extra
+
+    def __getitem__(self, key):
+        if key == 'role':
+            return self.role
+        if key == 'content':
+            return self.content
+        if self.extra and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self):
+        return {'role': self.role, 'content': self.content, **(self.extra or {})}
+
+    def __eq__(self, other):
+        if isinstance(other, Message):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return f'Message({self.to_dict()!r})'
+
+
+class MessageStore():
+    """Sequence of messages, array-backed (see above). Indexing decodes one message,
+    `append` takes a Message or a dict. A store decoded from a buffer is a view over
+    it until the first append (then copied)."""
+
+    def __init__(self, messages=()) -> None:
+        self.roles: list[str] = []
+        self._role_ids = array('H')
+        self._ends = array('Q')
+        self._body = bytearray()
+        self._extras: dict[int, dict] = {}
+        for message in messages:
+            self.append(message)
+
+    @classmethod
+    def from_buffers(cls, roles, role_ids, ends, body, extras):
+        store = cls.__new__(cls)
+        store.roles = roles
+        store._role_ids = role_ids
+        store._ends = ends
+        store._body = body
+        store._extras = extras
+        return store
+
+    def __len__(self):
+        return len(self._ends)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self[j] for j in range(*i.indices(len(self)))]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        return Message(self.role(i), self.content(i), self._extras.get(i))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __eq__(self, other):
+        try:
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        except TypeError:
+            return NotImplemented
+
+    def role(self, i):
+        return self.roles[self._role_ids[i]]
+
+    def content(self, i):
+        start = self._ends[i - 1] if i else 0
+        return str(self._body[start:self._ends[i]], 'utf-8')
+
+    def contents(self, role):
+        """Contents of the messages of `role`, the others not decoded"""
+        if role not in self.roles:
+            return []
+        role_id = self.roles.index(role)
+        return [self.content(i) for i in range(len(self)) if self._role_ids[i] == role_id]
+
+    @property
+    def nbytes(self):
+        return len(self._body) + len(self._ends) * 8 + len(self._role_ids) * 2
+
+    def append(self, message):
+        if isinstance(message, Message):
+            role, content, extra = message.role, message.content, dict(message.extra or {})
+        else:
+            extra = dict(message)
+            role, content = extra.pop('role'), extra.pop('content')
+        if not isinstance(self._body, bytearray):
+            self._thaw()
+        if role not in self.roles:
+            self.roles.append(role)
+        self._body += str(content).encode('utf-8')
+        self._role_ids.append(self.roles.index(role))
+        self._ends.append(len(self._body))
+        if extra:
+            self._extras[len(self._ends) - 1] = extra
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+    def _thaw(self):
+        # views over a decoded buffer: copied to growable arrays
+        self._role_ids = array('H', self._role_ids)
+        self._ends = array('Q', self._ends)
+        self._body = bytearray(self._body)
+        self.roles = list(self.roles)
+
+
+class Session():
+    """A session: `name` (its file name), `meta` (model, dates..) and its `messages`,
+    None when not loaded (e.g. listed from the archive index only).
+
+    `questions`/`answers` are the user and assistant contents; given to the
+    constructor they are interleaved into messages.
+    """
+
+    __slots__ = ('name', 'meta', 'messages')
+
+    HEADER = struct.Struct('<4sHHIIQ')
+    MAGIC = b'SSNB'
+    VERSION = 1
+    NO_MESSAGES = 1     # flag: messages is None
+
+    def __init__(self, name=None, meta=None, messages=None, questions=None, answers=None) -> None:
+        self.name = name or f"session_{datetime.now().strftime('%Y%m%d_%H%M%S')}.json"
+        self.meta = meta
+        if questions is not None or answers is not None:
+            messages = list(messages or []) + _interleave(questions or [], answers or [])
+        self.messages = messages if messages is None or isinstance(messages, MessageStore) else MessageStore(messages)
+
+    @property
+    def questions(self):
+        return None if self.messages is None else self.messages.contents('user')
+
+    @property
+    def answers(self):
+        return None if self.messages is None else self.messages.contents('assistant')
+
+    def has_content(self):
+        return self.messages is not None
+
+    def __eq__(self, other):
+        if not isinstance(other, Session):
+            return NotImplemented
+        return (self.name, self.meta) == (other.name, other.meta) and \
+            (self.messages == other.messages if self.messages is not None else other.messages is None)
+
+    def __repr__(self):
+        return f'Session(name={self.name!r}, meta={self.meta!r}, ' \
+               f'messages={None if self.messages is None else len(self.messages)})'
+
+    def header(self):
+        """The session without its messages, e.g. the header of a SessionJournal"""
+        return {'name': self.name, 'meta': self.meta, 'messages': []}
+
+    def to_dict(self):
+        return {'name': self.name, 'meta': self.meta,
+                'messages': None if self.messages is None else [m.to_dict() for m in self.messages]}
+
+    @classmethod
+    def from_dict(cls, d):
+        d = dict(d)
+        name = d.pop('name', None) or d.pop('filename', None)
+        d.pop('filename', None)
+        meta = d.pop('meta', None)
+        questions, answers = d.pop('questions', None), d.pop('answers', None)
+        messages = d.pop('messages', None)
+        conversation = d.pop('conversation', None)
+        if conversation is not None:
+            # journal records appended since, if any, come after
+            messages = [_from_conversation(entry) for entry in conversation] + (messages or [])
+        if d:
+            # other top level fields of the app sessions (model, timestamp..)
+            meta = {**d, **(meta or {})}
+        return cls(name, meta, messages, questions, answers)
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    @classmethod
+    def from_json(cls, json_s):
+        return cls.from_dict(json.loads(json_s))
+
+    def encode(self):
+        """Compact binary encoding (see above)"""
+        messages = self.messages if self.messages is not None else MessageStore()
+        head = json.dumps({'name': self.name, 'meta': self.meta, 'roles': messages.roles,
+                           'extras': {str(i): extra for i, extra in messages._extras.items()}},
+                          separators=(',', ':')).encode('utf-8')
+        count = len(messages)
+        flags = self.NO_MESSAGES if self.messages is None else 0
+        role_ids = _little_endian(messages._role_ids, 'H')
+        padding = -(self.HEADER.size + len(head) + len(role_ids)) % 8
+        return b''.join((self.HEADER.pack(self.MAGIC, self.VERSION, flags, count, len(head), len(messages._body)),
+                         head, role_ids, b'\0' * padding, _little_endian(messages._ends, 'Q'), messages._body))
+
+    @classmethod
+    def decode(cls, data):
+        """Session of an encoded buffer (bytes, memoryview..): the messages are views over it"""
+        view = memoryview(data)
+        magic, version, flags, count, head_size, body_size = cls.HEADER.unpack_from(view)
+        if magic != cls.MAGIC:
+            raise ValueError('Not an encoded session')
+        if version != cls.VERSION:
+            raise ValueError(f'Unsupported session encoding version {version}')
+        pos = cls.HEADER.size
+        head = json.loads(bytes(view[pos:pos + head_size]))
+        pos += head_size
+        ids_end = pos + 2 * count
+        ends_start = ids_end + (-ids_end % 8)
+        body_start = ends_start + 8 * count
+        if len(view) < body_start + body_size:
+            raise ValueError('Truncated session encoding')
+        role_ids = _native(view[pos:ids_end].cast('H'), 'H')
+        ends = _native(view[ends_start:body_start].cast('Q'), 'Q')
+        messages = None
+        if not flags & cls.NO_MESSAGES:
+            extras = {int(i): extra for i, extra in head['extras'].items()}
+            messages = MessageStore.from_buffers(head['roles'], role_ids, ends,
+                                                 view[body_start:body_start + body_size], extras)
+        return cls(head['name'], head['meta'], messages)
+
+    @classmethod
+    def load(cls, data):
+        """Session of its binary encoding or of its JSON (any of the older shapes)"""
+        if bytes(data[:len(cls.MAGIC)]) == cls.MAGIC:
+            return cls.decode(data)
+        return cls.from_json(bytes(data))
+
+    @classmethod
+    def read(cls, path):
+        with open(path, 'rb') as f:
+            return cls.load(f.read())
+
+
+def _interleave(questions, answers):
+    messages = []
+    for i in range(max(len(questions), len(answers))):
+        if i < len(questions):
+            messages.append({'role': 'user', 'content': questions[i]})
+        if i < len(answers):
+            messages.append({'role': 'assistant', 'content': answers[i]})
+    return messages
+
+
+def _from_conversation(entry):
+    # ConversationApp entries: the user as "User", replies under the model name, errors as "Error"
+    extra = dict(entry)
+    role = extra.pop('role')
+    if role == 'User':
+        role = 'user'
+    elif role == 'Error':
+        role = 'assistant'
+        extra['error'] = True
+    elif role not in ('user', 'assistant'):
+        extra.setdefault('model', role)
+        role = 'assistant'
+    return {'role': role, **extra}
+
+
+def _little_endian(values, typecode):
+    if sys.byteorder == 'little':
+        return memoryview(values).cast('B')
+    values = array(typecode, values)
+    values.byteswap()
+    return values.tobytes()
+
+
+def _native(view, typecode):
+    # views as is on little-endian hosts
+    if sys.byteorder == 'little':
+        return view
+    values = array(typecode, view)
+    values.byteswap()
+    return values
@@ -0,0 +1,49 @@
+import pytest
+from adscape.session import *
+import json
+
+
+def test_Session_encoding():
+    session = Session(name='session_20250101_120000.json', meta={'model': 'llama3'},
+                      messages=[{'role': 'user', 'content': 'résumé?'},
+                                {'role': 'assistant', 'content': '**ok** 👍', 'model': 'llama3', 'latency': 1.5},
+                                {'role': 'user', 'content': ''}])
+    data = session.encode()
+    decoded = Session.decode(data)
+    assert decoded == session and Session.load(data) == session
+    assert decoded.questions == ['résumé?', ''] and decoded.answers == ['**ok** 👍']
+    assert decoded.messages[1].get('latency') == 1.5 and decoded.messages[-1]['content'] == ''
+    # views over the buffer until appended to
+    assert isinstance(decoded.messages._body, memoryview)
+    decoded.messages.append({'role': 'assistant', 'content': 'more'})
+    assert decoded.answers == ['**ok** 👍', 'more'] and Session.decode(data) == session
+    assert Session.decode(decoded.encode()) == decoded
+
+    # not loaded / empty sessions
+    assert not Session.decode(Session(name='x').encode()).has_content()
+    assert Session.decode(Session(name='x', messages=[]).encode()).messages == []
+    with pytest.raises(ValueError):
+        Session.decode(data[:-1])
+
+
+def test_Session_json():
+    session = Session(meta={'llm': 'phi3'}, questions=['q1', 'q2'], answers=['a1'])
+    assert [m['role'] for m in session.messages] == ['user', 'assistant', 'user']
+    assert Session.load(session.to_json().encode()) == session
+
+    # LLMApp and ConversationApp session files
+    app1 = {'filename': 'session_1700000000.json', 'model': 'llama3',
+            'messages': [{'role': 'user', 'content': 'hi'}, {'role': 'assistant', 'content': 'hello'}]}
+    app2 = {'filename': 'session_20250101_120000.json', 'model': 'mistral', 'timestamp': '20250101_120000',
+            'conversation': [{'role': 'User', 'content': 'hi'}, {'role': 'mistral', 'content': 'hello'},
+                             {'role': 'Error', 'content': 'timeout'}]}
+    session = Session.from_json(json.dumps(app1))
+    assert session.name == app1['filename'] and session.meta == {'model': 'llama3'}
+    assert session.messages == app1['messages']
+    session = Session.from_json(json.dumps(app2))
+    assert session.meta == {'model': 'mistral', 'timestamp': '20250101_120000'}
+    assert session.questions == ['hi'] and session.messages[1].get('model') == 'mistral'
+    assert session.messages[2].get('error')
+    # a ConversationApp session continued with a journal of the new shape
+    app2['messages'] = [{'role': 'user', 'content': 'again'}]
+    assert Session.from_dict(app2).questions == ['hi', 'again']
@@ -0,0 +1,297 @@
+import os
+import sys
+import json
+import time
+import queue
+import bisect
+import pathlib
+import threading
+from collections import Counter
+
+
+# Spans around the hot paths (LLM turns, session saves, rendering, capture and
+# detection) go to an in-process metrics registry (counters, latency histograms)
+# and to a rotating JSONL trace file written by a background thread. Disabled, a
+# span is a shared no-op object: one attribute check per traced block.
+#   ADSCAPE_TRACE=trace.jsonl    enables tracing at start
+#   ADSCAPE_PROFILE=profile.txt  starts the sampling profiler (folded stacks)
+
+
+class Histogram():
+    """Latency histogram, log-spaced buckets from 1us to ~2 min (4 per doubling)"""
+
+    BOUNDS = tuple(1e-6 * 2 ** (i / 4) for i in range(108))
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        self.counts[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """Upper bound of the bucket of the q-quantile"""
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if n and seen >= rank:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+        return 0.0
+
+    def as_dict(self):
+        return {'count': self.count, 'mean': self.total / self.count if self.count else 0.0, 'max': self.max,
+                'p50': self.quantile(0.5), 'p95': self.quantile(0.95), 'p99': self.quantile(0.99)}
+
+
+class Metrics():
+    """Counters and latency histograms by name"""
+
+    def __init__(self) -> None:
+        self.counters: Counter[str] = Counter()
+        self.histograms: dict[str, Histogram] = {}
+        self._lock = threading.Lock()
+
+    def incr(self, name, n=1):
+        with self._lock:
+            self.counters[name] += n
+
+    def observe(self, name, seconds):
+        with self._lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                histogram = self.histograms[name] = Histogram()
+            histogram.add(seconds)
+
+    def snapshot(self):
+        with self._lock:
+            return {'counters': dict(self.counters),
+                    'latency': {name: h.as_dict() for name, h in sorted(self.histograms.items())}}
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+
+
+class TraceFile():
+    """JSONL file of spans, rotated at `max_bytes` (trace.jsonl.1 .. .`backups`),
+    written by a background thread: tracing never waits on the disk"""
+
+    def __init__(self, path, max_bytes=8*1024*1024, backups=3) -> None:
+        self.path = pathlib.Path(path)
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self._queue: queue.SimpleQueue = queue.SimpleQueue()
+        self._thread = threading.Thread(target=self._write_loop, daemon=True, name='trace')
+        self._thread.start()
+
+    def write(self, record):
+        self._queue.put(record)
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+
+    def _write_loop(self):
+        f = open(self.path, 'a', encoding='utf-8')
+        try:
+            while (record := self._queue.get()) is not None:
+                f.write(json.dumps(record, separators=(',', ':'), default=str) + '\n')
+                if self._queue.empty():
+                    f.flush()
+                if f.tell() >= self.max_bytes:
+                    f.close()
+                    self._rotate()
+                    f = open(self.path, 'a', encoding='utf-8')
+        finally:
+            f.close()
+
+    def _rotate(self):
+        for i in range(self.backups - 1, 0, -1):
+            older = self.path.with_name(f'{self.path.name}.{i}')
+            if older.exists():
+                os.replace(older, self.path.with_name(f'{self.path.name}.{i + 1}'))
+        if self.backups:
+            os.replace(self.path, self.path.with_name(f'{self.path.name}.1'))
+        else:
+            os.remove(self.path)
+
+
+class Span():
+    """Timed block, as a context manager or started and `end`-ed (e.g. across callbacks)"""
+
+    __slots__ = ('tracer', 'name', 'attrs', 'start', '_t0')
+
+    def __init__(self, tracer, name, attrs) -> None:
+        self.tracer = tracer
+        self.name = name
+        self.attrs = attrs
+        self.start = time.time()
+        self._t0 = time.perf_counter()
+
+    def set(self, **attrs):
+        self.attrs.update(attrs)
+
+    def end(self, **attrs):
+        if self._t0 is None:
+            return
+        seconds = time.perf_counter() - self._t0
+        self._t0 = None
+        self.attrs.update(attrs)
+        self.tracer.record(self.name, self.start, seconds, self.attrs)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is not None:
+            self.attrs['error'] = exc_type.__name__
+        self.end()
+
+
+class _NoSpan():
+    __slots__ = ()
+
+    def set(self, **attrs):
+        pass
+
+    def end(self, **attrs):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class SamplingProfiler():
+    """Samples the Python stacks of all threads (but its own) every `interval` seconds
+    from a daemon thread. Stacks are counted in the folded format, one
+    `thread;outer;..;inner count` line per stack, as read by flame graph tools"""
+
+    def __init__(self, interval=0.005) -> None:
+        self.interval = interval
+        self.stacks: Counter[str] = Counter()
+        self.samples = 0
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._sample_loop, daemon=True, name='profiler')
+            self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def dump(self, path):
+        with open(path, 'w', encoding='utf-8') as f:
+            for stack, n in self.stacks.most_common():
+                f.write(f'{stack} {n}\n')
+
+    def _sample_loop(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {t.ident: t.name for t in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.stacks[';'.join(reversed(stack))] += 1
+            self.samples += 1
+
+
+class Tracer():
+    """Spans to the metrics registry and, when a `trace_file` is set, to the trace file.
+
+    `span(name, **attrs)` costs one check while disabled. The sampling profiler is
+    toggled at runtime by `toggle_profiler`.
+    """
+
+    def __init__(self, trace_file=None, enabled=None, max_bytes=8*1024*1024, backups=3,
+                 profile_file='profile.txt') -> None:
+        self.metrics = Metrics()
+        self.profiler = None
+        self.profile_file = profile_file
+        self.enabled = False
+        self._trace_file = None
+        self.configure(trace_file, enabled, max_bytes, backups)
+
+    def configure(self, trace_file=None, enabled=None, max_bytes=8*1024*1024, backups=3):
+        """Set (or with None, remove) the trace file; enabled by default when there is one"""
+        if self._trace_file is not None:
+            self._trace_file.close()
+        self._trace_file = TraceFile(trace_file, max_bytes, backups) if trace_file else None
+        self.enabled = enabled if enabled is not None else trace_file is not None
+
+    def close(self):
+        self.stop_profiler(self.profile_file)
+        self.configure(None, self.enabled)
+
+    def span(self, name, **attrs):
+        if not self.enabled:
+            return _NO_SPAN
+        return Span(self, name, attrs)
+
+    def count(self, name, n=1):
+        if self.enabled:
+            self.metrics.incr(name, n)
+
+    def record(self, name, start, seconds, attrs):
+        self.metrics.observe(name, seconds)
+        if 'error' in attrs:
+            self.metrics.incr(f'{name}.errors')
+        if self._trace_file is not None:
+            self._trace_file.write({'name': name, 'ts': start, 'dur': seconds,
+                                    'thread': threading.current_thread().name, **attrs})
+
+    def snapshot(self):
+        return self.metrics.snapshot()
+
+    def start_profiler(self, interval=0.005):
+        if self.profiler is None or not self.profiler.running:
+            self.profiler = SamplingProfiler(interval)
+            self.profiler.start()
+
+    def stop_profiler(self, dump_file=None):
+        if self.profiler is not None and self.profiler.running:
+            self.profiler.stop()
+            if dump_file:
+                self.profiler.dump(dump_file)
+
+    def toggle_profiler(self):
+        """Start the profiler, or stop it and write its folded stacks to `profile_file`; True if now running"""
+        if self.profiler is not None and self.profiler.running:
+            self.stop_profiler(self.profile_file)
+            return False
+        self.start_profiler()
+        return True
+
+
+# the process tracer
+tracer = Tracer(os.environ.get('ADSCAPE_TRACE'), profile_file=os.environ.get('ADSCAPE_PROFILE') or 'profile.txt')
+if os.environ.get('ADSCAPE_PROFILE'):
+    tracer.start_profiler()
@@ -0,0 +1,62 @@
+import pytest
+from adscape.trace import *
+import json
+import time
+
+
+def test_Histogram():
+    h = Histogram()
+    for ms in (1, 2, 3, 4, 100):
+        h.add(ms / 1000)
+    stats = h.as_dict()
+    assert stats['count'] == 5 and stats['max'] == 0.1
+    # bucket upper bounds: within 1/4 doubling
+    assert 0.003 <= stats['p50'] <= 0.003 * 2 ** 0.25
+    assert 0.1 <= stats['p99'] <= 0.1 * 2 ** 0.25
+
+
+def test_Tracer(tmp_path):
+    tracer = Tracer()
+    # disabled: the shared no-op span, nothing recorded
+    with tracer.span('noop', x=1) as span:
+        span.set(y=2)
+    assert tracer.span('noop') is tracer.span('other')
+    assert tracer.snapshot() == {'counters': {}, 'latency': {}}
+
+    trace_file = tmp_path / 'trace.jsonl'
+    tracer.configure(trace_file, max_bytes=300, backups=2)
+    with pytest.raises(KeyError):
+        with tracer.span('lookup', key='k'):
+            raise KeyError('k')
+    turn = tracer.span('turn', model='llama3')
+    for _ in range(10):
+        with tracer.span('save'):
+            pass
+    turn.end(chars=12)
+    tracer.count('frames', 3)
+    tracer.close()
+
+    snapshot = tracer.snapshot()
+    assert snapshot['counters'] == {'lookup.errors': 1, 'frames': 3}
+    assert snapshot['latency']['save']['count'] == 10 and snapshot['latency']['turn']['count'] == 1
+    # rotated, the newest spans last in the current file
+    files = [trace_file.with_name('trace.jsonl.2'), trace_file.with_name('trace.jsonl.1'), trace_file]
+    assert all(f.exists() for f in files)
+    spans = [json.loads(line) for f in files for line in f.read_text().splitlines()]
+    assert spans[-1]['name'] == 'turn' and spans[-1]['chars'] == 12 and spans[-1]['model'] == 'llama3'
+
+
+def test_SamplingProfiler(tmp_path):
+    tracer = Tracer(profile_file=tmp_path / 'profile.txt')
+    assert tracer.toggle_profiler()
+
+    def busy_wait():
+        end = time.perf_counter() + 0.2
+        while time.perf_counter() < end:
+            pass
+
+    busy_wait()
+    assert not tracer.toggle_profiler()
+    lines = (tmp_path / 'profile.txt').read_text().splitlines()
+    assert any('busy_wait (trace_test.py' in line for line in lines)
+    assert sum(int(line.rsplit(' ', 1)[1]) for line in lines) >= tracer.profiler.samples > 0
@@ -0,0 +1,68 @@
+import kivy
+kivy.require('2.3.1')
+
+from kivy.app import App
+from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.label import Label
+from kivy.uix.button import Button
+from kivy.core.window import Window
+from kivy.clock import Clock
+
+from adscape.alert import AlertState
+
+
+# The window of the background monitor, imported (with Kivy) by
+# main_backgroud_event.py only when the first event is to be shown. Shown on
+# events, hidden when closed or when the screen is clear again: the monitor
+# callbacks feed an AlertState (adscape.alert) and the Kivy thread is only woken
+# up on its transitions, not for every detected frame.
+
+class MainLayout(BoxLayout):
+    def __init__(self, on_close_callback, **kwargs):
+        super().__init__(orientation='vertical', **kwargs)
+        self.label = Label(text="An event occurred!", font_size=24)
+        self.close_button = Button(text="Close", size_hint=(1, 0.3))
+        self.close_button.bind(on_release=on_close_callback) # pylint: disable=no-member
+
+        self.add_widget(self.label)
+        self.add_widget(self.close_button)
+
+class BackgroundEventApp(App):
+    """Window of a running headless `monitor`: its callbacks are rerouted to the window
+    (on the Kivy thread) once the app is started. `detections`: of the event that woke it up"""
+
+    def __init__(self, monitor, detections=(), **kwargs):
+        super().__init__(**kwargs)
+        self.monitor = monitor
+        self.detections = detections
+        self.alerts = AlertState(
+            on_show=lambda detections: Clock.schedule_once(lambda dt: self.show_event()),
+            on_hide=lambda: Clock.schedule_once(lambda dt: self.minimize_window()),
+            schedule=lambda delay, callback: Clock.schedule_once(lambda dt: callback(), delay))
+
+    def build(self):
+        self.layout = MainLayout(self.close_event)
+        return self.layout
+
+    def on_start(self):
+        self.alerts.event(self.detections)
+        self.monitor.on_event = self.alerts.event
+        self.monitor.on_clear = lambda detections, box: self.alerts.clear(box)
+
+    def on_stop(self):
+        self.monitor.stop()
+
+    def show_event(self):
+        Window.show()
+        Window.raise_window()
+
+    def close_event(self, instance):
+        # hidden by the state machine
+        self.alerts.acknowledge()
+
+    def minimize_window(self):
+        Window.hide()
+        metrics = self.monitor.metrics()
+        if metrics is not None:
+            print(f'event over, queue={metrics["queue_depth"]} dropped={metrics["dropped"]} '
+                  f'detect={metrics["detect"]["last"]*1000:.0f}ms suppressed={self.alerts.suppressed}')
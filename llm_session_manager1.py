@@ -1,35 +1,75 @@
 import os
 import json
 import time
-import requests
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.button import Button
 from kivy.uix.label import Label
 from kivy.uix.textinput import TextInput
 from kivy.uix.popup import Popup
-from kivy.uix.scrollview import ScrollView
-from kivy.uix.rst import RstDocument
-from kivy.uix.checkbox import CheckBox
-from kivy.uix.dropdown import DropDown
-from kivy.uix.spinner import Spinner
-from kivy.uix.settings import SettingsWithSidebar
+from kivy.core.window import Window
+from adscape.main import SessionJournal, SessionDirectory
+from adscape.session import Session
+from adscape.llm import LLMClient, LLMBusy, LLMCancelled, TokenBuffer, ChatHistory, PromptCache
+from adscape.trace import tracer
+from transcript import TranscriptView
 
 SESSIONS_DIR = "sessions"
 CONFIG_FILE = "config.json"
+# max refresh rate of the display while a reply is streamed
+STREAM_FPS = 10
+# seconds between checks of the sessions folder for changes by other apps
+WATCH_INTERVAL = 2
+# requests in flight at most in fan-out mode (client workers), see OLLAMA_NUM_PARALLEL
+MAX_PARALLEL = 4
+# starts/stops the sampling profiler (stacks written to tracer.profile_file), see adscape.trace
+PROFILER_KEY = 290  # F9
+SYSTEM_PROMPT = "Please respond in reStructuredText format."
+LLM_CACHE_FILE = "llm_cache.db"
+MODELS_FILE = "models.json"
+# replies to the initial prompt are seeded, so they are the same each session and cached
+INITIAL_PROMPT_OPTIONS = {"seed": 0}
 
 # Ensure sessions folder exists
 os.makedirs(SESSIONS_DIR, exist_ok=True)
 
-def list_sessions():
-    return sorted([f for f in os.listdir(SESSIONS_DIR) if f.endswith(".json")])
+def in_history(message, model):
+    # fan-out replies: each model is sent its own previous replies only
+    return not message.get("error") and message.get("model", model) == model
+
+def reply_label(message):
+    if message.get("latency") is None:
+        return f"{message['model']} ({'cancelled' if message.get('cancelled') else 'error'})"
+    return f"{message['model']} ({message['latency']:.1f}s)"
+
+def display_rows(messages):
+    """(role, content) of the messages, the replies of a fan-out as one row of columns"""
+    rows, fanout = [], None
+    for msg in messages:
+        if msg.get("fanout") is None:
+            rows.append((msg['role'], msg['content']))
+        elif msg["fanout"] == fanout:
+            rows[-1][1].append((reply_label(msg), msg['content']))
+        else:
+            rows.append(("assistant", [(reply_label(msg), msg['content'])]))
+        fanout = msg.get("fanout")
+    return rows
 
 class Config:
     def __init__(self):
         self.data = {
             "ollama_url": "http://localhost:11434",
             "default_model": "llama3",
-            "initial_prompt": ""
+            "initial_prompt": "",
+            "stream": True,
+            # model stays loaded between turns, with the KV state of the conversation
+            "keep_alive": "30m",
+            # history sent with each message (estimated tokens)
+            "context_tokens": 4096,
+            # several models: each prompt is sent to all of them, "fanout_parallel" at once
+            "fanout_models": [],
+            "fanout_parallel": 2
         }
         self.load()
 
@@ -46,13 +86,26 @@ class LLMApp(App):
     def build(self):
         self.config_data = Config()
         self.session_index = -1
-        self.sessions = list_sessions()
+        # sessions left with a journal (crash or app not properly closed)
+        SessionJournal.recover(SESSIONS_DIR)
+        self.sessions = SessionDirectory(SESSIONS_DIR)
         self.current_session = None
+        self.history = None
+        self.journal = None
+        self.stream = None  # reply being streamed: filename and text received so far
+        self.reply_request = None
+        # requests run on worker threads, callbacks come back on the main thread
+        self.llm = LLMClient(self.config_data.data['ollama_url'], workers=MAX_PARALLEL,
+                             dispatch=lambda fn, *args: Clock.schedule_once(lambda dt: fn(*args)),
+                             cache=PromptCache(LLM_CACHE_FILE), catalog_file=MODELS_FILE)
+        # model list ready before the config dialog opens, model loaded before the first prompt
+        self.llm.catalog.refresh()
+        self.warm_up()
 
         self.root = BoxLayout(orientation='vertical')
 
-        self.display = RstDocument(size_hint_y=0.8)
-        self.root.add_widget(ScrollView(size_hint_y=0.8, do_scroll_x=False, do_scroll_y=True, content=self.display))
+        self.display = TranscriptView(size_hint_y=0.8)
+        self.root.add_widget(self.display)
 
         self.prompt = TextInput(hint_text="Type your message...", multiline=False, size_hint_y=None, height=50)
         self.root.add_widget(self.prompt)
@@ -60,19 +113,23 @@ class LLMApp(App):
         nav_bar = BoxLayout(size_hint_y=None, height=50)
         self.back_button = Button(text="Back", on_press=self.go_back)
         self.next_button = Button(text="Next / New", on_press=self.go_next_or_new)
+        self.stop_button = Button(text="Stop", on_press=self.cancel_reply)
         menu_button = Button(text="⋮", on_press=self.open_menu)
         nav_bar.add_widget(self.back_button)
         nav_bar.add_widget(self.next_button)
+        nav_bar.add_widget(self.stop_button)
         nav_bar.add_widget(menu_button)
         self.root.add_widget(nav_bar)
 
         self.prompt.bind(on_text_validate=self.send_message)
         self.load_session(-1)  # Load latest session
+        Clock.schedule_interval(self.watch_sessions, WATCH_INTERVAL)
+        Window.bind(on_key_down=self.on_key_down)
 
         return self.root
 
     def load_session(self, index):
-        self.sessions = list_sessions()
+        self.save_current_session()
         if not self.sessions:
             self.new_session()
             return
@@ -83,51 +140,205 @@ class LLMApp(App):
         if 0 <= index < len(self.sessions):
             self.session_index = index
             filename = self.sessions[index]
-            with open(os.path.join(SESSIONS_DIR, filename)) as f:
-                self.current_session = json.load(f)
-            rst_content = "\n\n".join([f"**{msg['role']}**:\n\n{msg['content']}" for msg in self.current_session['messages']])
-            self.display.text = rst_content
+            with tracer.span('session.load') as span:
+                # the new session is listed before its first message is written
+                self.current_session = self.sessions.read(filename,
+                                                          meta={"model": self.config_data.data["default_model"]})
+                self.history = self.chat_history(self.current_session.messages)
+                span.set(messages=len(self.current_session.messages))
+            stored = self.current_session.messages
+            fanout = self.stream and self.stream['filename'] == filename and self.stream.get('fanout')
+            if fanout:
+                # the replies of the fan-out in progress are shown live, stored or not
+                stored = [msg for msg in stored if msg.get('fanout') != fanout]
+            messages = display_rows(stored)
+            if self.stream and self.stream['filename'] == filename:
+                messages.append(("assistant", list(self.stream['columns']) if fanout else self.stream['text']))
+            with tracer.span('render.show', messages=len(messages)):
+                self.display.show(filename, messages)
+
+    def watch_sessions(self, dt):
+        # sessions added or removed by others: keep the position of the current one
+        if self.sessions.poll() and self.current_session is not None:
+            index = self.sessions.find(self.current_session.name)
+            self.session_index = index if index >= 0 else min(self.session_index, len(self.sessions) - 1)
+
+    def session_model(self):
+        return (self.current_session.meta or {}).get('model', self.config_data.data["default_model"])
+
+    def chat_history(self, messages):
+        return ChatHistory(SYSTEM_PROMPT, self.config_data.data.get("context_tokens", 4096),
+                           messages=[m for m in messages if in_history(m, self.session_model())])
+
+    def append_message(self, message):
+        self.current_session.messages.append(message)
+        if in_history(message, self.session_model()):
+            self.history.append(message['role'], message['content'])
+        if self.journal is None:
+            self.journal = SessionJournal(os.path.join(SESSIONS_DIR, self.current_session.name),
+                                          header=self.current_session.header())
+        self.journal.append('messages', message)
+
+    def store_message(self, filename, message):
+        if self.current_session.name == filename:
+            self.append_message(message)
+        else:
+            # user moved to another session meanwhile
+            journal = SessionJournal(os.path.join(SESSIONS_DIR, filename))
+            journal.append('messages', message)
+            journal.close()
 
     def save_current_session(self):
-        if self.current_session:
-            filename = self.current_session['filename']
-            with open(os.path.join(SESSIONS_DIR, filename), 'w') as f:
-                json.dump(self.current_session, f, indent=2)
+        # fold the journal of the live session into its snapshot
+        if self.journal is not None:
+            with tracer.span('session.save'):
+                self.journal.close()
+            self.journal = None
+
+    def warm_up(self):
+        for model in self.config_data.data.get("fanout_models") or [self.config_data.data["default_model"]]:
+            try:
+                self.llm.warm_up(model, self.config_data.data.get("keep_alive", "30m"))
+            except LLMBusy:
+                pass
+
+    def on_stop(self):
+        self.cancel_reply()
+        self.save_current_session()
+        self.llm.close()
+        self.llm.cache.close()
+        tracer.close()
+
+    def on_key_down(self, window, key, scancode, codepoint, modifiers):
+        if key == PROFILER_KEY:
+            tracer.toggle_profiler()
+            return True
 
     def new_session(self):
+        self.save_current_session()
         timestamp = str(int(time.time()))
         filename = f"session_{timestamp}.json"
-        self.current_session = {
-            "filename": filename,
-            "model": self.config_data.data["default_model"],
-            "messages": []
-        }
-        self.session_index = len(self.sessions)
-        self.sessions.append(filename)
+        self.current_session = Session(filename, meta={"model": self.config_data.data["default_model"]}, messages=[])
+        self.history = self.chat_history([])
+        self.session_index = self.sessions.add(filename)
+        self.display.show(filename, [])
         if self.config_data.data["initial_prompt"]:
             self.send_message(text=self.config_data.data["initial_prompt"], from_init=True)
 
     def send_message(self, instance=None, text=None, from_init=False):
         message = text if text else self.prompt.text.strip()
-        if not message:
+        if not message or self.stream:
             return
 
-        self.current_session['messages'].append({"role": "user", "content": message})
-        self.prompt.text = ""
-        self.save_current_session()
-        self.display.text += f"\n\n**user**:\n\n{message}"
-
-        # Get response from local LLM
-        response = requests.post(f"{self.config_data.data['ollama_url']}/api/generate", json={
-            "model": self.current_session['model'],
-            "prompt": message,
-            "format": "rst"
-        })
-        if response.status_code == 200:
-            reply = response.json().get("response", "[No response]")
-            self.current_session['messages'].append({"role": "assistant", "content": reply})
-            self.save_current_session()
-            self.display.text += f"\n\n**assistant**:\n\n{reply}"
+        with tracer.span('ui.send'):
+            self.append_message({"role": "user", "content": message})
+            self.prompt.text = ""
+            self.display.append("user", message)
+
+            # Get response from local LLM, the conversation so far as context
+            options = {"options": INITIAL_PROMPT_OPTIONS} if from_init else {}
+            models = self.config_data.data.get("fanout_models") or []
+            if len(models) > 1:
+                self.request_fanout(models, options)
+            else:
+                self.request_reply(self.history.payload(self.session_model(),
+                                                        self.config_data.data.get("keep_alive", "30m"), **options))
+
+    def request_reply(self, payload, path="/api/chat"):
+        """Reply is requested on a client worker thread. When streamed, the display is
+        refreshed at most STREAM_FPS, in any case only the final message is persisted"""
+        filename = self.current_session.name
+        streaming = self.config_data.data.get("stream", True)
+        self.stream = {"filename": filename, "text": ""}
+        buffer = TokenBuffer()
+        self.display.append("assistant", "")
+        refresh = Clock.schedule_interval(lambda dt: self.flush_tokens(buffer), 1 / STREAM_FPS) if streaming else None
+        # prompt to persisted reply, the round-trip alone is the 'llm.http' span
+        turn = tracer.span('llm.turn', model=payload.get('model'), streaming=streaming)
+
+        def finish(content, **extra):
+            if refresh:
+                refresh.cancel()
+            self.flush_tokens(buffer)
+            if content is None:
+                content = self.stream['text']
+            self.stream = None
+            self.reply_request = None
+            self.store_message(filename, {"role": "assistant", "content": content, **extra})
+            turn.end(chars=len(content), **extra)
+
+        def on_done(result):
+            reply, metrics = result
+            if not streaming:
+                buffer.append(reply)
+            finish(reply, ttft=metrics["ttft"])
+
+        def on_error(e):
+            if isinstance(e, LLMCancelled):
+                finish(None, cancelled=True)
+            else:
+                buffer.append(f"[Error: {e}]")
+                finish(f"[Error: {e}]", error=True)
+
+        try:
+            self.reply_request = self.llm.generate(payload, on_done, on_error, on_token=buffer.append if streaming else None,
+                                                   path=path)
+        except LLMBusy as e:
+            on_error(e)
+
+    def request_fanout(self, models, options):
+        """The prompt to each of `models` concurrently, at most "fanout_parallel" requests at once.
+        Replies are shown side by side as they complete and persisted with their model and latency"""
+        filename = self.current_session.name
+        fanout = int(time.time() * 1000)
+        messages = list(self.current_session.messages)
+        columns = [(model, "...") for model in models]
+        keep_alive = self.config_data.data.get("keep_alive", "30m")
+        context_tokens = self.config_data.data.get("context_tokens", 4096)
+        self.stream = {"filename": filename, "text": "", "fanout": fanout, "columns": columns}
+        self.display.append("assistant", list(columns))
+        turn = tracer.span('llm.fanout', models=len(models))
+
+        def payload_of(model):
+            history = ChatHistory(SYSTEM_PROMPT, context_tokens, messages=[m for m in messages if in_history(m, model)])
+            return history.payload(model, keep_alive, **options)
+
+        def store(model, message):
+            columns[models.index(model)] = (reply_label(message), message['content'])
+            self.store_message(filename, message)
+            if self.current_session.name == filename:
+                self.display.update_last(list(columns))
+
+        def on_reply(model, content, metrics):
+            store(model, {"role": "assistant", "content": content, "model": model, "fanout": fanout,
+                          "latency": metrics["total"], "queued": metrics["queued"], "ttft": metrics["ttft"]})
+
+        def on_error(model, e):
+            if isinstance(e, LLMCancelled):
+                store(model, {"role": "assistant", "content": "", "model": model, "fanout": fanout, "cancelled": True})
+            else:
+                store(model, {"role": "assistant", "content": f"[Error: {e}]", "model": model, "fanout": fanout,
+                              "error": True})
+
+        def on_done(results):
+            self.stream = None
+            self.reply_request = None
+            turn.end(errors=sum(isinstance(r, Exception) for r in results.values()))
+
+        self.reply_request = self.llm.fan_out(models, payload_of, "/api/chat",
+                                              self.config_data.data.get("fanout_parallel", 2),
+                                              on_reply, on_error, on_done=on_done)
+
+    def cancel_reply(self, instance=None):
+        if self.reply_request:
+            self.reply_request.cancel()
+
+    def flush_tokens(self, buffer):
+        tokens = buffer.drain()
+        if tokens and self.stream:
+            self.stream['text'] += tokens
+            if self.current_session.name == self.stream['filename']:
+                self.display.update_last(self.stream['text'])
 
     def go_back(self, instance):
         if self.session_index > 0:
@@ -138,7 +349,6 @@ class LLMApp(App):
             self.load_session(self.session_index + 1)
         else:
             self.new_session()
-            self.load_session(-1)
 
     def open_menu(self, instance):
         menu = BoxLayout(orientation='vertical', size_hint=(None, None), size=(200, 150))
@@ -155,44 +365,63 @@ class LLMApp(App):
         popup.open()
 
     def open_config(self, instance):
+        # widgets of the dialog only: imported when first opened
+        from kivy.uix.checkbox import CheckBox
+        from kivy.uix.scrollview import ScrollView
         layout = BoxLayout(orientation='vertical')
 
         url_input = TextInput(text=self.config_data.data["ollama_url"], hint_text="Ollama URL")
         init_prompt_input = TextInput(text=self.config_data.data["initial_prompt"], hint_text="Initial prompt")
+        parallel_input = TextInput(text=str(self.config_data.data.get("fanout_parallel", 2)), input_filter='int',
+                                   multiline=False, hint_text=f"1 to {MAX_PARALLEL}")
         models_box = BoxLayout(orientation='vertical', size_hint_y=None)
         models_box.bind(minimum_height=models_box.setter('height'))
 
         model_checkboxes = {}
-        try:
-            models = requests.get(f"{self.config_data.data['ollama_url']}/api/tags").json().get("models", [])
-        except Exception:
-            models = []
-
-        for model in models:
-            box = BoxLayout(size_hint_y=None, height=30)
-            checkbox = CheckBox(active=model["name"] == self.config_data.data["default_model"])
-            model_checkboxes[model["name"]] = checkbox
-            box.add_widget(checkbox)
-            box.add_widget(Label(text=model["name"]))
-            models_box.add_widget(box)
+
+        def show_models(tags):
+            # listed from the catalog cache, listed again if a refresh brings changes
+            selected = [name for name, cb in model_checkboxes.items() if cb.active] or \
+                [self.config_data.data["default_model"]] + self.config_data.data.get("fanout_models", [])
+            models_box.clear_widgets()
+            model_checkboxes.clear()
+            for model in tags.get("models", []):
+                box = BoxLayout(size_hint_y=None, height=30)
+                checkbox = CheckBox(active=model["name"] in selected)
+                model_checkboxes[model["name"]] = checkbox
+                box.add_widget(checkbox)
+                box.add_widget(Label(text=model["name"]))
+                models_box.add_widget(box)
+
+        self.llm.catalog.models(show_models)
 
         def save_config(instance):
             self.config_data.data["ollama_url"] = url_input.text
+            self.llm.base_url = url_input.text
             self.config_data.data["initial_prompt"] = init_prompt_input.text
+            models = [self.config_data.data["default_model"]] + self.config_data.data.get("fanout_models", [])
             for name, cb in model_checkboxes.items():
                 if cb.active:
                     self.config_data.data["default_model"] = name
+            # several models checked: fan-out mode
+            checked = [name for name, cb in model_checkboxes.items() if cb.active]
+            self.config_data.data["fanout_models"] = checked if len(checked) > 1 else []
+            self.config_data.data["fanout_parallel"] = max(1, min(MAX_PARALLEL, int(parallel_input.text or 1)))
             self.config_data.save()
+            if [self.config_data.data["default_model"]] + self.config_data.data["fanout_models"] != models:
+                self.warm_up()
             popup.dismiss()
 
         layout.add_widget(Label(text="Ollama URL"))
         layout.add_widget(url_input)
         layout.add_widget(Label(text="Initial Prompt"))
         layout.add_widget(init_prompt_input)
-        layout.add_widget(Label(text="Select Default Model"))
+        layout.add_widget(Label(text="Select Default Model (several: each prompt to all)"))
         scroll = ScrollView(size_hint=(1, None), size=(300, 100))
         scroll.add_widget(models_box)
         layout.add_widget(scroll)
+        layout.add_widget(Label(text="Parallel requests (several models)"))
+        layout.add_widget(parallel_input)
         layout.add_widget(Button(text="Save", on_press=save_config))
 
         popup = Popup(title="Configuration", content=layout, size_hint=(None, None), size=(400, 500))
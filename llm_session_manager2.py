@@ -1,23 +1,61 @@
 import os
 import json
-import requests
 import time
 from kivy.app import App
+from kivy.clock import Clock
 from kivy.uix.boxlayout import BoxLayout
 from kivy.uix.textinput import TextInput
 from kivy.uix.label import Label
 from kivy.uix.button import Button
 from kivy.uix.popup import Popup
-from kivy.uix.scrollview import ScrollView
-from kivy.uix.rst import RstDocument
-from kivy.uix.spinner import Spinner
-from kivy.uix.checkbox import CheckBox
-from kivy.uix.gridlayout import GridLayout
 from kivy.uix.actionbar import ActionBar, ActionView, ActionPrevious, ActionOverflow, ActionButton
+from kivy.core.window import Window
+from adscape.main import SessionJournal, SessionDirectory
+from adscape.session import Session
+from adscape.llm import LLMClient, LLMBusy, LLMCancelled, TokenBuffer, ChatHistory, PromptCache
+from adscape.trace import tracer
+from transcript import TranscriptView
 
 SESSIONS_DIR = "sessions"
+# max refresh rate of the view while a reply is streamed
+STREAM_FPS = 10
+# seconds between checks of the sessions folder for changes by other apps
+WATCH_INTERVAL = 2
+# requests in flight at most in fan-out mode (client workers), see OLLAMA_NUM_PARALLEL
+MAX_PARALLEL = 4
+# starts/stops the sampling profiler (stacks written to tracer.profile_file), see adscape.trace
+PROFILER_KEY = 290  # F9
+SYSTEM_PROMPT = "Please respond in reStructuredText format."
+LLM_CACHE_FILE = "llm_cache.db"
+MODELS_FILE = "models.json"
+# replies to the initial prompt are seeded, so they are the same each session and cached
+INITIAL_PROMPT_OPTIONS = {"seed": 0}
 os.makedirs(SESSIONS_DIR, exist_ok=True)
 
+def display_role(entry):
+    # the user and the replies under the model name, as shown in the view
+    if entry["role"] == "user":
+        return "User"
+    return "Error" if entry.get("error") else entry.get("model", "Assistant")
+
+def reply_label(entry):
+    if entry.get("latency") is None:
+        return f"{entry['model']} ({'cancelled' if entry.get('cancelled') else 'error'})"
+    return f"{entry['model']} ({entry['latency']:.1f}s)"
+
+def display_rows(messages):
+    """(role, content) of the messages, the replies of a fan-out as one row of columns"""
+    rows, fanout = [], None
+    for entry in messages:
+        if entry.get("fanout") is None:
+            rows.append((display_role(entry), entry["content"]))
+        elif entry["fanout"] == fanout:
+            rows[-1][1].append((reply_label(entry), entry["content"]))
+        else:
+            rows.append(("Models", [(reply_label(entry), entry["content"])]))
+        fanout = entry.get("fanout")
+    return rows
+
 class Config:
     def __init__(self):
         self.config_file = "config.json"
@@ -39,28 +77,41 @@ class ConversationApp(App):
     def build(self):
         self.title = "LLM Conversation Manager"
         self.model = config.data.get("selected_model", "")
-        self.session_files = sorted([f for f in os.listdir(SESSIONS_DIR) if f.endswith(".json")])
+        # sessions left with a journal (crash or app not properly closed)
+        SessionJournal.recover(SESSIONS_DIR)
+        self.journal = None
+        self.stream = None  # reply being streamed: filename and text received so far
+        self.reply_request = None
+        # requests run on worker threads, callbacks come back on the main thread
+        self.llm = LLMClient(config.data["ollama_url"], workers=MAX_PARALLEL,
+                             dispatch=lambda fn, *args: Clock.schedule_once(lambda dt: fn(*args)),
+                             cache=PromptCache(LLM_CACHE_FILE), catalog_file=MODELS_FILE)
+        # model list ready before the config dialog opens, model loaded before the first prompt
+        self.llm.catalog.refresh()
+        self.warm_up()
+        self.session_files = SessionDirectory(SESSIONS_DIR)
         self.current_session_index = -1
-        self.current_session = {}
+        self.current_session = None
+        self.history = None
         self.session_label = Label(size_hint_y=None)
-        self.rst_view = RstDocument(text="", size_hint_y=None)
+        self.rst_view = TranscriptView(template="{role}:\n\n{content}", size_hint=(1, 0.8))
         self.prompt_input = TextInput(hint_text="Ask something...", multiline=False)
         self.prompt_input.bind(on_text_validate=self.send_prompt)
         
         layout = BoxLayout(orientation='vertical')
-        self.scroll = ScrollView(size_hint=(1, 0.8))
-        self.scroll.add_widget(self.rst_view)
-
-        layout.add_widget(self.scroll)
+        layout.add_widget(self.rst_view)
         layout.add_widget(self.prompt_input)
 
         btn_layout = BoxLayout(size_hint_y=0.1)
         self.back_btn = Button(text="< Back")
         self.next_btn = Button(text="Next >")
+        self.stop_btn = Button(text="Stop")
         self.back_btn.bind(on_press=self.previous_session)
         self.next_btn.bind(on_press=self.next_or_new_session)
+        self.stop_btn.bind(on_press=self.cancel_reply)
         btn_layout.add_widget(self.back_btn)
         btn_layout.add_widget(self.next_btn)
+        btn_layout.add_widget(self.stop_btn)
 
         layout.add_widget(btn_layout)
 
@@ -77,60 +128,215 @@ class ConversationApp(App):
         root.add_widget(layout)
 
         self.new_session()
+        Clock.schedule_interval(self.watch_sessions, WATCH_INTERVAL)
+        Window.bind(on_key_down=self.on_key_down)
         return root
 
     def load_session(self, filename):
-        with open(os.path.join(SESSIONS_DIR, filename), 'r') as f:
-            self.current_session = json.load(f)
+        self.save_session()
+        with tracer.span('session.load') as span:
+            self.current_session = self.session_files.read(filename, meta={"model": self.model})
+            self.history = self.chat_history(self.current_session.messages)
+            span.set(messages=len(self.current_session.messages))
         self.update_rst_view()
 
+    def chat_history(self, messages):
+        history = ChatHistory(SYSTEM_PROMPT, config.data.get("context_tokens", 4096))
+        for entry in messages:
+            self.add_to_history(history, entry, self.model)
+        return history
+
+    @staticmethod
+    def add_to_history(history, entry, model):
+        # fan-out replies: each model is sent its own previous replies only
+        if not entry.get("error") and (entry.get("fanout") is None or entry.get("model") == model):
+            history.append(entry["role"], entry["content"])
+
+    def append_entry(self, entry):
+        self.current_session.messages.append(entry)
+        self.add_to_history(self.history, entry, self.model)
+        if self.journal is None:
+            self.journal = SessionJournal(os.path.join(SESSIONS_DIR, self.current_session.name),
+                                          header=self.current_session.header())
+        self.journal.append("messages", entry)
+
     def save_session(self):
-        if self.current_session:
-            with open(os.path.join(SESSIONS_DIR, self.current_session['filename']), 'w') as f:
-                json.dump(self.current_session, f, indent=2)
+        # fold the journal of the live session into its snapshot
+        if self.journal is not None:
+            with tracer.span('session.save'):
+                self.journal.close()
+            self.journal = None
+
+    def warm_up(self):
+        for model in config.data.get("fanout_models") or ([self.model] if self.model else []):
+            try:
+                self.llm.warm_up(model, config.data.get("keep_alive", "30m"))
+            except LLMBusy:
+                pass
+
+    def on_stop(self):
+        self.cancel_reply()
+        self.save_session()
+        self.llm.close()
+        self.llm.cache.close()
+        tracer.close()
+
+    def on_key_down(self, window, key, scancode, codepoint, modifiers):
+        if key == PROFILER_KEY:
+            tracer.toggle_profiler()
+            return True
 
     def update_rst_view(self):
-        conversation = self.current_session.get("conversation", [])
-        self.rst_view.text = "\n\n".join([entry["role"] + ":\n\n" + entry["content"] for entry in conversation])
+        messages = self.current_session.messages
+        live = self.stream and self.stream["filename"] == self.current_session.name
+        fanout = live and self.stream.get("fanout")
+        if fanout:
+            # the replies of the fan-out in progress are shown live, stored or not
+            messages = [entry for entry in messages if entry.get("fanout") != fanout]
+        entries = display_rows(messages)
+        if live:
+            entries.append(("Models", list(self.stream["columns"])) if fanout else (self.model, self.stream["text"]))
+        with tracer.span('render.show', messages=len(entries)):
+            self.rst_view.show(self.current_session.name, entries)
 
-    def send_prompt(self, instance):
-        user_input = self.prompt_input.text
-        if not user_input.strip():
+    def send_prompt(self, instance=None, text=None, from_init=False):
+        """Send `text`, by default the prompt box"""
+        user_input = text if text is not None else self.prompt_input.text
+        if not user_input.strip() or self.stream:
             return
-        self.prompt_input.text = ""
-        self.current_session["conversation"].append({"role": "User", "content": user_input})
-        self.query_llm(user_input)
-        self.save_session()
-        self.update_rst_view()
+        with tracer.span('ui.send'):
+            if text is None:
+                self.prompt_input.text = ""
+            self.append_entry({"role": "user", "content": user_input})
+            self.rst_view.append("User", user_input)
+            models = config.data.get("fanout_models") or []
+            if len(models) > 1:
+                self.query_fanout(models, options=INITIAL_PROMPT_OPTIONS if from_init else None)
+            else:
+                self.query_llm(user_input, options=INITIAL_PROMPT_OPTIONS if from_init else None)
+
+    def query_llm(self, prompt, options=None):
+        """Reply is requested on a client worker thread, the conversation so far (prompt
+        included) as context. When streamed, the view is refreshed at most STREAM_FPS,
+        in any case only the final entry is persisted"""
+        filename = self.current_session.name
+        model = self.model
+        streaming = config.data.get("stream", True)
+        self.stream = {"filename": filename, "text": ""}
+        buffer = TokenBuffer()
+        refresh = Clock.schedule_interval(lambda dt: self.flush_tokens(buffer), 1 / STREAM_FPS) if streaming else None
+        self.rst_view.append(model, "")
+        # prompt to persisted reply, the round-trip alone is the 'llm.http' span
+        turn = tracer.span('llm.turn', model=model, streaming=streaming)
+
+        def finish(entry):
+            if refresh:
+                refresh.cancel()
+            self.stream = None
+            self.reply_request = None
+            if self.current_session.name == filename:
+                self.rst_view.update_last(entry["content"], role=display_role(entry))
+            self.store_entry(filename, entry)
+            turn.end(chars=len(entry["content"]), **{k: v for k, v in entry.items() if k in ("ttft", "cancelled", "error")})
+
+        def on_done(result):
+            content, metrics = result
+            finish({"role": "assistant", "content": content, "model": model, "ttft": metrics["ttft"]})
+
+        def on_error(e):
+            if isinstance(e, LLMCancelled):
+                self.flush_tokens(buffer)
+                finish({"role": "assistant", "content": self.stream["text"], "model": model, "cancelled": True})
+            else:
+                finish({"role": "assistant", "content": str(e), "model": model, "error": True})
 
-    def query_llm(self, prompt):
-        url = config.data["ollama_url"] + "/api/generate"
-        payload = {
-            "model": self.model,
-            "prompt": prompt + "\n(Please respond in reStructuredText format)",
-            "stream": False
-        }
         try:
-            response = requests.post(url, json=payload)
-            response.raise_for_status()
-            content = response.json().get("response", "(No response)")
-            self.current_session["conversation"].append({"role": self.model, "content": content})
-        except Exception as e:
-            self.current_session["conversation"].append({"role": "Error", "content": str(e)})
+            self.reply_request = self.llm.chat(self.history, model, on_done, on_error,
+                                               on_token=buffer.append if streaming else None,
+                                               keep_alive=config.data.get("keep_alive", "30m"),
+                                               **({"options": options} if options else {}))
+        except LLMBusy as e:
+            on_error(e)
+
+    def query_fanout(self, models, options=None):
+        """The conversation to each of `models` concurrently, at most "fanout_parallel" requests
+        at once. Replies are shown side by side as they complete and persisted with their latency"""
+        filename = self.current_session.name
+        fanout = int(time.time() * 1000)
+        messages = list(self.current_session.messages)
+        columns = [(model, "...") for model in models]
+        keep_alive = config.data.get("keep_alive", "30m")
+        self.stream = {"filename": filename, "text": "", "fanout": fanout, "columns": columns}
+        self.rst_view.append("Models", list(columns))
+        turn = tracer.span('llm.fanout', models=len(models))
+
+        def payload_of(model):
+            history = ChatHistory(SYSTEM_PROMPT, config.data.get("context_tokens", 4096))
+            for entry in messages:
+                self.add_to_history(history, entry, model)
+            return history.payload(model, keep_alive, **({"options": options} if options else {}))
+
+        def store(entry):
+            columns[models.index(entry["model"])] = (reply_label(entry), entry["content"])
+            if self.current_session.name == filename:
+                self.rst_view.update_last(list(columns))
+            self.store_entry(filename, entry)
+
+        def on_reply(model, content, metrics):
+            store({"role": "assistant", "content": content, "model": model, "fanout": fanout,
+                   "latency": metrics["total"], "queued": metrics["queued"], "ttft": metrics["ttft"]})
+
+        def on_error(model, e):
+            if isinstance(e, LLMCancelled):
+                store({"role": "assistant", "content": "", "model": model, "fanout": fanout, "cancelled": True})
+            else:
+                store({"role": "assistant", "content": str(e), "model": model, "fanout": fanout, "error": True})
+
+        def on_done(results):
+            self.stream = None
+            self.reply_request = None
+            turn.end(errors=sum(isinstance(r, Exception) for r in results.values()))
+
+        self.reply_request = self.llm.fan_out(models, payload_of, "/api/chat", config.data.get("fanout_parallel", 2),
+                                              on_reply, on_error, on_done=on_done)
+
+    def store_entry(self, filename, entry):
+        if self.current_session.name == filename:
+            self.append_entry(entry)
+        else:
+            # user moved to another session meanwhile
+            journal = SessionJournal(os.path.join(SESSIONS_DIR, filename))
+            journal.append("messages", entry)
+            journal.close()
+
+    def cancel_reply(self, instance=None):
+        if self.reply_request:
+            self.reply_request.cancel()
+
+    def flush_tokens(self, buffer):
+        tokens = buffer.drain()
+        if tokens and self.stream:
+            self.stream["text"] += tokens
+            if self.current_session.name == self.stream["filename"]:
+                self.rst_view.update_last(self.stream["text"])
 
     def new_session(self):
+        self.save_session()
         timestamp = time.strftime("%Y%m%d_%H%M%S")
         filename = f"session_{timestamp}.json"
-        self.current_session = {
-            "filename": filename,
-            "model": self.model,
-            "timestamp": timestamp,
-            "conversation": []
-        }
-        self.session_files.append(filename)
-        self.current_session_index = len(self.session_files) - 1
+        self.current_session = Session(filename, meta={"model": self.model, "timestamp": timestamp}, messages=[])
+        self.history = self.chat_history([])
+        self.current_session_index = self.session_files.add(filename)
+        self.update_rst_view()
         if config.data.get("initial_prompt"):
-            self.send_prompt(TextInput(text=config.data["initial_prompt"]))
+            self.send_prompt(text=config.data["initial_prompt"], from_init=True)
+
+    def watch_sessions(self, dt):
+        # sessions added or removed by others: keep the position of the current one
+        if self.session_files.poll():
+            index = self.session_files.find(self.current_session.name)
+            self.current_session_index = index if index >= 0 else min(self.current_session_index,
+                                                                      len(self.session_files) - 1)
 
     def previous_session(self, instance):
         if self.current_session_index > 0:
@@ -145,37 +351,51 @@ class ConversationApp(App):
             self.new_session()
 
     def open_config(self, instance):
+        # widget of the dialog only: imported when first opened
+        from kivy.uix.checkbox import CheckBox
         content = BoxLayout(orientation='vertical')
         url_input = TextInput(text=config.data.get("ollama_url", ""), hint_text="Local Ollama URL")
         models_box = BoxLayout(orientation='vertical')
-        model_options = []
-        try:
-            response = requests.get(config.data["ollama_url"] + "/api/tags")
-            model_options = response.json().get("models", [])
-        except:
-            model_options = []
         checkboxes = {}
-        for model in model_options:
-            box = BoxLayout()
-            cb = CheckBox(group='models')
-            if model["name"] == config.data.get("selected_model"):
-                cb.active = True
-            lbl = Label(text=model["name"])
-            checkboxes[model["name"]] = cb
-            box.add_widget(cb)
-            box.add_widget(lbl)
-            models_box.add_widget(box)
+
+        def show_models(tags):
+            # listed from the catalog cache, listed again if a refresh brings changes
+            # several checked: each prompt goes to all of them (fan-out)
+            selected = [name for name, cb in checkboxes.items() if cb.active] or \
+                [config.data.get("selected_model")] + config.data.get("fanout_models", [])
+            models_box.clear_widgets()
+            checkboxes.clear()
+            for model in tags.get("models", []):
+                box = BoxLayout()
+                cb = CheckBox()
+                if model["name"] in selected:
+                    cb.active = True
+                lbl = Label(text=model["name"])
+                checkboxes[model["name"]] = cb
+                box.add_widget(cb)
+                box.add_widget(lbl)
+                models_box.add_widget(box)
+
+        self.llm.catalog.models(show_models)
 
         initial_prompt = TextInput(text=config.data.get("initial_prompt", ""), hint_text="Optional initial prompt")
+        parallel_input = TextInput(text=str(config.data.get("fanout_parallel", 2)), input_filter='int', multiline=False,
+                                   hint_text=f"Parallel requests, 1 to {MAX_PARALLEL}")
 
         def save_config(instance):
             config.data["ollama_url"] = url_input.text
+            self.llm.base_url = url_input.text
             config.data["initial_prompt"] = initial_prompt.text
-            for name, cb in checkboxes.items():
-                if cb.active:
-                    config.data["selected_model"] = name
-                    break
+            models = [self.model] + config.data.get("fanout_models", [])
+            checked = [name for name, cb in checkboxes.items() if cb.active]
+            if checked:
+                config.data["selected_model"] = checked[0]
+            config.data["fanout_models"] = checked if len(checked) > 1 else []
+            config.data["fanout_parallel"] = max(1, min(MAX_PARALLEL, int(parallel_input.text or 1)))
             config.save()
+            self.model = config.data.get("selected_model", "")
+            if [self.model] + config.data["fanout_models"] != models:
+                self.warm_up()
             popup.dismiss()
 
         save_btn = Button(text="Save", on_press=save_config)
@@ -185,6 +405,8 @@ class ConversationApp(App):
         content.add_widget(models_box)
         content.add_widget(Label(text="Initial Prompt:"))
         content.add_widget(initial_prompt)
+        content.add_widget(Label(text="Parallel requests (several models):"))
+        content.add_widget(parallel_input)
         content.add_widget(save_btn)
 
         popup = Popup(title="Configuration", content=content, size_hint=(0.9, 0.9))
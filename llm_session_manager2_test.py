@@ -0,0 +1,30 @@
+import pytest
+from types import SimpleNamespace
+
+
+@pytest.fixture
+def app2(tmp_path, monkeypatch):
+    # the app module creates its folders in the current directory
+    monkeypatch.chdir(tmp_path)
+    pytest.importorskip('kivy')
+    import llm_session_manager2
+    return llm_session_manager2
+
+
+def test_send_prompt(app2):
+    sent = []
+    app = SimpleNamespace(prompt_input=SimpleNamespace(text=''), stream=None,
+                          append_entry=sent.append, rst_view=SimpleNamespace(append=lambda role, text: None),
+                          query_llm=lambda prompt, options=None: sent.append((prompt, options)))
+    app2.config.data['fanout_models'] = []
+
+    # the initial prompt of a new session, the prompt box is empty
+    app2.ConversationApp.send_prompt(app, text='Hello', from_init=True)
+    assert sent == [{'role': 'user', 'content': 'Hello'}, ('Hello', app2.INITIAL_PROMPT_OPTIONS)]
+
+    sent.clear()
+    app.prompt_input.text = 'typed'
+    app2.ConversationApp.send_prompt(app)
+    assert sent[1] == ('typed', None) and app.prompt_input.text == ''
+    app2.ConversationApp.send_prompt(app)
+    assert len(sent) == 2
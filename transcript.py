@@ -0,0 +1,135 @@
+from collections import OrderedDict
+from kivy.clock import Clock
+from kivy.uix.boxlayout import BoxLayout
+from kivy.uix.recycleview import RecycleView
+from kivy.uix.recycleview.views import RecycleDataViewBehavior
+from kivy.uix.recycleboxlayout import RecycleBoxLayout
+from kivy.uix.rst import RstDocument
+from adscape.trace import tracer
+
+
+# a transcript view where each message is parsed/rendered once (RstDocument cached per message id,
+# along with the text it was rendered from: a reply that went on streaming while another session
+# was shown is rendered again) and only the rows on screen are in the widget tree (RecycleView)
+
+class MessageRow(RecycleDataViewBehavior, BoxLayout):
+    """Recycled row, just a holder for the cached rendered message"""
+
+    def refresh_view_attrs(self, rv, index, data):
+        doc = rv.rendered(data)
+        if doc.parent is not self:
+            if doc.parent is not None:
+                doc.parent.remove_widget(doc)
+            self.clear_widgets()
+            self.add_widget(doc)
+        return super().refresh_view_attrs(rv, index, data)
+
+
+class TranscriptView(RecycleView):
+
+    def __init__(self, template="**{role}**:\n\n{content}", max_cached=200, **kwargs):
+        super().__init__(**kwargs)
+        self.template = template
+        self.max_cached = max_cached
+        self._rendered: OrderedDict[str, RstDocument] = OrderedDict()
+        self._sources: dict[str, tuple] = {}    # msg_id: (role, content) of the rendered document
+        self._positions: dict[str, int] = {}
+        self.session_key = None
+        self.do_scroll_x = False
+        self.viewclass = MessageRow
+        layout = RecycleBoxLayout(orientation='vertical', size_hint_y=None, default_size=(None, 60),
+                                  default_size_hint=(1, None))
+        layout.bind(minimum_height=layout.setter('height'))
+        self.add_widget(layout)
+        self._trigger_refresh = Clock.create_trigger(lambda dt: self.refresh_from_data())
+
+    def show(self, session_key, messages):
+        """Show a whole session, messages as (role, content), content being a list of
+        (role, content) for a row of answers side by side"""
+        self.session_key = session_key
+        self._positions = {}
+        data = []
+        for role, content in messages:
+            data.append(self._item(len(data), role, content))
+        self.data = data
+        self.scroll_y = 0
+
+    def append(self, role, content):
+        self.data.append(self._item(len(self.data), role, content))
+        self.scroll_y = 0
+
+    def update_last(self, content, role=None):
+        """Replace the content of the last message (reply being streamed), only that message is re-rendered"""
+        if not self.data:
+            return
+        item = self.data[-1]
+        self._forget(item['msg_id'])
+        item['role'] = role or item['role']
+        item['content'] = content
+        self.data[-1] = item
+        self.scroll_y = 0
+
+    def rendered(self, item):
+        msg_id = item['msg_id']
+        doc = self._rendered.get(msg_id)
+        source = (item['role'], list(item['content']) if isinstance(item['content'], list) else item['content'])
+        if doc is not None and self._sources.get(msg_id) != source:
+            self._forget(msg_id)
+            doc = None
+        if doc is None:
+            if isinstance(item['content'], list):
+                # answers side by side
+                doc = BoxLayout(orientation='horizontal', size_hint_y=None, spacing=4)
+                for role, content in item['content']:
+                    column = self._render(role, content)
+                    column.content.bind(height=lambda content, h, column=column:
+                                        self._set_column_height(msg_id, column, h))
+                    doc.add_widget(column)
+            else:
+                doc = self._render(item['role'], item['content'])
+                doc.content.bind(height=lambda content, h: self._set_height(msg_id, h))
+            self._rendered[msg_id] = doc
+            self._sources[msg_id] = source
+            self._evict()
+        else:
+            self._rendered.move_to_end(msg_id)
+        return doc
+
+    def _render(self, role, content):
+        # parsing and layout of the RST text, once per message (and per streamed refresh)
+        with tracer.span('render.rst', chars=len(content)):
+            return RstDocument(text=self.template.format(role=role, content=content),
+                               size_hint_y=None, do_scroll_y=False)
+
+    def _item(self, position, role, content):
+        msg_id = f'{self.session_key}/{position}'
+        self._positions[msg_id] = position
+        return {'msg_id': msg_id, 'role': role, 'content': content, 'height': 60}
+
+    def _set_height(self, msg_id, height):
+        doc = self._rendered.get(msg_id)
+        if doc is not None:
+            doc.height = height
+        position = self._positions.get(msg_id)
+        if position is not None and position < len(self.data) and self.data[position]['msg_id'] == msg_id:
+            self.data[position]['height'] = height
+            self._trigger_refresh()
+
+    def _set_column_height(self, msg_id, column, height):
+        # the row is as high as its highest column
+        column.height = height
+        row = self._rendered.get(msg_id)
+        if row is not None:
+            self._set_height(msg_id, max(c.height for c in row.children))
+
+    def _evict(self):
+        # rendered widgets of rows on screen are kept
+        for msg_id in list(self._rendered):
+            if len(self._rendered) <= self.max_cached:
+                break
+            if self._rendered[msg_id].parent is None:
+                self._forget(msg_id)
+
+    def _forget(self, msg_id):
+        self._rendered.pop(msg_id, None)
+        self._sources.pop(msg_id, None)